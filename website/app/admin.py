@@ -1,6 +1,9 @@
 from django.contrib import admin
-from .models import Installation, Command
+from .models import Installation, Command, FleetDispatch, Alarm, ConnectionSession
 
 # Register your models here.
 admin.site.register(Installation)
-admin.site.register(Command)
\ No newline at end of file
+admin.site.register(Command)
+admin.site.register(FleetDispatch)
+admin.site.register(Alarm)
+admin.site.register(ConnectionSession)
\ No newline at end of file
@@ -1,4 +1,20 @@
 import django.apps as ap
+from django.db.backends.signals import connection_created
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    # The pragmas of settings.SQLITE_PRAGMAS only last as long as the
+    # connection, so they never change the database file
+    from django.conf import settings
+
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for pragma, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+                cursor.execute(f'PRAGMA {pragma}={value}')
+
 
 class AppConfig(ap.AppConfig):
-    name = 'app'
\ No newline at end of file
+    name = 'app'
+
+    def ready(self):
+        connection_created.connect(configure_sqlite)
@@ -0,0 +1,99 @@
+import logging
+import os
+import signal
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+def process_uptime():
+    """
+    The time since the current process was started by the kernel, so
+    that it includes the start of the interpreter, django.setup and
+    the imports done before the command runs. It is read from /proc,
+    with the resolution of the clock ticks of the kernel.
+
+    :return: the seconds since the start of the process, or None if
+        /proc is not available
+    """
+    try:
+        with open("/proc/self/stat") as stat:
+            # The name of the executable may contain spaces
+            fields = stat.read().rpartition(")")[2].split()
+        with open("/proc/uptime") as uptime:
+            boot = float(uptime.read().split()[0])
+        # starttime is the 22nd field, in clock ticks since the boot
+        return boot - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Command(BaseCommand):
+    """
+    Runs the socket server the RPis connect to, in the foreground.
+
+    Django is set up once by manage.py, and every module used to
+    serve the RPis is imported before serving, so neither the worker
+    processes nor the processes of the connections (see
+    AppSocketServer) set it up or import anything again.
+
+    The time from the start of the process to the listening socket is
+    measured against SOCKET_SERVER_STARTUP_BUDGET, as the RPis can
+    only reconnect after a restart once the server listens. Where the
+    start of the process is not known (see process_uptime), the time
+    is measured from the start of the command.
+    """
+
+    help = "Runs the socket server the RPis connect to"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", choices=("asyncio", "process"), default=settings.SOCKET_SERVER_MODE,
+                            help="Serve every RPi from an event loop, or fork a process for each one")
+        parser.add_argument("--port", type=int, default=getattr(settings, "SOCKET_SERVER_PORT", 37863))
+        parser.add_argument("--workers", type=int, default=settings.SOCKET_SERVER_WORKERS,
+                            help="Processes sharing the listening socket in asyncio mode")
+
+    def handle(self, *args, **options):
+        start = time.monotonic() - (process_uptime() or 0)
+        # Imported here, as they preload the models and the rest of the
+        # server before any process is forked
+        from appsocketserver import AppSocketServer
+        from server.asyncserver import AsyncAppSocketServer
+        from server.database import enable_wal
+        from server.sessions import shutdown
+
+        enable_wal()
+        if options["mode"] == "asyncio":
+            server = AsyncAppSocketServer(port=options["port"], workers=options["workers"],
+                                          notify_port=settings.SOCKET_SERVER_NOTIFY_PORT,
+                                          feed_port=settings.SOCKET_SERVER_FEED_PORT,
+                                          dispatch_rate=settings.SOCKET_SERVER_DISPATCH_RATE)
+        else:
+            server = AppSocketServer(port=options["port"], notify_port=settings.SOCKET_SERVER_NOTIFY_PORT,
+                                     feed_port=settings.SOCKET_SERVER_FEED_PORT,
+                                     dispatch_rate=settings.SOCKET_SERVER_DISPATCH_RATE)
+        server.daemon = True
+        server.start()
+
+        budget = getattr(settings, "SOCKET_SERVER_STARTUP_BUDGET", 2.0)
+        logger = logging.getLogger(__name__)
+        if server.ready.wait(max(budget - (time.monotonic() - start), 0)):
+            elapsed = time.monotonic() - start
+            logger.info(f"Socket server ready in {elapsed * 1000:.0f} ms")
+            self.stdout.write(f"Socket server listening on port {options['port']} in {options['mode']} mode, "
+                              f"ready in {elapsed * 1000:.0f} ms")
+        else:
+            logger.warning(f"Socket server not ready within the startup budget of {budget} s")
+            self.stderr.write(f"Socket server not ready within the startup budget of {budget} s")
+        # SIGTERM stops the server as SIGINT does. The processes of the
+        # socket server are then terminated by multiprocessing, and
+        # write what they buffered (see server.sessions.shutdown), as
+        # this process does for the server in its own threads.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            while server.is_alive():
+                server.join(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shutdown()
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.14 on 2026-10-17 01:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_auto_20200729_1044'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reading',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('imei', models.CharField(help_text='IMEI Code', max_length=255)),
+                ('ts', models.IntegerField(help_text='Timestamp (s)')),
+                ('inlet_pressure', models.IntegerField(help_text='Inlet pressure (Bar)', null=True)),
+                ('outlet_pressure', models.IntegerField(help_text='Outlet pressure (Bar)', null=True)),
+                ('inlet_temperature', models.IntegerField(help_text='Inlet temperature (°C)', null=True)),
+                ('speed', models.IntegerField(help_text='Speed (rpm)', null=True)),
+                ('running', models.BooleanField(help_text='Running state', null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reading',
+            index=models.Index(fields=['imei', 'ts'], name='reading_imei_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.0.14 on 2026-10-17 01:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_reading'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='command',
+            options={'ordering': ['id']},
+        ),
+        migrations.AlterField(
+            model_name='command',
+            name='imei',
+            field=models.CharField(db_index=True, help_text="Recipient's IMEI", max_length=255),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.14 on 2026-10-17 01:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_command_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetDispatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command_string', models.CharField(help_text='Command string', max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='Creation time')),
+                ('total', models.IntegerField(default=0, help_text='Number of recipients')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='command',
+            name='dispatch',
+            field=models.ForeignKey(blank=True, help_text='Fleet dispatch', null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.FleetDispatch'),
+        ),
+    ]
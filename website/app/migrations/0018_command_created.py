@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-17 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_fleet_dispatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='command',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, help_text='Creation time', null=True),
+        ),
+    ]
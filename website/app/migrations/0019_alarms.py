@@ -0,0 +1,91 @@
+# Generated by Django 3.0.14 on 2026-10-17 02:10
+
+import json
+from django.db import migrations, models
+
+
+def add_alarms_column(apps, schema_editor):
+    # The "alarms" column of the installations was added to the model
+    # without a migration: databases created by the migrations do not
+    # have it, so it is added before being moved to the Alarm rows
+    Installation = apps.get_model('app', 'Installation')
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        columns = [column.name for column in connection.introspection.get_table_description(cursor,
+                                                                                           'app_installation')]
+    if 'alarms' not in columns:
+        schema_editor.add_field(Installation, Installation._meta.get_field('alarms'))
+
+
+def move_alarms(apps, schema_editor):
+    # The alarms were a JSON list of CANbus IDs: every ID becomes an
+    # active Alarm
+    from django.utils import timezone
+
+    Alarm = apps.get_model('app', 'Alarm')
+    Installation = apps.get_model('app', 'Installation')
+    now = timezone.now()
+    alarms = []
+    for imei, nodes in Installation.objects.values_list('imei', 'alarms'):
+        try:
+            nodes = json.loads(nodes)
+        except (TypeError, ValueError):
+            continue
+        if isinstance(nodes, list):
+            alarms += [Alarm(imei=imei, node=int(node), raised=now) for node in set(nodes)]
+    Alarm.objects.bulk_create(alarms)
+
+
+def restore_alarms(apps, schema_editor):
+    # The column is rebuilt from the Alarms not cleared yet
+    Alarm = apps.get_model('app', 'Alarm')
+    Installation = apps.get_model('app', 'Installation')
+    nodes = {}
+    for imei, node in Alarm.objects.filter(cleared__isnull=True).values_list('imei', 'node'):
+        nodes.setdefault(imei, []).append(node)
+    for imei, alarms in nodes.items():
+        Installation.objects.filter(imei=imei).update(alarms=json.dumps(sorted(alarms)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_command_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Alarm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('imei', models.CharField(help_text='IMEI Code', max_length=255)),
+                ('node', models.IntegerField(help_text='CANbus ID of the node')),
+                ('raised', models.DateTimeField(help_text='Raise time')),
+                ('cleared', models.DateTimeField(blank=True, help_text='Clear time', null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='alarm',
+            index=models.Index(fields=['node', 'cleared'], name='alarm_node_cleared_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alarm',
+            index=models.Index(fields=['imei', 'cleared'], name='alarm_imei_cleared_idx'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='installation',
+                    name='alarms',
+                    field=models.CharField(default='[]', max_length=255,
+                                           help_text='JSON containing CANbus IDs of the nodes in an alarm state'),
+                ),
+            ],
+        ),
+        migrations.RunPython(add_alarms_column, migrations.RunPython.noop),
+        migrations.RunPython(move_alarms, restore_alarms),
+        migrations.RemoveField(
+            model_name='installation',
+            name='alarms',
+        ),
+    ]
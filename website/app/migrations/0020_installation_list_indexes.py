@@ -0,0 +1,136 @@
+# Generated by Django 3.0.14 on 2026-10-17 02:40
+
+from django.db import migrations, models
+
+# The columns of the installations added to the model, and removed
+# from it, without a migration
+MISSING_COLUMNS = {
+    'outlet_pressure_target': models.IntegerField(default=0),
+    'running': models.BooleanField(default=False),
+    'speed': models.IntegerField(default=0),
+}
+STALE_COLUMNS = ('alarm', 'time_limit')
+
+
+def sync_columns(apps, schema_editor):
+    # Databases created before the model changed already have the
+    # right columns, the ones created by the migrations do not: only
+    # the columns that are missing are added, and the stale ones that
+    # exist dropped
+    connection = schema_editor.connection
+    quote = schema_editor.quote_name
+    with connection.cursor() as cursor:
+        columns = {column.name for column in connection.introspection.get_table_description(cursor,
+                                                                                          'app_installation')}
+    for name, field in MISSING_COLUMNS.items():
+        if name not in columns:
+            default = schema_editor.quote_value(field.get_default())
+            schema_editor.execute(f"ALTER TABLE {quote('app_installation')} ADD COLUMN {quote(name)} "
+                                  f"{field.db_type(connection)} NOT NULL DEFAULT {default}")
+    for name in STALE_COLUMNS:
+        if name in columns:
+            schema_editor.execute(f"ALTER TABLE {quote('app_installation')} DROP COLUMN {quote(name)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_alarms'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(sync_columns, migrations.RunPython.noop),
+            ],
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='installation',
+                    name='alarm',
+                ),
+                migrations.RemoveField(
+                    model_name='installation',
+                    name='time_limit',
+                ),
+                migrations.AddField(
+                    model_name='installation',
+                    name='outlet_pressure_target',
+                    field=models.IntegerField(default=0, help_text='Target pressure (Bar) for the output'),
+                ),
+                migrations.AddField(
+                    model_name='installation',
+                    name='running',
+                    field=models.BooleanField(default=False, help_text='Running state'),
+                ),
+                migrations.AddField(
+                    model_name='installation',
+                    name='speed',
+                    field=models.IntegerField(default=0, help_text='Speed (rpm)'),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='inlet_pressure',
+                    field=models.IntegerField(default=0, help_text='Inlet pressure (Bar)'),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='inlet_temperature',
+                    field=models.IntegerField(blank=True, default=0, help_text='Inlet temperature (°C)'),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='installation_code',
+                    field=models.CharField(default='default', help_text='Installation Code', max_length=255),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='outlet_pressure',
+                    field=models.IntegerField(default=0, help_text='Outlet pressure (Bar)'),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='run',
+                    field=models.BooleanField(default=False, help_text='Running command'),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='start_code',
+                    field=models.CharField(default='0x0000', help_text='Start code', max_length=255),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='working_hours_counter',
+                    field=models.IntegerField(default=0, help_text='Total working hours'),
+                ),
+                migrations.AlterField(
+                    model_name='installation',
+                    name='working_minutes_counter',
+                    field=models.IntegerField(default=0, help_text='Working minutes'),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='installation',
+            index=models.Index(fields=['installation_code', 'id'], name='installation_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='installation',
+            index=models.Index(fields=['online', 'id'], name='installation_online_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='installation',
+            index=models.Index(fields=['running', 'id'], name='installation_running_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='installation',
+            index=models.Index(fields=['outlet_pressure', 'id'], name='installation_pressure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='installation',
+            index=models.Index(fields=['speed', 'id'], name='installation_speed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='installation',
+            index=models.Index(fields=['working_hours_counter', 'id'], name='installation_hours_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.0.14 on 2026-10-17 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_installation_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='command',
+            name='imei',
+            field=models.CharField(help_text="Recipient's IMEI", max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='alarm',
+            index=models.Index(condition=models.Q(cleared__isnull=True), fields=['imei', 'node'], name='alarm_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['imei', 'id'], name='command_imei_id_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.14 on 2026-10-17 03:10
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConnectionSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('imei', models.CharField(help_text='IMEI Code', max_length=255)),
+                ('address', models.CharField(help_text='Address of the RPi', max_length=255)),
+                ('connected', models.DateTimeField(help_text='Connection time')),
+                ('disconnected', models.DateTimeField(blank=True, help_text='Disconnection time', null=True)),
+                ('bytes_received', models.BigIntegerField(default=0, help_text='Bytes received from the RPi')),
+                ('bytes_sent', models.BigIntegerField(default=0, help_text='Bytes sent to the RPi')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='connectionsession',
+            index=models.Index(fields=['imei', 'connected'], name='session_imei_connected_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='connectionsession',
+            index=models.Index(condition=models.Q(disconnected__isnull=True), fields=['connected'], name='session_open_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.14 on 2026-10-17 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_connection_sessions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('imei', models.CharField(help_text='IMEI Code', max_length=255)),
+                ('field', models.CharField(help_text='Field of the Readings', max_length=32)),
+                ('minute', models.IntegerField(help_text='Minute (s)')),
+                ('min', models.IntegerField(help_text='Minimum')),
+                ('max', models.IntegerField(help_text='Maximum')),
+                ('total', models.BigIntegerField(help_text='Total')),
+                ('count', models.IntegerField(help_text='Number of Readings')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='readingrollup',
+            index=models.Index(fields=['imei', 'field', 'minute'], name='rollup_imei_field_minute_idx'),
+        ),
+    ]
@@ -1,4 +1,44 @@
+import time
+import uuid
 from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.db.models import F, Q, Min, Max, Avg, Sum, Count, Value, Exists, OuterRef
+
+
+class InstallationQuerySet(models.QuerySet):
+    def with_alarms(self, has_alarms=True):
+        """
+        The Installations with (or without) an active Alarm, with an
+        EXISTS subquery served by the (imei, cleared) index of the
+        Alarms.
+        """
+        active = Alarm.objects.active().filter(imei=OuterRef('imei'))
+        return self.annotate(has_alarms=Exists(active)).filter(has_alarms=has_alarms)
+
+    def keyset(self, sort, last=None):
+        """
+        Orders the Installations by one of Installation.SORT_FIELDS,
+        prefixed by "-" for a descending order, and then by id. If the
+        sort value and the id of the last Installation of the previous
+        page are given, only the Installations after it are returned,
+        so that every page is read from the (field, id) index of the
+        field starting from the previous one, instead of counting
+        OFFSET rows from the start.
+        """
+        field = sort.lstrip('-')
+        descending = sort.startswith('-')
+        lookup = 'lt' if descending else 'gt'
+        queryset = self.order_by(sort, '-id' if descending else 'id')
+        if last is None:
+            return queryset
+        value, pk = last
+        if field == 'id':
+            return queryset.filter(**{f'id__{lookup}': pk})
+        # The first condition is redundant, but it lets the database
+        # seek the index to the first row of the page
+        return queryset.filter(Q(**{f'{field}__{lookup}e': value}),
+                               Q(**{f'{field}__{lookup}': value}) | Q(**{f'id__{lookup}': pk}))
 
 
 # Create your models here.
@@ -20,8 +60,6 @@ class Installation(models.Model):
     working_minutes_counter = models.IntegerField(help_text="Working minutes", null=False, default=0)
     anti_drip = models.BooleanField(help_text="Anti-drip", default=False)
     start_code = models.CharField(help_text="Start code", null=False, max_length=255, default="0x0000")
-    alarms = models.CharField(help_text="JSON containing CANbus IDs of the nodes in an alarm state", default="[]",
-                              null=False, max_length=255)
     speed = models.IntegerField(help_text="Speed (rpm)", default=0, null=False)
     bk_service = models.BooleanField(help_text="Backup service", default=False)
     tl_service = models.BooleanField(help_text="Time limit service", default=False)
@@ -29,12 +67,37 @@ class Installation(models.Model):
     run = models.BooleanField(help_text="Running command", default=False)
     running = models.BooleanField(help_text="Running state", default=False)
 
+    # The fields sent to the dashboard, along with the active Alarms
+    SNAPSHOT_FIELDS = ('id', 'installation_code', 'imei', 'online', 'inlet_pressure', 'inlet_temperature',
+                       'outlet_pressure', 'outlet_pressure_target', 'working_hours_counter',
+                       'working_minutes_counter', 'anti_drip', 'start_code', 'speed', 'bk_service',
+                       'tl_service', 'rb_service', 'run', 'running')
+
+    # The fields the list of the installations can be sorted by (see
+    # InstallationQuerySet.keyset), each one with an index
+    SORT_FIELDS = ('id', 'imei', 'installation_code', 'outlet_pressure', 'speed', 'working_hours_counter')
+
+    objects = InstallationQuerySet.as_manager()
+
     """
     Metadata
     Permissions, ...
     """
     class Meta:
         permissions = (("can_see_advanced_info", "Can see advanced informations"), )
+        # The indexes of the list of the installations: the filters,
+        # followed by the id as it is the default order, and the sort
+        # fields. Every telemetry field indexed is one more index
+        # written by the updates of the socket server, so only the
+        # ones worth sorting by are.
+        indexes = [
+            models.Index(fields=['installation_code', 'id'], name='installation_code_idx'),
+            models.Index(fields=['online', 'id'], name='installation_online_idx'),
+            models.Index(fields=['running', 'id'], name='installation_running_idx'),
+            models.Index(fields=['outlet_pressure', 'id'], name='installation_pressure_idx'),
+            models.Index(fields=['speed', 'id'], name='installation_speed_idx'),
+            models.Index(fields=['working_hours_counter', 'id'], name='installation_hours_idx'),
+        ]
 
     """
     Methods
@@ -45,6 +108,42 @@ class Installation(models.Model):
         return self.imei
 
 
+class FleetDispatch(models.Model):
+    """
+    This class defines a model for a Fleet Dispatch: the same command
+    sent to many installations at once. Every Command created by the
+    dispatch refers to it, so that its progress can be followed: a
+    Command is deleted as soon as the installation executes it.
+
+    Questa classe definisce un modello per un Invio alla Flotta:
+    lo stesso comando inviato a molti impianti allo stesso tempo.
+    """
+
+    """
+    Fields
+    """
+    command_string = models.CharField(help_text="Command string", max_length=255, null=False, blank=False)
+    created = models.DateTimeField(help_text="Creation time", auto_now_add=True)
+    total = models.IntegerField(help_text="Number of recipients", default=0)
+
+    def __str__(self):
+        return "{} to {} installations".format(self.command_string, self.total)
+
+
+class CommandQuerySet(models.QuerySet):
+    def delete_executed(self, imei, ids):
+        """
+        Removes the given Commands of an installation from its queue,
+        and publishes whether other Commands are still queued for it,
+        with a DELETE and a single EXISTS whatever the number of
+        Commands.
+        """
+        from server.feed import publish_update
+        deleted, _ = self.filter(imei=imei, id__in=ids).delete()
+        publish_update(imei, command_pending=self.filter(imei=imei).exists())
+        return deleted
+
+
 class Command(models.Model):
     """
     This class defines a model for a Command. A Command
@@ -60,11 +159,338 @@ class Command(models.Model):
     """
     Fields
     """
-    # A single command can be sent to an IMEI at one time
-    imei = models.CharField(help_text="Recipient's IMEI", unique=True, max_length=255)
+    # Commands for the same IMEI are queued, and sent in order of id
+    # (see ConnectedClient.execute_pending_commands), which is read
+    # from the (imei, id) index without sorting
+    imei = models.CharField(help_text="Recipient's IMEI", max_length=255)
     command_string = models.CharField(help_text="Command string", max_length=255, null=False, blank=False)
+    dispatch = models.ForeignKey(FleetDispatch, help_text="Fleet dispatch", null=True, blank=True,
+                                 on_delete=models.SET_NULL)
+    # Used to measure the latency of the commands (see server.metrics)
+    created = models.DateTimeField(help_text="Creation time", auto_now_add=True, null=True)
+
+    objects = CommandQuerySet.as_manager()
+
+    """
+    Metadata
+    """
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['imei', 'id'], name='command_imei_id_idx'),
+        ]
 
     def __str__(self):
         # A human-readable form of a Command model
         info = "For {}: {}".format(self.imei, self.command_string)
         return info
+
+
+# Every change saved through the ORM is published to the update feed
+# of the socket server, which keeps the live state of the
+# installations (see server.feed and server.livestate). Telemetry
+# written in bulk by the socket server is published by
+# server.telemetry instead, and the executed Commands are published
+# once for every installation by CommandQuerySet.delete_executed, as a
+# post_delete receiver would query the queue for every deleted row.
+@receiver(post_save, sender=Installation)
+def publish_installation(sender, instance, **kwargs):
+    from server.feed import publish_updates
+    publish_updates([{field: getattr(instance, field) for field in Installation.SNAPSHOT_FIELDS}])
+
+
+@receiver(post_save, sender=Command)
+def publish_command_saved(sender, instance, **kwargs):
+    from server.feed import publish_update
+    publish_update(instance.imei, command_pending=True)
+
+
+# Maximum number of time ranges of Readings matched by a single query
+# (see ReadingQuerySet.history)
+RANGES_PER_QUERY = 100
+
+
+class ReadingQuerySet(models.QuerySet):
+    def between(self, imei, start, end):
+        """
+        The Readings of the given installation in the given time
+        range, as UNIX timestamps. This is served by the (imei, ts)
+        index.
+        """
+        return self.filter(imei=imei, ts__gte=start, ts__lt=end)
+
+    def downsample(self, field, bucket):
+        """
+        Groups the Readings in buckets of the given number of seconds,
+        returning the bucket start, and the minimum, maximum and
+        average of the field in it, along with its total and the
+        number of values. The aggregation runs in the database, so
+        only one row per bucket is returned.
+        """
+        bucket_start = (F('ts') / Value(bucket)) * Value(bucket)
+        return (self.annotate(bucket=bucket_start)
+                .values('bucket')
+                .annotate(min=Min(field), max=Max(field), avg=Avg(field), total=Sum(field), count=Count(field))
+                .order_by('bucket'))
+
+    def history(self, imei, field, start, end, bucket):
+        """
+        Same as between(imei, start, end).downsample(field, bucket),
+        as a list. When the buckets are whole minutes, the minutes
+        already rolled up (see ReadingRollup) are read from the
+        rollups, so that a month is read from 43,200 rows instead of
+        up to one Reading per second. The partial minute at the start
+        of the range, the last minutes, not rolled up yet, and the
+        buckets with minutes that have no rollup (e.g. as the socket
+        server stopped before writing it, or as the installation was
+        offline) are read from the Readings.
+        """
+        if bucket % 60:
+            return [{key: row[key] for key in ('bucket', 'min', 'max', 'avg')}
+                    for row in self.between(imei, start, end).downsample(field, bucket)]
+        # The rollups of a minute are written by the socket server
+        # once the minute is over (see server.telemetry)
+        first = min(-(-start // 60) * 60, end)
+        last = max(min(end // 60 * 60, int(time.time()) // 60 * 60 - ReadingRollup.DELAY), first)
+        rollups = []
+        ranges = [(start, first)]
+        for row in ReadingRollup.objects.between(imei, field, first, last).downsample(bucket):
+            if row['minutes'] == (min(row['bucket'] + bucket, last) - max(row['bucket'], first)) // 60:
+                rollups.append(row)
+        complete = {row['bucket'] for row in rollups}
+        for bucket_start in range(first // bucket * bucket, last, bucket):
+            if bucket_start not in complete:
+                ranges.append((max(bucket_start, first), min(bucket_start + bucket, last)))
+        ranges.append((last, end))
+        # Adjacent ranges are read as one
+        merged = []
+        for range_start, range_end in ranges:
+            if merged and merged[-1][1] == range_start:
+                merged[-1] = (merged[-1][0], range_end)
+            elif range_start < range_end:
+                merged.append((range_start, range_end))
+        parts = [rollups]
+        for i in range(0, len(merged), RANGES_PER_QUERY):
+            condition = Q()
+            for range_start, range_end in merged[i:i + RANGES_PER_QUERY]:
+                condition |= Q(ts__gte=range_start, ts__lt=range_end)
+            parts.append(self.filter(condition, imei=imei).downsample(field, bucket))
+        buckets = {}
+        for part in parts:
+            for row in part:
+                if not row['count']:
+                    continue
+                merged = buckets.get(row['bucket'])
+                if merged is None:
+                    buckets[row['bucket']] = dict(row)
+                    continue
+                merged['min'] = min(merged['min'], row['min'])
+                merged['max'] = max(merged['max'], row['max'])
+                merged['total'] += row['total']
+                merged['count'] += row['count']
+        return [{'bucket': row['bucket'], 'min': row['min'], 'max': row['max'], 'avg': row['total'] / row['count']}
+                for _, row in sorted(buckets.items())]
+
+
+class Reading(models.Model):
+    """
+    This class defines a model for a Reading: the values of the
+    telemetry fields of an Installation at a given time. Readings are
+    only ever appended, in bulk, by the socket server (see
+    server.telemetry), and they are the history of the Installation.
+
+    Questa classe definisce un modello per una Lettura: i valori
+    dei campi di telemetria di un Impianto in un dato momento.
+    """
+
+    # The fields of Installation whose history is kept
+    FIELDS = ('inlet_pressure', 'outlet_pressure', 'inlet_temperature', 'speed', 'running')
+
+    """
+    Fields
+    """
+    imei = models.CharField(help_text="IMEI Code", max_length=255)
+    # UNIX timestamp: more compact than a datetime, and bucketing is
+    # a simple integer division
+    ts = models.IntegerField(help_text="Timestamp (s)")
+    inlet_pressure = models.IntegerField(help_text="Inlet pressure (Bar)", null=True)
+    outlet_pressure = models.IntegerField(help_text="Outlet pressure (Bar)", null=True)
+    inlet_temperature = models.IntegerField(help_text="Inlet temperature (°C)", null=True)
+    speed = models.IntegerField(help_text="Speed (rpm)", null=True)
+    running = models.BooleanField(help_text="Running state", null=True)
+
+    objects = ReadingQuerySet.as_manager()
+
+    """
+    Metadata
+    """
+    class Meta:
+        indexes = [models.Index(fields=['imei', 'ts'], name='reading_imei_ts_idx')]
+
+    def __str__(self):
+        return "{} at {}".format(self.imei, self.ts)
+
+
+class ReadingRollupQuerySet(models.QuerySet):
+    def between(self, imei, field, start, end):
+        """
+        The rollups of a field of the given installation in the given
+        time range, as UNIX timestamps of whole minutes. This is
+        served by the (imei, field, minute) index.
+        """
+        return self.filter(imei=imei, field=field, minute__gte=start, minute__lt=end)
+
+    def downsample(self, bucket):
+        """
+        Same as ReadingQuerySet.downsample, for buckets of whole
+        minutes, along with the number of minutes rolled up in every
+        bucket.
+        """
+        bucket_start = (F('minute') / Value(bucket)) * Value(bucket)
+        return (self.annotate(bucket=bucket_start)
+                .values('bucket')
+                .annotate(min=Min('min'), max=Max('max'), total=Sum('total'), count=Sum('count'),
+                          minutes=Count('minute', distinct=True))
+                .order_by('bucket'))
+
+
+class ReadingRollup(models.Model):
+    """
+    This class defines a model for a Reading Rollup: the minimum,
+    maximum, total and number of the Readings of a field of an
+    Installation in a minute. Rollups are written by the socket
+    server once the minute is over (see server.telemetry), and serve
+    the history over long time ranges (see ReadingQuerySet.history).
+    A minute may have more than one rollup, e.g. if the RPi
+    reconnected: they are added up when read.
+
+    Questa classe definisce un modello per un Riepilogo delle Letture:
+    il minimo, il massimo, il totale e il numero delle Letture di un
+    campo di un Impianto in un minuto.
+    """
+
+    # Seconds after the end of a minute within which its rollups are
+    # written
+    DELAY = 60
+
+    """
+    Fields
+    """
+    imei = models.CharField(help_text="IMEI Code", max_length=255)
+    field = models.CharField(help_text="Field of the Readings", max_length=32)
+    # UNIX timestamp of the start of the minute
+    minute = models.IntegerField(help_text="Minute (s)")
+    min = models.IntegerField(help_text="Minimum")
+    max = models.IntegerField(help_text="Maximum")
+    total = models.BigIntegerField(help_text="Total")
+    count = models.IntegerField(help_text="Number of Readings")
+
+    objects = ReadingRollupQuerySet.as_manager()
+
+    """
+    Metadata
+    """
+    class Meta:
+        indexes = [models.Index(fields=['imei', 'field', 'minute'], name='rollup_imei_field_minute_idx')]
+
+    def __str__(self):
+        return "{} of {} at {}".format(self.field, self.imei, self.minute)
+
+
+class AlarmQuerySet(models.QuerySet):
+    def active(self):
+        """
+        The Alarms not cleared yet. With node, this is served by the
+        (node, cleared) index, e.g. the installations with node #12 in
+        an alarm state are Alarm.objects.active().filter(node=12).
+        """
+        return self.filter(cleared__isnull=True)
+
+    def nodes_by_imei(self):
+        """
+        The CANbus IDs of the Alarms, as a dictionary of sorted lists
+        by IMEI, with a single query.
+        """
+        nodes = {}
+        for imei, node in self.order_by('imei', 'node').values_list('imei', 'node'):
+            nodes.setdefault(imei, []).append(node)
+        return nodes
+
+
+class Alarm(models.Model):
+    """
+    This class defines a model for an Alarm: a CANbus node of an
+    Installation in an alarm state, from the time it was raised to the
+    time it was cleared. Alarms are written by the socket server (see
+    server.telemetry) when the list of nodes in an alarm state sent by
+    a RPi changes, and the ones not cleared yet are the current alarms
+    of the Installation.
+
+    Questa classe definisce un modello per un Allarme: un nodo
+    CANbus di un Impianto in stato di allarme, dal momento in cui è
+    scattato al momento in cui è rientrato.
+    """
+
+    """
+    Fields
+    """
+    imei = models.CharField(help_text="IMEI Code", max_length=255)
+    node = models.IntegerField(help_text="CANbus ID of the node")
+    raised = models.DateTimeField(help_text="Raise time")
+    cleared = models.DateTimeField(help_text="Clear time", null=True, blank=True)
+
+    objects = AlarmQuerySet.as_manager()
+
+    """
+    Metadata
+    """
+    class Meta:
+        # The partial index only holds the active Alarms, in the order
+        # of nodes_by_imei, so reading them never sorts nor visits
+        # the cleared ones
+        indexes = [models.Index(fields=['node', 'cleared'], name='alarm_node_cleared_idx'),
+                   models.Index(fields=['imei', 'cleared'], name='alarm_imei_cleared_idx'),
+                   models.Index(fields=['imei', 'node'], name='alarm_active_idx', condition=Q(cleared__isnull=True))]
+
+    def __str__(self):
+        return "#{} of {}".format(self.node, self.imei)
+
+
+class ConnectionSession(models.Model):
+    """
+    This class defines a model for a Connection Session: a connection
+    of a RPi to the socket server, from the time it was identified to
+    the time it was closed, with the address of the RPi and the bytes
+    exchanged. Sessions are written in bulk by the socket server (see
+    server.sessions.SessionRecorder), which generates their primary
+    key, so that a session can be closed without reading it back.
+
+    Questa classe definisce un modello per una Sessione di
+    Connessione: una connessione di un RPi al socket server, dalla
+    sua identificazione alla sua chiusura.
+    """
+
+    """
+    Fields
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    imei = models.CharField(help_text="IMEI Code", max_length=255)
+    address = models.CharField(help_text="Address of the RPi", max_length=255)
+    connected = models.DateTimeField(help_text="Connection time")
+    # Sessions left open by a stopped server are closed at startup
+    # (see AppSocketServer.set_all_offline)
+    disconnected = models.DateTimeField(help_text="Disconnection time", null=True, blank=True)
+    bytes_received = models.BigIntegerField(help_text="Bytes received from the RPi", default=0)
+    bytes_sent = models.BigIntegerField(help_text="Bytes sent to the RPi", default=0)
+
+    """
+    Metadata
+    """
+    class Meta:
+        # The partial index only holds the open sessions
+        indexes = [models.Index(fields=['imei', 'connected'], name='session_imei_connected_idx'),
+                   models.Index(fields=['connected'], name='session_open_idx',
+                                condition=Q(disconnected__isnull=True))]
+
+    def __str__(self):
+        return "{} from {}".format(self.imei, self.address)
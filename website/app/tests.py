@@ -1,3 +1,889 @@
-from django.test import TestCase
+import json
+import logging
+import socket
+import sys
+import time
+from multiprocessing import Pipe
+from threading import Thread
+from unittest import mock
+from django.contrib.auth.models import User, Permission
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from .models import Installation, Command, Alarm, ConnectionSession, Reading, ReadingRollup
+from appsocketserver import AppSocketServer
+from server.alarms import AlarmBus, NODE_BURST, NODE_RATE, RAISED, CLEARED
+from server.asyncserver import AsyncConnectedClient
+from server.cadence import PollScheduler
+from server.connectedclient import ConnectedClient
+from server.encoding import TelemetryDecoder, encode_delta
+from server.feed import UpdateFeed
+from server.framing import MessageBuffer
+from server.heartbeat import TimerWheel
+from server.livestate import LiveState
+from server.logs import client_logger, ImeiSampler, JsonFormatter
+from server import metrics
+from server import notify
+from server import sessions
+from server.sessions import SessionRecorder
+from server.telemetry import TelemetryIngestor
 
-# Create your tests here.
+# The number of installations of the tests: the number of queries
+# must not depend on it
+FLEET_SIZE = 30
+
+
+# Nothing listens on port 1, so the views read the database instead
+# of the live state of the socket server
+@override_settings(SOCKET_SERVER_FEED_PORT=1, SOCKET_SERVER_NOTIFY_PORT=1)
+class QueryCountTest(TestCase):
+    """
+    The number of queries of every view and of every step of the
+    socket server, whatever the number of installations, commands and
+    alarms. Every view of a logged in user also reads the session and
+    the user.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Installation.objects.bulk_create([Installation(imei=f"{i:015d}", online=i % 2 == 0)
+                                          for i in range(FLEET_SIZE)])
+        Command.objects.bulk_create([Command(imei=f"{i:015d}", command_string="RUN")
+                                     for i in range(FLEET_SIZE) for _ in range(3)])
+        Alarm.objects.bulk_create([Alarm(imei=f"{i:015d}", node=node, raised=timezone.now())
+                                   for i in range(0, FLEET_SIZE, 3) for node in (3, 7)])
+        cls.user = User.objects.create_user("operator", password="operator")
+        cls.user.user_permissions.add(Permission.objects.get(codename="can_see_advanced_info"))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_dashboard(self):
+        # The page, its commands and its alarms, then the permissions
+        # of the user read by the template
+        with self.assertNumQueries(7):
+            response = self.client.get("/app/dashboard/", {"online": "1", "sort": "-id"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_installation_list(self):
+        with self.assertNumQueries(5):
+            response = self.client.get("/app/dashboard/installations/list", {"has_alarms": "1", "limit": 5})
+        self.assertEqual(len(response.json()["installations"]), 5)
+        with self.assertNumQueries(5):
+            response = self.client.get("/app/dashboard/installations/list",
+                                       {"has_alarms": "1", "limit": 5, "after": response.json()["next"]})
+        self.assertEqual(len(response.json()["installations"]), 5)
+
+    def test_update_data(self):
+        with self.assertNumQueries(5):
+            response = self.client.post("/app/dashboard/installations/update_data")
+        self.assertEqual(len(response.json()), FLEET_SIZE)
+        with self.assertNumQueries(5):
+            response = self.client.post("/app/dashboard/installations/update_data",
+                                        {"imeis": f"{0:015d},{1:015d}"})
+        self.assertEqual(len(response.json()), 2)
+
+    def test_command_pending(self):
+        with self.assertNumQueries(3):
+            response = self.client.post("/app/dashboard/installations/command_pending", {"imei": f"{0:015d}"})
+        self.assertTrue(response.json()["command_pending"])
+
+    def test_toggle_installation(self):
+        # Whether the queue is full, then the new command
+        with self.assertNumQueries(4):
+            response = self.client.post("/app/dashboard/installations/toggle",
+                                        {"imei": f"{0:015d}", "command": "run"})
+        self.assertEqual(response.content, b"success")
+
+    def test_restart(self):
+        ConnectionSession.objects.create(imei=f"{0:015d}", address="127.0.0.1:1", connected=timezone.now())
+        # The installations, then the sessions left open
+        with self.assertNumQueries(2):
+            AppSocketServer.set_all_offline()
+        self.assertFalse(Installation.objects.filter(online=True).exists())
+        self.assertFalse(ConnectionSession.objects.filter(disconnected__isnull=True).exists())
+
+        # The whole fleet, and a new RPi, reconnect
+        recorder = SessionRecorder()
+        imeis = [f"{i:015d}" for i in range(FLEET_SIZE)] + ["new"]
+        sessions = {imei: recorder.connect(imei, ("127.0.0.1", 1)) for imei in imeis}
+        # The known IMEIs, the new Installation and its fields, then in
+        # a transaction (a savepoint in the tests) the sessions and the
+        # online state
+        with self.assertNumQueries(7):
+            self.assertEqual(recorder.flush(), len(imeis))
+        self.assertEqual(Installation.objects.filter(online=True).count(), len(imeis))
+
+        # The fleet reconnects again, one RPi before its previous
+        # connection is closed
+        recorder.connect(f"{0:015d}", ("127.0.0.1", 2))
+        for imei, session in sessions.items():
+            recorder.disconnect(session, imei, 10, 20)
+        # The new session, the closed ones and the online state
+        with self.assertNumQueries(6):
+            recorder.flush()
+        self.assertEqual(list(Installation.objects.filter(online=True).values_list("imei", flat=True)),
+                         [f"{0:015d}"])
+        self.assertEqual(ConnectionSession.objects.filter(disconnected__isnull=True).count(), 1)
+        self.assertEqual(ConnectionSession.objects.filter(bytes_received=10, bytes_sent=20).count(), len(imeis))
+
+    def test_restart_telemetry_error(self):
+        recorder = SessionRecorder()
+        session = recorder.connect(f"{0:015d}", ("127.0.0.1", 1))
+        recorder.disconnect(session, f"{0:015d}")
+        # The sessions are written even if the telemetry can not be
+        with mock.patch("server.sessions.get_ingestor") as get_ingestor:
+            get_ingestor.return_value.forget.side_effect = ValueError()
+            recorder.flush()
+        self.assertFalse(Installation.objects.get(imei=f"{0:015d}").online)
+        self.assertFalse(ConnectionSession.objects.filter(disconnected__isnull=True).exists())
+
+    def test_new_installation_telemetry(self):
+        recorder = SessionRecorder()
+        ingestor = TelemetryIngestor()
+        decoder = TelemetryDecoder()
+        recorder.connect("new", ("127.0.0.1", 1))
+        # The first reply arrives before the Installation is created:
+        # it is kept, as the decoder will not send it again
+        ingestor.submit("new", decoder.decode('{"speed": 1500, "running": true}'))
+        self.assertEqual(ingestor.flush(), 0)
+        self.assertEqual(decoder.decode('{"speed": 1500, "running": true}'), {})
+        recorder.flush()
+        self.assertEqual(ingestor.flush(), 1)
+        installation = Installation.objects.get(imei="new")
+        self.assertEqual((installation.speed, installation.running), (1500, True))
+
+        # A new RPi disconnects before its Installation is created
+        session = recorder.connect("other", ("127.0.0.1", 2))
+        ingestor.submit("other", {"speed": 1200})
+        self.assertEqual(ingestor.flush(), 0)
+        recorder.disconnect(session, "other")
+        with mock.patch("server.sessions.get_ingestor", return_value=ingestor):
+            recorder.flush()
+        self.assertEqual(Installation.objects.get(imei="other").speed, 1200)
+        self.assertEqual(ingestor.pending, {})
+
+    def test_commands(self):
+        client = AsyncConnectedClient(None, None, None)
+        client.id = f"{0:015d}"
+        with self.assertNumQueries(1):
+            commands = client.get_commands(10)
+        self.assertEqual(len(commands), 3)
+
+    def test_delete_commands(self):
+        client = AsyncConnectedClient(None, None, None)
+        client.id = f"{0:015d}"
+        Command.objects.bulk_create([Command(imei=client.id, command_string="RUN") for _ in range(FLEET_SIZE)])
+        # The DELETE, then whether commands are still queued, whatever
+        # their number
+        for count in (1, FLEET_SIZE):
+            ids = list(Command.objects.filter(imei=client.id).values_list("id", flat=True)[:count])
+            with self.assertNumQueries(2):
+                client.delete_commands(ids)
+        self.assertEqual(Command.objects.filter(imei=client.id).count(), 2)
+
+        # The commands acknowledged by a pushing RPi
+        client = ConnectedClient.__new__(ConnectedClient)
+        client.id, client.Command, client.logger = f"{1:015d}", Command, client_logger(f"{1:015d}")
+        client.sent_commands = {command.id: command.created for command in Command.objects.filter(imei=client.id)}
+        client.acknowledged = set(client.sent_commands)
+        with self.assertNumQueries(2):
+            client.delete_acknowledged_commands()
+        self.assertFalse(Command.objects.filter(imei=client.id).exists())
+
+    def test_telemetry_flush(self):
+        ingestor = TelemetryIngestor()
+        for i in range(FLEET_SIZE):
+            ingestor.submit(f"{i:015d}", {"speed": i, "outlet_pressure": 2})
+        # The primary keys, one UPDATE for each distinct set of
+        # changed fields, and one INSERT for the Readings
+        with self.assertNumQueries(3):
+            self.assertEqual(ingestor.flush(), FLEET_SIZE)
+        for i in range(FLEET_SIZE):
+            ingestor.submit(f"{i:015d}", {"speed": i + 1})
+        # The primary keys are cached
+        with self.assertNumQueries(2):
+            self.assertEqual(ingestor.flush(), FLEET_SIZE)
+
+    def test_telemetry_invalid(self):
+        ingestor = TelemetryIngestor()
+        ingestor.submit(f"{0:015d}", {"speed": "fast", "running": True})
+        ingestor.submit(f"{1:015d}", {"speed": "1600", "alarms": "37"})
+        # The invalid values are discarded, the others converted
+        self.assertEqual(ingestor.flush(), 2)
+        self.assertEqual(Installation.objects.get(imei=f"{0:015d}").speed, 0)
+        self.assertTrue(Installation.objects.get(imei=f"{0:015d}").running)
+        self.assertEqual(Installation.objects.get(imei=f"{1:015d}").speed, 1600)
+        self.assertEqual(ingestor.flush(), 0)
+
+
+@override_settings(SOCKET_SERVER_FEED_PORT=1, SOCKET_SERVER_NOTIFY_PORT=1)
+class ConnectionTest(TransactionTestCase):
+    """
+    The protocol of ConnectedClient, with a simulated RPi on the other
+    end of a socket pair. The RPi runs in its own thread, so the
+    Commands it creates are committed to be seen by the client.
+    """
+
+    IMEI = f"{0:015d}"
+
+    def connect(self, rpi, notifications=None, framed=True):
+        # Serves the simulated RPi until it closes the connection, and
+        # returns what it returned. A legacy RPi does not terminate its
+        # messages
+        server, client = socket.socketpair()
+        terminator = "\n" if framed else ""
+        result = []
+
+        def run():
+            try:
+                with client, client.makefile("r") as stream:
+                    result.append(rpi(stream, lambda message: client.sendall(f"{message}{terminator}".encode())))
+            except BaseException as e:
+                result.append(e)
+            finally:
+                connection.close()
+
+        thread = Thread(target=run)
+        thread.start()
+        ingestor, recorder = TelemetryIngestor(), SessionRecorder()
+        with mock.patch("server.connectedclient.get_ingestor", return_value=ingestor), \
+                mock.patch("server.sessions.get_ingestor", return_value=ingestor), \
+                mock.patch("server.connectedclient.get_recorder", return_value=recorder), server:
+            ConnectedClient(server, ("127.0.0.1", 1), notifications)
+        thread.join(5)
+        if isinstance(result[0], BaseException):
+            raise result[0]
+        return result[0]
+
+    def test_pipelined_commands(self):
+        commands = [Command.objects.create(imei=self.IMEI, command_string=f"SET {i}") for i in range(3)]
+        other = Command.objects.create(imei=f"{1:015d}", command_string="RUN")
+
+        def rpi(stream, send):
+            # Not terminated, as the framing is not known yet
+            self.assertEqual(stream.read(13), "ID_SUPPLICANT")
+            send(f"{self.IMEI};PIPELINE")
+            self.assertEqual(stream.readline(), "GET_INFO\n")
+            send('{"speed": 1500}')
+            first = [stream.readline() for _ in commands]
+            # Acknowledged out of order, the second one is not
+            send(f"OK {commands[2].id}")
+            send("ERROR")
+            send(f"OK {commands[0].id}")
+            self.assertEqual(stream.readline(), "GET_INFO\n")
+            send("NU")
+            second = stream.readline()
+            send("ERROR")
+            self.assertEqual(stream.readline(), "GET_INFO\n")
+            return first, second
+
+        first, second = self.connect(rpi)
+        # The commands are sent in the order they were queued, and the
+        # one not acknowledged is sent again
+        self.assertEqual(first, [f"CMD {command.id} SET {i}\n" for i, command in enumerate(commands)])
+        self.assertEqual(second, f"CMD {commands[1].id} SET 1\n")
+        self.assertEqual(list(Command.objects.values_list("id", flat=True)), [commands[1].id, other.id])
+        self.assertEqual(Installation.objects.get(imei=self.IMEI).speed, 1500)
+
+    def test_delta(self):
+        def rpi(stream, send):
+            self.assertEqual(stream.read(13), "ID_SUPPLICANT")
+            send(f"{self.IMEI};DELTA")
+            self.assertEqual(stream.readline(), "DELTA_OK\n")
+            self.assertEqual(stream.readline(), "GET_INFO\n")
+            send(encode_delta({"speed": 1500}))
+
+        self.connect(rpi)
+        self.assertEqual(Installation.objects.get(imei=self.IMEI).speed, 1500)
+
+    def test_delta_legacy(self):
+        def rpi(stream, send):
+            self.assertEqual(stream.read(13), "ID_SUPPLICANT")
+            send(f"{self.IMEI};DELTA")
+            # Not confirmed, as it could be read along with GET_INFO
+            self.assertEqual(stream.read(8), "GET_INFO")
+            send('{"speed": 1500}')
+
+        self.connect(rpi, framed=False)
+        self.assertEqual(Installation.objects.get(imei=self.IMEI).speed, 1500)
+
+    def test_push(self):
+        notifications, router = Pipe()
+
+        def rpi(stream, send):
+            self.assertEqual(stream.read(13), "ID_SUPPLICANT")
+            send(f"{self.IMEI};PUSH")
+            self.assertEqual(stream.readline(), f"PUSH_OK {ConnectedClient.HEARTBEAT_INTERVAL}\n")
+            # The process of the RPi is registered (see PipeRouter)
+            self.assertEqual(router.recv(), self.IMEI)
+            send('{"speed": 1500, "running": true}')
+            send("HB")
+            command = Command.objects.create(imei=self.IMEI, command_string="STOP")
+            router.send(self.IMEI)
+            # Pushed as soon as it is notified, not on the next check
+            # of the queue
+            start = time.monotonic()
+            self.assertEqual(stream.readline(), f"CMD {command.id} STOP\n")
+            elapsed = time.monotonic() - start
+            send(f"OK {command.id}")
+            send('{"running": false}')
+            return elapsed
+
+        elapsed = self.connect(rpi, notifications)
+        self.assertLess(elapsed, ConnectedClient.COMMAND_RECHECK_INTERVAL / 2)
+        self.assertFalse(Command.objects.exists())
+        installation = Installation.objects.get(imei=self.IMEI)
+        self.assertEqual((installation.speed, installation.running), (1500, False))
+
+
+@override_settings(SOCKET_SERVER_FEED_PORT=1, SOCKET_SERVER_NOTIFY_PORT=1)
+class PaginationTest(TestCase):
+    """
+    The keyset pagination of the installations, with ties in the sort
+    field and filters.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Installation.objects.bulk_create([Installation(imei=f"{i:015d}", online=i % 2 == 0, speed=i % 4,
+                                                       installation_code=f"code{i % 3}")
+                                          for i in range(FLEET_SIZE)])
+        Alarm.objects.bulk_create([Alarm(imei=f"{i:015d}", node=3, raised=timezone.now())
+                                   for i in range(0, FLEET_SIZE, 5)])
+        cls.user = User.objects.create_user("operator", password="operator")
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def pages(self, params, limit=4):
+        # The IMEIs of every page, following the "next" cursors
+        pages = []
+        query = dict(params, limit=limit)
+        while True:
+            response = self.client.get("/app/dashboard/installations/list", query)
+            self.assertEqual(response.status_code, 200)
+            pages.append([i["imei"] for i in response.json()["installations"]])
+            if response.json()["next"] is None:
+                return pages
+            query["after"] = response.json()["next"]
+
+    def test_keyset(self):
+        installations = list(Installation.objects.values("id", "imei", "speed", "online", "installation_code"))
+        alarms = set(Alarm.objects.values_list("imei", flat=True))
+        for params, selected, key in [
+            ({}, installations, lambda i: i["id"]),
+            ({"sort": "-id"}, installations, lambda i: -i["id"]),
+            ({"sort": "speed"}, installations, lambda i: (i["speed"], i["id"])),
+            ({"sort": "-speed"}, installations, lambda i: (-i["speed"], -i["id"])),
+            ({"sort": "speed", "online": "1"}, [i for i in installations if i["online"]],
+             lambda i: (i["speed"], i["id"])),
+            ({"sort": "-speed", "installation_code": "code1"},
+             [i for i in installations if i["installation_code"] == "code1"], lambda i: (-i["speed"], -i["id"])),
+            ({"sort": "speed", "has_alarms": "0"}, [i for i in installations if i["imei"] not in alarms],
+             lambda i: (i["speed"], i["id"])),
+        ]:
+            with self.subTest(params=params):
+                pages = self.pages(params)
+                # Every installation is on exactly one page, in order
+                self.assertEqual(sum(pages, []), [i["imei"] for i in sorted(selected, key=key)])
+                self.assertTrue(all(len(page) == 4 for page in pages[:-1]))
+
+    def test_invalid_parameters(self):
+        for params in ({"sort": "password"}, {"after": "not a cursor"}, {"limit": "x"}):
+            with self.subTest(params=params):
+                response = self.client.get("/app/dashboard/installations/list", params)
+                self.assertEqual(response.status_code, 400)
+
+    def test_first_page_link(self):
+        response = self.client.get("/app/dashboard/", {"limit": 4})
+        self.assertFalse(response.context["show_first_page_link"])
+        self.assertNotContains(response, "Prima pagina")
+        after = self.client.get("/app/dashboard/installations/list", {"limit": 4}).json()["next"]
+        response = self.client.get("/app/dashboard/", {"limit": 4, "after": after})
+        self.assertTrue(response.context["show_first_page_link"])
+        self.assertContains(response, "Prima pagina")
+
+
+class LiveStateTest(SimpleTestCase):
+    """
+    The LiveState kept by the UpdateFeed of the socket server.
+    """
+
+    def test_reload(self):
+        state = LiveState()
+        installations = [{"imei": "1", "online": True}, {"imei": "2", "online": False}]
+        self.assertEqual(state.load(installations, {"1"}, {}), 2)
+        version = state.snapshot()["version"]
+        # Only the entries that differ from the database are updated
+        self.assertEqual(state.load(installations, {"1"}, {}), 0)
+        state.update("2", {"online": True})
+        self.assertEqual(state.load(installations, set(), {"2": [3]}), 2)
+        self.assertEqual(state.snapshot(version)["installations"],
+                         [{"imei": "1", "online": True, "command_pending": False, "alarms": [], "last_seen": None,
+                           "version": 4},
+                          {"imei": "2", "online": False, "command_pending": False, "alarms": [3], "last_seen": None,
+                           "version": 5}])
+
+    def test_reload_deleted(self):
+        state = LiveState()
+        state.load([{"id": 1, "imei": "1"}, {"id": 2, "imei": "2"}], set(), {})
+        # A RPi whose Installation is not created yet
+        state.update("3", {"online": True}, seen=True)
+        # The Installation of "2" is deleted
+        self.assertEqual(state.load([{"id": 1, "imei": "1"}], set(), {}), 1)
+        self.assertEqual(sorted(state.entries), ["1", "3"])
+        self.assertEqual([entry["imei"] for entry in state.snapshot()["installations"]], ["1", "3"])
+
+    def test_invalid_datagram(self):
+        feed = UpdateFeed(port=1)
+        with self.assertLogs("server.feed", "ERROR"):
+            feed.handle_datagram(b"not json")
+        with self.assertLogs("server.feed", "ERROR"):
+            feed.handle_datagram(b'{"updates": [{"online": true}]}')
+        feed.handle_datagram(b'{"seen": false, "updates": [{"imei": "1", "online": true}]}')
+        self.assertTrue(feed.state.entries["1"]["online"])
+
+
+class AlarmBusTest(SimpleTestCase):
+    """
+    The deduplication and rate limiting of the alarm events.
+    """
+
+    def setUp(self):
+        self.delivered = []
+        self.bus = AlarmBus([self.delivered.append])
+
+    def publish(self, events, node=12):
+        self.bus.publish([{"imei": "1", "node": node, "event": event} for event in events])
+
+    def events(self):
+        return [(event["node"], event["event"], event["suppressed"]) for event in self.delivered]
+
+    @mock.patch("server.alarms.time.monotonic", return_value=0)
+    def test_duplicates(self, monotonic):
+        self.publish([RAISED, RAISED, RAISED])
+        self.publish([CLEARED])
+        self.assertEqual(self.events(), [(12, RAISED, 0), (12, CLEARED, 2)])
+        # A duplicate is never delivered later
+        monotonic.return_value = 1 / NODE_RATE
+        self.bus.tick()
+        self.assertEqual(len(self.delivered), 2)
+
+    @mock.patch("server.alarms.time.monotonic", return_value=0)
+    def test_flapping(self, monotonic):
+        events = [RAISED, CLEARED] * NODE_BURST
+        self.publish(events)
+        self.publish([RAISED], node=13)
+        self.assertEqual(self.events(), [(12, event, 0) for event in events[:NODE_BURST]] + [(13, RAISED, 0)])
+        del self.delivered[:]
+        # Only the latest event is delivered, once the bucket allows it
+        self.bus.tick()
+        self.assertEqual(self.delivered, [])
+        monotonic.return_value = 1 / NODE_RATE
+        self.bus.tick()
+        self.assertEqual(self.events(), [(12, events[-1], NODE_BURST)])
+        self.bus.tick()
+        self.assertEqual(len(self.delivered), 1)
+
+    @mock.patch("server.alarms.time.monotonic", return_value=0)
+    def test_flapping_back(self, monotonic):
+        # A node that went back to the state last delivered is not
+        # delivered, but its events are still counted
+        self.publish([RAISED, CLEARED] * NODE_BURST + [RAISED])
+        del self.delivered[:]
+        monotonic.return_value = 1 / NODE_RATE
+        self.bus.tick()
+        self.assertEqual(self.delivered, [])
+        self.publish([CLEARED])
+        self.assertEqual(self.events(), [(12, CLEARED, NODE_BURST + 1)])
+
+
+class MetricsTest(TestCase):
+    """
+    The metrics of the socket server, as exposed by /metrics.
+    """
+
+    def test_render(self):
+        recorder = metrics.MetricsRecorder()
+        # The upper bound of a bucket belongs to it, and the values
+        # above the last bound only to +Inf
+        for seconds in (0.0007, 0.5, 100):
+            recorder.observe(metrics.GET_INFO_SECONDS, seconds, ())
+        recorder.increment(metrics.RECEIVED_BYTES, 10, ("imei", 'a"b\\c\nd'))
+        samples = [[name, labels, value] for (name, labels), value in recorder.counters.items()]
+        samples += [[name, labels, value] for (name, labels), value in recorder.histograms.items()]
+        store = metrics.MetricsStore()
+        # The samples of two processes add up
+        store.add(json.loads(json.dumps(samples)))
+        store.add(json.loads(json.dumps(samples)))
+        lines = store.render().splitlines()
+
+        name = metrics.GET_INFO_SECONDS
+        self.assertIn(f"# TYPE {name} histogram", lines)
+        buckets = [line for line in lines if line.startswith(f"{name}_bucket")]
+        self.assertEqual(len(buckets), len(metrics.LATENCY_BUCKETS) + 1)
+        for bound, count in [("0.0005", 0), ("0.001", 2), ("0.25", 2), ("0.5", 4), ("60", 4), ("+Inf", 6)]:
+            self.assertIn(f'{name}_bucket{{le="{bound}"}} {count}', buckets)
+        self.assertIn(f"{name}_count 6", lines)
+        total = [line for line in lines if line.startswith(f"{name}_sum ")]
+        self.assertAlmostEqual(float(total[0].split()[1]), 2 * 100.5007)
+        self.assertIn(f'{metrics.RECEIVED_BYTES}{{imei="a\\"b\\\\c\\nd"}} 20', lines)
+
+    @mock.patch("app.views.get_metrics", return_value="# metrics\n")
+    def test_view(self, get_metrics):
+        with override_settings(METRICS_ALLOWED_ADDRESSES=["127.0.0.1"]):
+            response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        self.assertEqual(response.content, b"# metrics\n")
+        with override_settings(METRICS_ALLOWED_ADDRESSES=[]):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+        get_metrics.return_value = None
+        with override_settings(METRICS_ALLOWED_ADDRESSES=["127.0.0.1"]):
+            self.assertEqual(self.client.get("/metrics").status_code, 503)
+
+
+class LoggingTest(SimpleTestCase):
+    """
+    The sampling and the JSON format of the logs of the socket server.
+    """
+
+    def record(self, name, level=logging.INFO, message="GET_INFO sent to %s", exc_info=None):
+        return logging.LogRecord(name, level, __file__, 1, message, ("RPi",) if "%s" in message else None, exc_info)
+
+    def test_sampler(self):
+        sampler = ImeiSampler(rate=10)
+        imeis = [f"{i:015d}" for i in range(1000)]
+        kept = [imei for imei in imeis if sampler.filter(self.record(client_logger(imei).name))]
+        self.assertTrue(50 < len(kept) < 150)
+        # The same RPis are always kept, with all their records
+        self.assertEqual([imei for imei in imeis if sampler.filter(self.record(client_logger(imei).name))], kept)
+        dropped = next(imei for imei in imeis if imei not in kept)
+        self.assertFalse(sampler.filter(self.record(client_logger(dropped).name, logging.DEBUG)))
+        # Warnings and the records of the other loggers are never
+        # discarded
+        self.assertTrue(sampler.filter(self.record(client_logger(dropped).name, logging.WARNING)))
+        self.assertTrue(sampler.filter(self.record("server.feed")))
+        self.assertTrue(sampler.filter(self.record(client_logger().name)))
+        self.assertTrue(ImeiSampler().filter(self.record(client_logger(dropped).name)))
+
+    def test_json_formatter(self):
+        formatter = JsonFormatter()
+        entry = json.loads(formatter.format(self.record(client_logger("123").name)))
+        self.assertEqual({key: entry[key] for key in ("level", "logger", "message", "imei")},
+                         {"level": "INFO", "logger": "server.client.123", "message": "GET_INFO sent to RPi",
+                          "imei": "123"})
+        self.assertNotIn("exception", entry)
+        try:
+            raise ValueError("invalid")
+        except ValueError:
+            record = self.record("server.feed", logging.ERROR, "Line\nbreak", sys.exc_info())
+        line = formatter.format(record)
+        # A record is always a single line
+        self.assertNotIn("\n", line)
+        entry = json.loads(line)
+        self.assertNotIn("imei", entry)
+        self.assertEqual(entry["message"], "Line\nbreak")
+        self.assertIn("ValueError: invalid", entry["exception"])
+
+
+class TelemetryDecoderTest(SimpleTestCase):
+    """
+    The encodings of the replies to GET_INFO.
+    """
+
+    def test_delta(self):
+        fields = {"inlet_pressure": 12, "start_code": "A1", "alarms": [3, 12], "speed": 1500,
+                  "anti_drip": False, "running": True}
+        decoder = TelemetryDecoder()
+        self.assertEqual(decoder.decode(encode_delta(fields)), fields)
+        # Only the fields that changed are returned
+        self.assertEqual(decoder.decode(encode_delta(dict(fields, speed=1600, alarms=[]))),
+                         {"speed": 1600, "alarms": []})
+        self.assertEqual(decoder.decode("D"), {})
+
+    def test_malformed_delta(self):
+        decoder = TelemetryDecoder()
+        for message in ("D-1=1", "D+9=1", "D15=1", "D=1", "D9", "D9=fast", "D14=2", "D8=1,x"):
+            with self.subTest(message=message), self.assertRaises(ValueError):
+                decoder.decode(message)
+        self.assertEqual(decoder.state, {})
+
+
+class TimerWheelTest(SimpleTestCase):
+    """
+    The deadlines of the HeartbeatMonitor.
+    """
+
+    def test_expire(self):
+        wheel = TimerWheel(0, tick=1, slots=4)
+        wheel.schedule("a", 2.5)
+        wheel.schedule("b", 3)
+        self.assertEqual(wheel.expire(2.4), [])
+        self.assertEqual(wheel.expire(2.5), ["a"])
+        self.assertEqual(wheel.expire(3.5), ["b"])
+        self.assertEqual(wheel.deadlines, {})
+
+    def test_cancel(self):
+        wheel = TimerWheel(0, tick=1, slots=4)
+        wheel.schedule("a", 1)
+        wheel.schedule("b", 2)
+        wheel.cancel("a")
+        wheel.cancel("c")
+        # A rescheduled key only expires at its new deadline
+        wheel.schedule("b", 3)
+        self.assertEqual(wheel.expire(2.5), [])
+        self.assertEqual(wheel.expire(3), ["b"])
+
+    def test_wrap(self):
+        wheel = TimerWheel(0, tick=1, slots=4)
+        # The three keys share a slot, a turn apart
+        for key, deadline in (("a", 2.5), ("b", 6.5), ("c", 10.5)):
+            wheel.schedule(key, deadline)
+        self.assertEqual(wheel.expire(3), ["a"])
+        self.assertEqual(wheel.expire(6), [])
+        self.assertEqual(wheel.expire(7), ["b"])
+        # Several turns elapsed since the last expire
+        wheel.schedule("d", 13)
+        self.assertEqual(sorted(wheel.expire(100)), ["c", "d"])
+        wheel.schedule("e", 101.5)
+        self.assertEqual(wheel.expire(102), ["e"])
+
+
+class PollSchedulerTest(SimpleTestCase):
+    """
+    The adaptive cadence of GET_INFO.
+    """
+
+    def test_active(self):
+        scheduler = PollScheduler()
+        self.assertEqual(scheduler.schedule({"running": True}, False), PollScheduler.ACTIVE_INTERVAL)
+        self.assertEqual(scheduler.schedule({"running": False, "alarms": [3]}, False), PollScheduler.ACTIVE_INTERVAL)
+        self.assertEqual(scheduler.schedule({"running": False, "alarms": []}, True), PollScheduler.IDLE_INTERVAL)
+
+    def test_backoff(self):
+        scheduler = PollScheduler()
+        intervals = [scheduler.schedule({"running": False}, False) for _ in range(8)]
+        self.assertEqual(intervals, [2, 4, 8, 16, 30, 30, 30, 30])
+        # New data, then the installation starts running
+        self.assertEqual(scheduler.schedule({"running": False}, True), PollScheduler.IDLE_INTERVAL)
+        scheduler.schedule({"running": False}, False)
+        self.assertEqual(scheduler.schedule({"running": True}, False), PollScheduler.ACTIVE_INTERVAL)
+        # Backing off starts again from IDLE_INTERVAL
+        self.assertEqual(scheduler.schedule({"running": False}, False), 2)
+
+    @mock.patch("server.cadence.time.monotonic", return_value=1000)
+    def test_watch(self, monotonic):
+        scheduler = PollScheduler()
+        for _ in range(8):
+            scheduler.schedule({}, False)
+        # Only the first notification interrupts the current wait
+        self.assertTrue(scheduler.watch())
+        self.assertFalse(scheduler.watch())
+        self.assertEqual(scheduler.schedule({}, False), PollScheduler.ACTIVE_INTERVAL)
+        # A notification extends the fastest rate for WATCH_TTL
+        monotonic.return_value += PollScheduler.WATCH_TTL - 1
+        self.assertFalse(scheduler.watch())
+        monotonic.return_value += PollScheduler.WATCH_TTL - 1
+        self.assertEqual(scheduler.schedule({}, False), PollScheduler.ACTIVE_INTERVAL)
+        monotonic.return_value += 1
+        self.assertEqual(scheduler.schedule({}, False), 2)
+        self.assertTrue(scheduler.watch())
+
+
+class WatchTest(SimpleTestCase):
+    """
+    The notifications of the installations shown on a dashboard.
+    """
+
+    def setUp(self):
+        notify.last_watch.clear()
+
+    @mock.patch("server.notify.notify_commands")
+    def test_notify_watching(self, notify_commands):
+        # A dashboard showing the whole fleet does not watch it
+        notify.notify_watching(None)
+        notify.notify_watching({str(i) for i in range(notify.MAX_WATCHED + 1)})
+        notify_commands.assert_not_called()
+        notify.notify_watching(["1", "2"])
+        notify_commands.assert_called_once_with(["WATCH 1", "WATCH 2"])
+        # Every installation is notified once every WATCH_INTERVAL
+        notify.notify_watching(["2", "3"])
+        notify_commands.assert_called_with(["WATCH 3"])
+        self.assertEqual([notify.parse_watch(message) for message in notify_commands.call_args[0][0]], ["3"])
+        self.assertIsNone(notify.parse_watch("3"))
+
+    @mock.patch("server.notify.notify_commands")
+    def test_notify_watching_threads(self, notify_commands):
+        from concurrent.futures import ThreadPoolExecutor
+
+        # The call count of a mock is not thread safe, appending is
+        sent = []
+        notify_commands.side_effect = sent.append
+        # Concurrent requests of dashboards showing different pages
+        with mock.patch("server.notify.WATCH_INTERVAL", 0), ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda page: [notify.notify_watching([f"{page}-{i}" for i in range(50)])
+                                            for _ in range(200)], range(8)))
+        self.assertEqual(len(sent), 8 * 200)
+
+    def test_notifier_backlog(self):
+        dispatched = []
+        notifier = notify.CommandNotifier(dispatched.append, port=0, rate=1)
+        with mock.patch("socket.socket") as socket:
+            socket.return_value.__enter__.return_value.recvfrom.side_effect = [
+                (b"1\n2\n3", None), (b"4", None), (b"WATCH 5\nWATCH 6", None), InterruptedError()]
+            with self.assertRaises(InterruptedError):
+                notifier.run()
+        # The notifications for many RPis wait in the backlog, the
+        # others are dispatched immediately
+        self.assertEqual([imei for imei in dispatched if imei != "1"], ["4", "WATCH 5", "WATCH 6"])
+
+    def test_pipe_router(self):
+        router = notify.PipeRouter()
+        router.start()
+        children = []
+        for imei in ("1", "2"):
+            child, parent = Pipe()
+            router.add(parent)
+            child.send(imei)
+            children.append(child)
+        # Every process is notified as soon as its IMEI is registered,
+        # so that it checks the Commands saved in the meantime
+        for imei, child in zip(("1", "2"), children):
+            self.assertTrue(child.poll(0.5))
+            self.assertEqual(child.recv(), imei)
+        deadline = time.monotonic() + 5
+        # Every notification is only sent to the process of its RPi
+        for message in ("1", "WATCH 2", "3"):
+            router(message)
+        self.assertEqual(children[0].recv(), "1")
+        self.assertEqual(children[1].recv(), "WATCH 2")
+        self.assertFalse(children[0].poll(0.1) or children[1].poll(0))
+        # The Pipe of a terminated process is discarded
+        children[0].close()
+        while "1" in router.owners and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(list(router.owners), ["2"])
+        children[1].close()
+
+
+class HistoryTest(TestCase):
+    """
+    The history of the telemetry, read from the ReadingRollups when
+    possible.
+    """
+
+    def test_history(self):
+        readings = [Reading(imei="1", ts=ts, speed=ts % 7, running=ts % 3 == 0) for ts in range(6000, 9000, 7)]
+        Reading.objects.bulk_create(readings)
+        ingestor = TelemetryIngestor()
+        ingestor.roll_up(readings)
+        # The last minutes are not rolled up yet
+        ingestor.write_rollups(before=8400)
+        self.assertTrue(ReadingRollup.objects.exists())
+        for field, start, end, bucket in [("speed", 6030, 8990, 600), ("running", 0, 10000, 120),
+                                          ("speed", 6000, 9000, 100)]:
+            expected = [{key: row[key] for key in ("bucket", "min", "max", "avg")}
+                        for row in Reading.objects.between("1", start, end).downsample(field, bucket)]
+            with mock.patch("app.models.time.time", return_value=8500):
+                history = Reading.objects.history("1", field, start, end, bucket)
+            self.assertEqual([dict(row, avg=round(row["avg"], 6)) for row in history],
+                             [dict(row, min=int(row["min"]), max=int(row["max"]), avg=round(row["avg"], 6))
+                              for row in expected])
+
+    def test_missing_rollups(self):
+        readings = [Reading(imei="1", ts=ts, speed=ts % 11) for ts in range(6000, 9000, 7)]
+        Reading.objects.bulk_create(readings)
+        ingestor = TelemetryIngestor()
+        ingestor.roll_up(readings)
+        ingestor.write_rollups()
+        # The rollups of some minutes were never written, e.g. as the
+        # socket server was stopped
+        ReadingRollup.objects.filter(minute__in=[6600, 7200, 7260]).delete()
+        expected = [(row["bucket"], row["min"], row["max"], round(row["avg"], 6))
+                    for row in Reading.objects.between("1", 6000, 9000).downsample("speed", 300)]
+        with mock.patch("app.models.time.time", return_value=10000):
+            history = Reading.objects.history("1", "speed", 6000, 9000, 300)
+        self.assertEqual([(row["bucket"], row["min"], row["max"], round(row["avg"], 6)) for row in history],
+                         expected)
+
+    def test_shutdown(self):
+        ingestor = TelemetryIngestor()
+        ingestor.primary_keys["1"] = Installation.objects.create(imei="1").id
+        ingestor.submit("1", {"speed": 1500})
+        # The pending telemetry and the rollups of the minute in
+        # progress are written when the process stops
+        with mock.patch("server.telemetry._ingestor", ingestor):
+            sessions.shutdown()
+        self.assertEqual(Installation.objects.get(imei="1").speed, 1500)
+        self.assertEqual(ReadingRollup.objects.get(imei="1", field="speed").max, 1500)
+
+
+class AlarmTest(TestCase):
+    """
+    The Alarms raised and cleared by the socket server.
+    """
+
+    @mock.patch("server.telemetry.publish_alarm_events")
+    def test_write_alarms(self, publish_alarm_events):
+        ingestor = TelemetryIngestor()
+        ingestor.write_alarms({"1": [3, 7], "2": []})
+        self.assertEqual(Alarm.objects.active().nodes_by_imei(), {"1": [3, 7]})
+        self.assertEqual([(event["imei"], event["node"], event["event"])
+                          for event in publish_alarm_events.call_args[0][0]], [("1", 3, RAISED), ("1", 7, RAISED)])
+
+        # An unchanged list neither writes nor publishes anything
+        publish_alarm_events.reset_mock()
+        with self.assertNumQueries(1):
+            ingestor.write_alarms({"1": [7, 3]})
+        publish_alarm_events.assert_not_called()
+
+        ingestor.write_alarms({"1": [7, 9]})
+        self.assertEqual(Alarm.objects.active().nodes_by_imei(), {"1": [7, 9]})
+        self.assertEqual(list(Alarm.objects.filter(cleared__isnull=False).values_list("imei", "node")), [("1", 3)])
+        self.assertEqual([(event["imei"], event["node"], event["event"])
+                          for event in publish_alarm_events.call_args[0][0]], [("1", 9, RAISED), ("1", 3, CLEARED)])
+
+        # The cached alarms of the IMEI spare the query of the active
+        # ones
+        ingestor.last_values["1"] = {"alarms": [7, 9]}
+        ingestor.write_alarms({"1": []})
+        self.assertEqual(Alarm.objects.active().nodes_by_imei(), {})
+        self.assertEqual(Alarm.objects.filter(cleared__isnull=False).count(), 3)
+
+
+class MessageBufferTest(SimpleTestCase):
+    """
+    The framing of the messages of the RPis.
+    """
+
+    def test_split_reply(self):
+        buffer = MessageBuffer()
+        # The framing is only known once the delimiter is received
+        buffer.feed(b"1234567890")
+        self.assertTrue(buffer.settling)
+        self.assertIsNone(buffer.next_message())
+        buffer.feed(b"12345;DELTA\nGET")
+        self.assertEqual(buffer.next_message(), "123456789012345;DELTA")
+        self.assertTrue(buffer.framed)
+        self.assertIsNone(buffer.next_message())
+
+    def test_legacy(self):
+        buffer = MessageBuffer()
+        buffer.feed(b"1234567890")
+        buffer.feed(b"12345")
+        buffer.settle()
+        self.assertEqual(buffer.next_message(), "123456789012345")
+        self.assertFalse(buffer.framed)
+        self.assertEqual(buffer.encode("GET_INFO"), b"GET_INFO")
+
+    def test_growth(self):
+        buffer = MessageBuffer(size=16, max_size=64)
+        buffer.feed(b"x" * 40 + b"\n")
+        self.assertEqual(len(buffer.buffer), 64)
+        self.assertEqual(buffer.next_message(), "x" * 40)
+        # The buffer shrinks back once the message is consumed
+        self.assertEqual(len(buffer.buffer), 16)
+        with self.assertRaises(ConnectionError):
+            buffer.feed(b"x" * 65)
@@ -7,8 +7,14 @@ urlpatterns = [
     path('dashboard/installations/toggle', views.toggle_installation, name='toggle_installation'),
     path('dashboard/installations/reset_time_limit', views.reset_time_limit, name='reset_time_limit'),
     path('dashboard/installations/update_data', views.update_data, name='update_data'),
+    path('dashboard/installations/list', views.installation_list, name='installation_list'),
     path('dashboard/installations/command_pending', views.command_pending, name='command_pending'),
     path('dashboard/installations/set_pressure_target', views.set_pressure_target, name='set_pressure_target'),
+    path('dashboard/installations/stream', views.stream_updates, name='stream_updates'),
+    path('dashboard/installations/history', views.installation_history, name='installation_history'),
+    path('dashboard/installations/dispatch', views.dispatch_fleet, name='dispatch_fleet'),
+    path('dashboard/installations/dispatch_status', views.dispatch_status, name='dispatch_status'),
+    path('alarms/webhook', views.alarm_webhook, name='alarm_webhook'),
     path('', include('django.contrib.auth.urls')),
 ]
 
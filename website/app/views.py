@@ -1,30 +1,178 @@
 from django.core.exceptions import ValidationError
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.core.validators import validate_integer
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.csrf import csrf_exempt
+from django.db import transaction
+from django.db.models import Count
 import json
-from django.core import serializers
-from .models import Installation, Command
+import base64
+import hashlib
+import logging
+from .models import Installation, Command, Reading, FleetDispatch, Alarm
+from server.notify import notify_command, notify_commands, notify_watching
+from server.feed import subscribe, publish_updates
+from server.livestate import get_live_state
+from server.metrics import get_metrics
 
 
-def parse_alarms(installations):
-    # Parse the alarms dictionary for every installation,
-    # and just give an output string. This will make the
-    # dashboard.html template much easier to understand
-    alarms_strings = {}
+# Maximum number of commands waiting to be sent to an installation
+MAX_QUEUED_COMMANDS = 10
+
+# The commands that can be sent to the whole fleet, and the command
+# string sent to the installations
+FLEET_COMMANDS = {
+    'run': 'RUN',
+    'stop': 'STOP',
+    'reset_time_limit': 'RESET_TL',
+    'reset_backup': 'RESET_BK',
+    'reset_whatever': 'RESET_RB',
+}
+
+# Installations on a page of the dashboard, and maximum number of
+# installations returned at once by installation_list
+PAGE_SIZE = 12
+MAX_PAGE_SIZE = 100
+
+# The labels of the sort fields (see Installation.SORT_FIELDS) shown
+# on the dashboard
+SORT_LABELS = {
+    'id': 'Numero impianto',
+    'imei': 'IMEI',
+    'installation_code': 'Codice impianto',
+    'outlet_pressure': 'Pressione in uscita',
+    'speed': 'Velocità',
+    'working_hours_counter': 'Ore di funzionamento',
+}
+
+
+def alarms_string(alarms):
+    # Turn the list of the IDs of the nodes in an alarm state
+    # into the string shown on the dashboard
+    if not alarms:
+        return "NESSUNO"
+    return ", ".join(f"#{alarm_id}" for alarm_id in alarms)
+
+
+def queue_full(imei):
+    # Whether MAX_QUEUED_COMMANDS commands are already queued for the
+    # installation. The query stops at the last allowed command,
+    # instead of counting the whole queue
+    return Command.objects.filter(imei=imei)[MAX_QUEUED_COMMANDS - 1:].exists()
+
+
+def queue_command(imei, command_string):
+    # Save the command and let the socket server send it
+    # right away
+    c = Command(imei=imei, command_string=command_string)
+    c.save()
+    notify_command(imei)
+
+
+def fleet_recipients(request):
+    # The IMEIs of the installations selected by the filters of a
+    # fleet dispatch: a comma separated list of IMEIs, an installation
+    # code and/or only the installations that are online
+    installations = Installation.objects.all()
+    imeis = request.POST.get("imeis", '')
+    if imeis:
+        installations = installations.filter(imei__in=[imei.strip() for imei in imeis.split(',')])
+    installation_code = request.POST.get("installation_code", '')
+    if installation_code:
+        installations = installations.filter(installation_code=installation_code)
+    if request.POST.get("online", '') == "1":
+        installations = installations.filter(online=True)
+    return list(installations.values_list('imei', flat=True))
+
+
+def encode_cursor(installation, sort):
+    # The position of the next page, after the given installation:
+    # its sort value and its id, as an opaque string
+    position = [installation[sort.lstrip('-')], installation['id']]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError if the cursor was not made by encode_cursor
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(pk, int):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return value, pk
+
+
+def parse_flag(value):
+    # "1" and "0" select the installations where a flag is true or
+    # false, anything else does not filter them
+    return {'1': True, '0': False}.get(value)
+
+
+def installation_page(params):
+    # Reads a page of the installations, selected by the filters and
+    # sorted as in the given query parameters (see installation_list),
+    # with one query for the installations, one for their pending
+    # commands and one for their alarms. Returns the installations and
+    # the cursor of the next page, or None if this is the last one.
+    # Raises ValueError if the parameters are invalid
+    sort = params.get('sort', 'id') or 'id'
+    if sort.lstrip('-') not in Installation.SORT_FIELDS:
+        raise ValueError(f"Invalid sort field {sort}")
+    size = min(max(int(params.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    after = params.get('after', '')
+    last = decode_cursor(after) if after else None
+
+    installations = Installation.objects.all()
+    for flag in ('online', 'running'):
+        value = parse_flag(params.get(flag, ''))
+        if value is not None:
+            installations = installations.filter(**{flag: value})
+    installation_code = params.get('installation_code', '')
+    if installation_code:
+        installations = installations.filter(installation_code=installation_code)
+    has_alarms = parse_flag(params.get('has_alarms', ''))
+    if has_alarms is not None:
+        installations = installations.with_alarms(has_alarms)
+    # One more installation tells whether there is a next page
+    installations = list(installations.keyset(sort, last).values(*Installation.SNAPSHOT_FIELDS)[:size + 1])
+    next_cursor = encode_cursor(installations[size - 1], sort) if len(installations) > size else None
+    installations = installations[:size]
+
+    imeis = [i['imei'] for i in installations]
+    pending = set(Command.objects.filter(imei__in=imeis).values_list('imei', flat=True))
+    alarms = Alarm.objects.active().filter(imei__in=imeis).nodes_by_imei()
     for i in installations:
-        alarms = json.loads(i.alarms)
-        counter = 0
-        alarms_strings[i.id] = ""
-        for alarm_id in alarms:
-            counter += 1
-            if counter != 1:
-                alarms_strings[i.id] += ", "
-            alarms_strings[i.id] += f"#{alarm_id}"
-        if counter == 0:
-            alarms_strings[i.id] += "NESSUNO"
-    return alarms_strings
+        i['command_pending'] = i['imei'] in pending
+        i['alarms'] = alarms.get(i['imei'], [])
+    return installations, next_cursor
+
+
+def visible_imeis(value):
+    # The IMEIs of the installations shown by a dashboard, as a comma
+    # separated list, or None if it shows all of them
+    if not value:
+        return None
+    return {imei.strip() for imei in value.split(',')}
+
+
+def live_installations(since=''):
+    # Read the installations changed since the given version from the
+    # live state kept by the socket server (see server.livestate).
+    # Returns the new version and the installations, or None if the
+    # socket server is not available
+    state = get_live_state(since)
+    if state is None:
+        return None
+    installations = []
+    for entry in state['installations']:
+        # Only installations that exist in the database are shown
+        if 'id' in entry:
+            installations.append({key: value for key, value in entry.items() if key != 'version'})
+    installations.sort(key=lambda i: i['id'])
+    return state['version'], installations
 
 
 @login_required
@@ -32,15 +180,30 @@ def dashboard(request):
     if not request.user.is_authenticated:
         return redirect('login')
 
-    # Loads the list of installations
-    installations = Installation.objects.all()
-    alarms_strings = parse_alarms(installations)
+    # Loads a single page of installations, selected and sorted by
+    # the filters of the dashboard (see installation_page): the
+    # browser only polls and receives the updates of this page
+    try:
+        installations, next_cursor = installation_page(request.GET)
+    except ValueError:
+        return redirect('dashboard')
+    alarms_strings = {i['id']: alarms_string(i['alarms']) for i in installations}
+
+    next_page = None
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query['after'] = next_cursor
+        next_page = query.urlencode()
 
     # TODO pending commands block further actions on the same installations
     context = {
         'installations': installations,
         'alarms_strings': alarms_strings,
-        'installations_count': installations.count(),
+        'installations_count': len(installations),
+        'filters': request.GET,
+        'sort_choices': [(field, label) for field, label in SORT_LABELS.items()],
+        'next_page': next_page,
+        'show_first_page_link': 'after' in request.GET,
     }
 
     return render(request, 'dashboard.html', context=context)
@@ -51,17 +214,14 @@ def toggle_installation(request):
     if request.user.is_authenticated and request.method == "POST":
         imei = request.POST.get("imei", '')
         command = request.POST.get("command", '')
-        command_queue = Command.objects.filter(imei=imei)
-        if command_queue.count() >= 1:
-            return HttpResponse('There already is a command being executed for this installation.')
+        if queue_full(imei):
+            return HttpResponse('There already are too many commands queued for this installation.')
         if command == "run":
-            c = Command(imei=imei, command_string="RUN")
-            c.save()
+            queue_command(imei, "RUN")
             print("RUN command sent to installation with imei {}".format(imei))
             return HttpResponse('success')
         elif command == "stop":
-            c = Command(imei=imei, command_string="STOP")
-            c.save()
+            queue_command(imei, "STOP")
             print("STOP command sent to installation with imei {}".format(imei))
             return HttpResponse('success')
         else:
@@ -77,20 +237,16 @@ def reset_time_limit(request):
             imei = request.POST.get("imei", '')
             code = request.POST.get("code", '')
             field_type = request.POST.get("field_type", '')
-            command_queue = Command.objects.filter(imei=imei)
-            if command_queue.count() >= 1:
-                return HttpResponse('There already is a command being executed for this installation.')
+            if queue_full(imei):
+                return HttpResponse('There already are too many commands queued for this installation.')
             if field_type == "tl" and code == "reset_time_limit":
-                c = Command(imei=imei, command_string="RESET_TL")
-                c.save()
+                queue_command(imei, "RESET_TL")
                 return HttpResponse('success')
             elif field_type == "bk" and code == "reset_backup":
-                c = Command(imei=imei, command_string="RESET_BK")
-                c.save()
+                queue_command(imei, "RESET_BK")
                 return HttpResponse('success')
             elif field_type == "rb" and code == "reset_whatever":
-                c = Command(imei=imei, command_string="RESET_RB")
-                c.save()
+                queue_command(imei, "RESET_RB")
                 return HttpResponse('success')
             else:
                 return HttpResponse('Invalid command')
@@ -104,13 +260,11 @@ def set_pressure_target(request):
         if request.user.groups.filter(name="admin").exists():
             imei = request.POST.get("imei", '')
             pressure_target = request.POST.get("pressure_target", '')
-            command_queue = Command.objects.filter(imei=imei)
-            if command_queue.count() >= 1:
-                return HttpResponse('There already is a command being executed for this installation.')
+            if queue_full(imei):
+                return HttpResponse('There already are too many commands queued for this installation.')
             try:
                 validate_integer(pressure_target)
-                c = Command(imei=imei, command_string=f"SET_PRESSURE_TARGET: {pressure_target}")
-                c.save()
+                queue_command(imei, f"SET_PRESSURE_TARGET: {pressure_target}")
                 return HttpResponse('success')
             except ValidationError:
                 return HttpResponse('There is already a command pending for the device');
@@ -122,17 +276,72 @@ def set_pressure_target(request):
 def update_data(request):
     # Authentication is required to send a command
     if request.user.is_authenticated and request.method == "POST":
-        installations = Installation.objects.all()
-        alarms_strings = parse_alarms(installations)
+        # The client sends back the version of the last snapshot it
+        # received: if nothing changed, the snapshot is not sent again
+        since = request.POST.get("since", request.META.get("HTTP_IF_NONE_MATCH", '')).strip('"')
+        # Only the installations shown by the dashboard are sent
+        imeis = visible_imeis(request.POST.get("imeis", ''))
+        # While the dashboard is open the installations it shows are
+        # polled at their fastest rate
+        notify_watching(imeis)
+        live = live_installations(since)
+        if live is not None:
+            # Only the installations changed since the given version
+            version, installations = live
+            if imeis is not None:
+                installations = [i for i in installations if i['imei'] in imeis]
+            if not installations and version == since:
+                return HttpResponseNotModified()
+        else:
+            # One query for the installations, one for the pending
+            # commands and one for the alarms, whatever the number of
+            # installations
+            installations = Installation.objects.all()
+            commands = Command.objects.all()
+            alarms = Alarm.objects.active()
+            if imeis is not None:
+                installations = installations.filter(imei__in=imeis)
+                commands = commands.filter(imei__in=imeis)
+                alarms = alarms.filter(imei__in=imeis)
+            pending = set(commands.values_list('imei', flat=True))
+            alarms = alarms.nodes_by_imei()
+            installations = list(installations.values(*Installation.SNAPSHOT_FIELDS))
+            for i in installations:
+                i['command_pending'] = i['imei'] in pending
+                i['alarms'] = alarms.get(i['imei'], [])
         for i in installations:
-            i.alarms = alarms_strings[i.id]
-            command_queue = Command.objects.filter(imei=i.imei)
-            if command_queue.count() >= 1:
-                i.command_pending = True
-            else:
-                i.command_pending = False
-        installations_json = serializers.serialize("json", installations)
-        return HttpResponse(installations_json, content_type='application/json')
+            i['alarms'] = alarms_string(i['alarms'])
+        installations_json = json.dumps(installations, separators=(',', ':'))
+        if live is None:
+            version = hashlib.md5(installations_json.encode()).hexdigest()
+            if since == version:
+                return HttpResponseNotModified()
+        response = HttpResponse(installations_json, content_type='application/json')
+        response['ETag'] = f'"{version}"'
+        return response
+
+
+@login_required
+def installation_list(request):
+    # Returns a page of the installations, as JSON. The parameters are
+    # all optional:
+    # - online, running, has_alarms: "1" or "0" to only return the
+    #   installations where they are true or false
+    # - installation_code: to only return the installations with it
+    # - sort: one of Installation.SORT_FIELDS, prefixed by "-" for a
+    #   descending order (by default, "id")
+    # - limit: the size of the page (at most MAX_PAGE_SIZE)
+    # - after: the "next" cursor returned with the previous page
+    # The pages are read with keyset pagination (see
+    # InstallationQuerySet.keyset), so every page costs the same
+    # whatever its position in the list
+    try:
+        installations, next_cursor = installation_page(request.GET)
+    except ValueError:
+        return HttpResponse('Invalid parameters', status=400)
+    for i in installations:
+        i['alarms'] = alarms_string(i['alarms'])
+    return JsonResponse({'installations': installations, 'next': next_cursor})
 
 
 @login_required
@@ -140,10 +349,162 @@ def command_pending(request):
     if request.user.is_authenticated and request.method == "POST":
         imei = request.POST.get("imei", '')
         response = {}
-        command_queue = Command.objects.filter(imei=imei)
-        if command_queue.count() >= 1:
-            response["command_pending"] = True
+        state = get_live_state(imei=imei)
+        if state is not None:
+            entries = state['installations']
+            response["command_pending"] = bool(entries) and entries[0]['command_pending']
         else:
-            response["command_pending"] = False
+            response["command_pending"] = Command.objects.filter(imei=imei).exists()
         response_json = json.dumps(response)
         return HttpResponse(response_json, content_type='application/json')
+
+
+@login_required
+def installation_history(request):
+    # Returns the history of a telemetry field of an installation,
+    # aggregated in buckets of "bucket" seconds, between the UNIX
+    # timestamps "start" and "end"
+    imei = request.GET.get("imei", '')
+    field = request.GET.get("field", '')
+    if field not in Reading.FIELDS:
+        return HttpResponse('Invalid field', status=400)
+    try:
+        start = int(request.GET.get("start", 0))
+        end = int(request.GET.get("end", 2 ** 31 - 1))
+        bucket = max(int(request.GET.get("bucket", 60)), 1)
+    except ValueError:
+        return HttpResponse('Invalid range', status=400)
+    buckets = Reading.objects.history(imei, field, start, end, bucket)
+    return JsonResponse({'imei': imei, 'field': field, 'bucket': bucket, 'data': buckets})
+
+
+@login_required
+def stream_updates(request):
+    # Server-Sent Events stream of the changes of the installations,
+    # as published by the socket server (see server.feed). Every
+    # event is a list of objects with the imei of an installation
+    # and the fields that changed, except for the alarm events
+    # (see server.alarms), which are sent as "alarm" events. Only the
+    # installations shown by the dashboard are sent
+    imeis = visible_imeis(request.GET.get("imeis", ''))
+
+    def events():
+        yield "retry: 2000\n\n"
+        # While the dashboard is open the installations it shows are
+        # polled at their fastest rate
+        notify_watching(imeis)
+        try:
+            for updates in subscribe(settings.SOCKET_SERVER_FEED_PORT, timeout=15):
+                notify_watching(imeis)
+                if updates is None:
+                    # Keep-alive, to detect closed browsers
+                    yield ": keep-alive\n\n"
+                    continue
+                updates = json.loads(updates)
+                if isinstance(updates, dict):
+                    if imeis is None or updates['alarm']['imei'] in imeis:
+                        yield f"event: alarm\ndata: {json.dumps(updates['alarm'])}\n\n"
+                    continue
+                if imeis is not None:
+                    updates = [update for update in updates if update['imei'] in imeis]
+                    if not updates:
+                        continue
+                for update in updates:
+                    if "alarms" in update:
+                        update["alarms"] = alarms_string(update["alarms"])
+                yield f"data: {json.dumps(updates)}\n\n"
+        except OSError:
+            # The feed is not available: the dashboard falls back to polling
+            return
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@login_required
+def dispatch_fleet(request):
+    # Sends the same command to every installation selected by the
+    # filters (see fleet_recipients), with a single insert. The
+    # installations are woken up gradually by the socket server (see
+    # server.notify.CommandNotifier), and the progress of the dispatch
+    # can be followed with dispatch_status
+    if request.method != "POST":
+        return HttpResponse('Invalid request', status=405)
+    if not request.user.groups.filter(name="admin").exists():
+        return HttpResponse('Insufficient permissions', status=403)
+    command = request.POST.get("command", '')
+    if command == "set_pressure_target":
+        pressure_target = request.POST.get("pressure_target", '')
+        try:
+            validate_integer(pressure_target)
+        except ValidationError:
+            return HttpResponse('Invalid pressure target', status=400)
+        command_string = f"SET_PRESSURE_TARGET: {pressure_target}"
+    elif command in FLEET_COMMANDS:
+        command_string = FLEET_COMMANDS[command]
+    else:
+        return HttpResponse('Invalid command', status=400)
+
+    imeis = fleet_recipients(request)
+    # Installations with a full queue are skipped, with one query
+    full = set(Command.objects.filter(imei__in=imeis).values('imei').annotate(queued=Count('id'))
+               .filter(queued__gte=MAX_QUEUED_COMMANDS).values_list('imei', flat=True))
+    recipients = [imei for imei in imeis if imei not in full]
+    with transaction.atomic():
+        dispatch = FleetDispatch.objects.create(command_string=command_string, total=len(recipients))
+        Command.objects.bulk_create([Command(imei=imei, command_string=command_string, dispatch=dispatch)
+                                     for imei in recipients])
+    # bulk_create does not send the post_save signals
+    publish_updates([{'imei': imei, 'command_pending': True} for imei in recipients])
+    notify_commands(recipients)
+    return JsonResponse({'dispatch': dispatch.id, 'total': len(recipients), 'skipped': sorted(full)})
+
+
+@login_required
+def dispatch_status(request):
+    # The progress of a fleet dispatch: a command is deleted as soon
+    # as the installation executes it, so the ones left are pending
+    try:
+        dispatch = FleetDispatch.objects.get(id=request.GET.get("dispatch", ''))
+    except (FleetDispatch.DoesNotExist, ValueError):
+        return HttpResponse('Invalid dispatch', status=404)
+    pending = list(Command.objects.filter(dispatch=dispatch).values_list('imei', flat=True))
+    return JsonResponse({
+        'dispatch': dispatch.id,
+        'command': dispatch.command_string,
+        'total': dispatch.total,
+        'completed': dispatch.total - len(pending),
+        'pending': pending,
+    })
+
+
+def metrics(request):
+    # The metrics of the socket server, in the Prometheus text format
+    # (see server.metrics). Scrapers connect from the addresses in
+    # METRICS_ALLOWED_ADDRESSES without logging in, anybody else must
+    # be an admin
+    allowed = request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_ADDRESSES', [])
+    if not allowed and not (request.user.is_authenticated and request.user.groups.filter(name="admin").exists()):
+        return HttpResponse('Insufficient permissions', status=403)
+    text = get_metrics()
+    if text is None:
+        return HttpResponse('Socket server not available', status=503)
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@csrf_exempt
+def alarm_webhook(request):
+    # A local stand-in for the endpoint of the alarm webhook (see
+    # server.alarms.WebhookSubscriber and settings.ALARM_WEBHOOK_URL),
+    # which only logs the events it receives
+    if request.method != "POST":
+        return HttpResponse('Invalid request', status=405)
+    if request.META.get('REMOTE_ADDR') not in ('127.0.0.1', '::1'):
+        return HttpResponse('Insufficient permissions', status=403)
+    try:
+        event = json.loads(request.body)
+    except ValueError:
+        return HttpResponse('Invalid event', status=400)
+    logging.getLogger(__name__).info(f"Alarm webhook received {event}")
+    return HttpResponse(status=204)
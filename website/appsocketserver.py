@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
-from multiprocessing import Process
-from threading import Thread
+from multiprocessing import Process, Pipe
+from threading import Thread, Event
 import socket as sk
-from datetime import datetime
-from pathlib import Path
 import logging
 from server.connectedclient import ConnectedClient
+from server.notify import CommandNotifier, PipeRouter, NOTIFY_PORT, DISPATCH_RATE
+from server.feed import UpdateFeed, FEED_PORT
+from server.heartbeat import configure_keepalive
+from server.sessions import shutdown, exit_on_terminate
+from server.logs import configure_logging
+from server import metrics
 import os
 import django
 
@@ -42,7 +46,9 @@ class AppSocketServer(Thread):
        This allows to identify the client and what needs to be done
        next. If the IMEI is not in the Installations list, then a
        new record is created. This allows client-server
-       auto-configuration.
+       auto-configuration. The <ID> may be followed by ";" and the
+       optional features supported by the client, e.g. "<ID>;DELTA"
+       for the compact telemetry encoding (see server.encoding).
 
     3) If the client is a RPi, a loop will start:
         a) The server sends "GET_INFO" and waits for the RPi
@@ -54,25 +60,42 @@ class AppSocketServer(Thread):
            If something can be read, the command is sent to the RPi
            and the element is removed from the db.
 
+       RPis that advertised the PUSH feature are not polled: they
+       send their data as soon as it changes, and a heartbeat when
+       it does not, while the commands are sent to them as soon as
+       they are saved (see ConnectedClient.push_worker).
+
+    After the identification, every message is terminated by a
+    newline ("\n"), so that a message may span several TCP segments
+    and several messages may be sent back to back. RPis that do not
+    terminate their reply to ID_SUPPLICANT with a newline are served
+    with the legacy behaviour, where every read is a whole message
+    (see server.framing.MessageBuffer).
+
     This is implemented with the help of ConnectedClient.
+
+    See server.asyncserver.AsyncAppSocketServer for an implementation
+    of the same protocol that does not need a process per RPi.
     """
 
-    def __init__(self, host="", port=37863):
+    def __init__(self, host="", port=37863, notify_port=NOTIFY_PORT, feed_port=FEED_PORT,
+                 dispatch_rate=DISPATCH_RATE):
         """
         The constructor intializes all the variables, including the
-        logger.
+        logger (see server.logs.configure_logging).
 
         :param host:
         :param port:
+        :param notify_port: The local UDP port on which new Commands
+            are notified by the views (see server.notify)
+        :param feed_port: The local port of the UpdateFeed, through
+            which the changes of the Installations are pushed to the
+            dashboards (see server.feed)
+        :param dispatch_rate: The maximum number of RPis woken up per
+            second by the notifications (see server.notify)
         """
         super(AppSocketServer, self).__init__()
-        now = datetime.now()
-        directory = Path("logs/")
-        filename = now.strftime("%Y-%m-%d_%H-%M-%S")
-        filename += "_server.log"
-        filename = directory / filename
-        logging.basicConfig(level=logging.DEBUG, filename=filename,
-                            format="[%(asctime)s][%(levelname)s] %(message)s")
+        configure_logging()
         self.logger = logging.getLogger(__name__)
         self.logger.debug("Logger ready")
         self.logger.info('Socket server started')
@@ -81,6 +104,12 @@ class AppSocketServer(Thread):
         # Configure parameters
         self.host = host
         self.port = port
+        self.notify_port = notify_port
+        self.feed_port = feed_port
+        self.dispatch_rate = dispatch_rate
+        self.router = PipeRouter()
+        # Set as soon as the server accepts connections
+        self.ready = Event()
 
     def listen_for_connections(self) -> None:
         """
@@ -90,42 +119,72 @@ class AppSocketServer(Thread):
         separated Process. Every process is marked as daemonic so that
         no process are left hanging if the programs terminates.
 
+        Every process receives the notifications of new Commands for
+        its RPi through a Pipe, fed by a CommandNotifier thread (see
+        server.notify.PipeRouter). TCP
+        keepalive is enabled on every connection (see
+        server.heartbeat.configure_keepalive), so that the process of
+        a RPi that silently disconnected ends in bounded time.
+
+        The database connection of this thread is closed before
+        forking, so that no process inherits it: every process opens
+        its own.
+
         :return: None
         """
+        from django.db import connections
+
+        self.router.start()
+        CommandNotifier(self.router, self.notify_port, self.dispatch_rate).start()
+        connections.close_all()
         with sk.socket(sk.AF_INET, sk.SOCK_STREAM) as s:
+            # Restarting must not wait for the connections of the
+            # previous run to leave TIME_WAIT
+            s.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEADDR, 1)
             s.bind((self.host, self.port))
+            s.listen(sk.SOMAXCONN)
+            self.ready.set()
             while True:
-                s.listen()
                 self.logger.info("Socket server listening for a new connection")
                 con, addr = s.accept()
                 self.logger.info("New connection from {}. Launching process.".format(addr))
+                configure_keepalive(con)
+                # Connections are rare enough in this mode to publish
+                # the metrics of this thread right away
+                metrics.increment(metrics.CONNECTIONS_ACCEPTED)
+                metrics.publish()
                 with con:
-                    p = Process(target=self.connection_process, args=(con, addr))
+                    notifications, sender = Pipe()
+                    p = Process(target=self.connection_process, args=(con, addr, notifications))
                     p.daemon = True
                     p.start()
+                    notifications.close()
+                    self.router.add(sender)
 
     @staticmethod
     def set_all_offline() -> None:
         """
-        Sets the "online" field of every Installation to "offline".
-        This should be used only at startup, to clear any possible
-        error caused by Installations not being properly set as
-        offline when the program terminated last time.
+        Sets the "online" field of every Installation to "offline",
+        and closes the ConnectionSessions left open. This should be
+        used only at startup, to clear any possible error caused by
+        Installations not being properly set as offline when the
+        program terminated last time. Two UPDATEs are issued, whatever
+        the number of Installations.
         :return: None
         """
         # Set all the installations as "offline" to ensure
         # a correct startup
         os.environ.setdefault("DJANGO_SETTINGS_MODULE", "website.settings")
         django.setup()
-        from app.models import Installation
+        from django.utils import timezone
+        from app.models import Installation, ConnectionSession
 
-        matching_count = Installation.objects.filter(online=True).count()
-        if matching_count > 0:
-            i = Installation.objects.get(online=True)
-            i.online = False
-            i.save()
+        Installation.objects.filter(online=True).update(online=False)
+        # The time of the disconnection is unknown: the sessions end
+        # at the latest when the server restarts
+        ConnectionSession.objects.filter(disconnected__isnull=True).update(disconnected=timezone.now())
 
-    def connection_process(self, connection: sk.socket, address) -> None:
+    def connection_process(self, connection: sk.socket, address, notifications=None) -> None:
         """
         A method that delegates all the client management to the
         ConnectedClient class. It takes care of returning in case of
@@ -135,14 +194,24 @@ class AppSocketServer(Thread):
             the client.
         :param address: the address of the connected client, as
             returned by socket.accept()
+        :param notifications: the child end of the Pipe on which new
+            Commands are notified.
         :return:
         """
         self.logger.info("Process for {} started. Identifying client.".format(address))
+        exit_on_terminate()
+        metrics.increment(metrics.CONNECTIONS)
         try:
-            c = ConnectedClient(connection, address)
+            c = ConnectedClient(connection, address, notifications)
         except ConnectionError:
             self.logger.warning("Connection error. Process for {} terminating.".format(address))
             return
+        finally:
+            # Also when the socket server stops (see exit_on_terminate)
+            shutdown()
+            # The metrics of the process would be lost otherwise
+            metrics.increment(metrics.CONNECTIONS, -1)
+            metrics.publish()
         self.logger.debug("Process for {} terminating.".format(address))
 
     def run(self) -> None:
@@ -152,4 +221,5 @@ class AppSocketServer(Thread):
         :return:
         """
         self.set_all_offline()
+        UpdateFeed(self.feed_port).start()
         self.listen_for_connections()
@@ -0,0 +1,52 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "website.settings")
+
+
+@contextmanager
+def scratch_database():
+    """
+    Sets up django on a scratch database, so that the database of the
+    site is never touched. With SQLite, unless DATABASE_NAME is set, a
+    temporary file is used; with the other backends DATABASE_NAME must
+    be an empty database. The tables are created from the models, and
+    dropped when the context is left.
+
+    :return: a context manager
+    """
+    database = None
+    if os.environ.get("DATABASE_ENGINE", "sqlite3") == "sqlite3" and "DATABASE_NAME" not in os.environ:
+        database = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+        os.environ["DATABASE_NAME"] = database
+
+    import django
+    from django.db import connection
+    django.setup()
+    from server.database import enable_wal
+    from app.models import Installation, Command, FleetDispatch, Reading, ReadingRollup, Alarm, \
+        ConnectionSession
+
+    models = (Installation, FleetDispatch, Command, Reading, ReadingRollup, Alarm, ConnectionSession)
+    with connection.schema_editor() as editor:
+        for model in models:
+            editor.create_model(model)
+    # As the socket server does (see manage.py runsocketserver)
+    enable_wal()
+    try:
+        yield
+    finally:
+        with connection.schema_editor() as editor:
+            for model in reversed(models):
+                editor.delete_model(model)
+        connection.close()
+        if database is not None:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(database + suffix):
+                    os.remove(database + suffix)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measures how long the history of a telemetry field of an installation
+takes to read, on the database backend selected by the DATABASE_*
+environment variables (see settings.DATABASES), in two modes:
+
+- readings: every Reading of the range is aggregated, as
+  ReadingQuerySet.downsample does;
+- rollups: the ReadingRollups written by the TelemetryIngestor are
+  aggregated instead, as ReadingQuerySet.history does for buckets of
+  whole minutes.
+
+The history has one Reading per second for the given number of days,
+and its rollups are written by a TelemetryIngestor. The benchmark
+never touches the database of the site (see telemetry_writes.py).
+
+Usage, from the website directory:
+
+    python benchmarks/history_reads.py --days 30 --bucket 3600
+"""
+import argparse
+import time
+from common import scratch_database
+
+IMEI = "%015d" % 0
+
+# Readings rolled up at once
+BATCH_SIZE = 10000
+
+
+def fill(days: int, end: int) -> None:
+    """
+    Writes one Reading per second for the given number of days before
+    end, and their rollups.
+
+    :param days: The number of days of history
+    :param end: The UNIX timestamp of the end of the history
+    :return: None
+    """
+    from app.models import Reading
+    from server.telemetry import TelemetryIngestor
+
+    ingestor = TelemetryIngestor()
+    start = end - days * 86400
+    for batch in range(start, end, BATCH_SIZE):
+        readings = [Reading(imei=IMEI, ts=ts, inlet_pressure=ts % 50, outlet_pressure=ts % 200,
+                            inlet_temperature=ts % 40, speed=1000 + ts % 500, running=ts % 2 == 0)
+                    for ts in range(batch, min(batch + BATCH_SIZE, end))]
+        Reading.objects.bulk_create(readings)
+        ingestor.roll_up(readings)
+        ingestor.write_rollups(before=readings[-1].ts // 60 * 60)
+    ingestor.write_rollups()
+
+
+def measure(function, repeat: int) -> float:
+    """
+    :return: the best time of repeat calls of function, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        begin = time.monotonic()
+        function()
+        best = min(best, time.monotonic() - begin)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="History read benchmark")
+    parser.add_argument("--days", type=int, default=30, help="Days of history, one Reading per second")
+    parser.add_argument("--bucket", type=int, default=3600, help="Seconds per bucket, a multiple of 60")
+    parser.add_argument("--field", default="speed")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with scratch_database():
+        from django.db import connection
+        from app.models import Reading
+
+        # The history ends two minutes ago, so that it is all rolled up
+        end = (int(time.time()) // 60 - 2) * 60
+        start = end - args.days * 86400
+        begin = time.monotonic()
+        fill(args.days, end)
+        print(f"Backend: {connection.vendor}, {args.days} days written in {time.monotonic() - begin:.1f} s")
+
+        readings = measure(lambda: list(Reading.objects.between(IMEI, start, end).downsample(args.field,
+                                                                                             args.bucket)),
+                           args.repeat)
+        rollups = measure(lambda: Reading.objects.history(IMEI, args.field, start, end, args.bucket), args.repeat)
+        print(f"{'mode':>9} {'seconds':>8}")
+        print(f"{'readings':>9} {readings:>8.3f}")
+        print(f"{'rollups':>9} {rollups:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
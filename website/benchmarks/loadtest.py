@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Load test of the socket server with a simulated fleet of RPis.
+
+The server (AsyncAppSocketServer or AppSocketServer) is started in a
+separate process on a scratch database (see common.scratch_database),
+then thousands of simulated RPis, all coroutines of a single event
+loop, connect to it and speak the real protocol:
+
+- they reply to ID_SUPPLICANT with a fake IMEI, optionally followed
+  by the features to negotiate (e.g. DELTA,PIPELINE or PUSH);
+- they reply to GET_INFO with new JSON data, with the given
+  probability, or with "NU";
+- in push mode they push new JSON data every push interval, or a
+  heartbeat;
+- they reply "OK" to the commands, or "OK <id>" to the pipelined
+  ones.
+
+Every reply is delayed by the given latency plus a uniform jitter, to
+simulate the GSM network. Meanwhile, commands are queued for random
+RPis at the given rate, as the dashboard does, and their latency is
+measured from the creation of the Command to its reception.
+
+The report includes connections per second, GET_INFO and telemetry
+updates per second, command latency percentiles and the RSS of the
+server processes.
+
+Usage, from the website directory:
+
+    python benchmarks/loadtest.py --units 2000 --duration 60
+    python benchmarks/loadtest.py --units 200 --server process --features PIPELINE
+    python benchmarks/loadtest.py --units 5000 --features DELTA,PUSH --latency 0.3 --jitter 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import signal
+import time
+from multiprocessing import Process
+from common import scratch_database
+
+
+class Stats:
+    """
+    The counters of the load test, shared by every simulated RPi.
+    """
+
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.disconnected = 0
+        self.get_info = 0
+        self.updates = 0
+        self.commands = 0
+        self.latencies = []
+        self.first_connection = None
+        self.last_connection = None
+
+    def connection(self) -> None:
+        now = time.monotonic()
+        if self.first_connection is None:
+            self.first_connection = now
+        self.last_connection = now
+        self.connected += 1
+
+    def connections_per_second(self) -> float:
+        if self.connected < 2:
+            return 0
+        return self.connected / max(self.last_connection - self.first_connection, 1e-6)
+
+
+def percentile(values, p: float) -> float:
+    """
+    :param values: A sorted list
+    :param p: The percentile, between 0 and 100
+    :return: the percentile of the values (nearest rank)
+    """
+    if not values:
+        return float("nan")
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def server_rss(pid: int) -> int:
+    """
+    :param pid: The PID of the server
+    :return: the resident set size, in bytes, of the server and of
+        all its child processes, read from /proc. 0 if not available.
+    """
+    children = {}
+    total = 0
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(entry))
+        except (OSError, IndexError):
+            continue
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            continue
+    return total
+
+
+class SimulatedRPi:
+    """
+    A simulated RPi, connected to the socket server.
+    """
+
+    def __init__(self, imei: str, args, stats: Stats):
+        self.imei = imei
+        self.args = args
+        self.stats = stats
+        self.writer = None
+        self.value = 0
+
+    async def delay(self) -> None:
+        """
+        Waits for the simulated network latency.
+        """
+        delay = self.args.latency + random.uniform(-self.args.jitter, self.args.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def telemetry(self) -> str:
+        """
+        :return: a reply to GET_INFO, with new data or "NU"
+        """
+        if random.random() >= self.args.change_probability:
+            return "NU"
+        self.value += 1
+        return json.dumps({"speed": 1000 + self.value % 500, "outlet_pressure": self.value % 200,
+                           "running": self.value % 2 == 0})
+
+    def send(self, message: str) -> None:
+        self.writer.write(message.encode() + b"\n")
+
+    def command(self, message: str) -> None:
+        """
+        Records the latency of a received command, and acknowledges it.
+
+        :param message: The command, as sent by the server
+        """
+        reply = "OK"
+        if message.startswith("CMD "):
+            _, command_id, message = message.split(" ", 2)
+            reply = f"OK {command_id}"
+        if message.startswith("LOADTEST "):
+            self.stats.latencies.append(time.time() - float(message.split()[1]))
+        self.stats.commands += 1
+        self.send(reply)
+
+    async def push(self) -> None:
+        """
+        Pushes new data, or a heartbeat, every push interval.
+        """
+        while True:
+            await asyncio.sleep(self.args.push_interval)
+            await self.delay()
+            message = self.telemetry()
+            if message == "NU":
+                message = "HB"
+            else:
+                self.stats.updates += 1
+            self.send(message)
+
+    async def run(self) -> None:
+        try:
+            reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+            # ID_SUPPLICANT is not terminated, as the framing is not
+            # negotiated yet
+            await reader.read(64)
+            await self.delay()
+            features = f";{self.args.features}" if self.args.features else ""
+            self.send(f"{self.imei}{features}")
+        except OSError:
+            self.stats.failed += 1
+            return
+        pusher = None
+        connected = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = line.decode().strip()
+                if not connected:
+                    connected = True
+                    self.stats.connection()
+                if message == "DELTA_OK":
+                    continue
+                if message.startswith("PUSH_OK"):
+                    # The first push must contain every field
+                    self.send(json.dumps({"speed": 1000, "outlet_pressure": 0, "running": False}))
+                    pusher = asyncio.ensure_future(self.push())
+                    continue
+                await self.delay()
+                if message == "GET_INFO":
+                    self.stats.get_info += 1
+                    reply = self.telemetry()
+                    if reply != "NU":
+                        self.stats.updates += 1
+                    self.send(reply)
+                else:
+                    self.command(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if pusher is not None:
+                pusher.cancel()
+            self.writer.close()
+        self.stats.disconnected += 1
+
+
+def serve(args) -> None:
+    """
+    Entry point of the server process. The server runs in its own
+    process group, so that it can be terminated with its children.
+    """
+    from server.asyncserver import AsyncAppSocketServer
+    from appsocketserver import AppSocketServer
+
+    if args.server == "asyncio":
+        server = AsyncAppSocketServer(port=args.port, workers=args.workers, notify_port=args.port + 1,
+                                      feed_port=args.port + 2)
+    else:
+        server = AppSocketServer(port=args.port, notify_port=args.port + 1, feed_port=args.port + 2)
+    os.setpgrp()
+    server.run()
+
+
+def queue_command(imei: str) -> None:
+    """
+    Queues a command for the given RPi, as the dashboard does. The
+    command carries its creation time, to measure its latency.
+    """
+    from app.models import Command
+    from server.notify import notify_command
+
+    Command.objects.create(imei=imei, command_string=f"LOADTEST {time.time():.6f}")
+    notify_command(imei)
+
+
+async def send_commands(args, imeis) -> None:
+    """
+    Queues commands for random RPis at args.command_rate per second.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(1 / args.command_rate)
+        await loop.run_in_executor(None, queue_command, random.choice(imeis))
+
+
+def report(stats: Stats, elapsed: float, rss: int, final=False) -> None:
+    latencies = sorted(stats.latencies)
+    print(f"{'Final' if final else f'{elapsed:6.0f} s'}: "
+          f"{stats.connected} connected ({stats.connections_per_second():.0f}/s), "
+          f"{stats.failed} failed, {stats.disconnected} disconnected | "
+          f"{stats.get_info / elapsed:.0f} GET_INFO/s, {stats.updates / elapsed:.0f} updates/s | "
+          f"{stats.commands} commands, latency p50 {percentile(latencies, 50) * 1000:.1f} ms "
+          f"p90 {percentile(latencies, 90) * 1000:.1f} ms p99 {percentile(latencies, 99) * 1000:.1f} ms | "
+          f"server RSS {rss / 2 ** 20:.1f} MB", flush=True)
+
+
+async def load(args, server_pid: int) -> None:
+    stats = Stats()
+    imeis = ["%015d" % (10 ** 14 + i) for i in range(args.units)]
+    rpis = []
+    begin = time.monotonic()
+    for imei in imeis:
+        rpis.append(asyncio.ensure_future(SimulatedRPi(imei, args, stats).run()))
+        if args.ramp:
+            await asyncio.sleep(1 / args.ramp)
+    commands = asyncio.ensure_future(send_commands(args, imeis)) if args.command_rate else None
+    peak_rss = 0
+    while time.monotonic() - begin < args.duration:
+        await asyncio.sleep(args.report_interval)
+        rss = server_rss(server_pid)
+        peak_rss = max(peak_rss, rss)
+        report(stats, time.monotonic() - begin, rss)
+    if commands is not None:
+        commands.cancel()
+    report(stats, time.monotonic() - begin, peak_rss, final=True)
+    for rpi in rpis:
+        rpi.cancel()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test of the socket server with a simulated fleet")
+    parser.add_argument("--units", type=int, default=1000, help="Number of simulated RPis")
+    parser.add_argument("--duration", type=float, default=30, help="Duration of the test, in seconds")
+    parser.add_argument("--server", choices=("asyncio", "process"), default="asyncio", help="Socket server mode")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes in asyncio mode")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=47863,
+                        help="Port of the server. The next two are used for notifications and the feed.")
+    parser.add_argument("--features", default="", help="Features advertised by the RPis, e.g. DELTA,PIPELINE")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay of every reply, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random variation of the delay")
+    parser.add_argument("--change-probability", type=float, default=0.2,
+                        help="Probability that a reply contains new data instead of NU")
+    parser.add_argument("--push-interval", type=float, default=5, help="Seconds between two pushes")
+    parser.add_argument("--command-rate", type=float, default=5, help="Commands queued per second")
+    parser.add_argument("--ramp", type=float, default=0, help="New connections per second, 0 for all at once")
+    parser.add_argument("--report-interval", type=float, default=5)
+    args = parser.parse_args()
+
+    # Every simulated RPi needs a file descriptor, and so does every
+    # connection of the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with scratch_database():
+        from django.conf import settings
+        from django.db import connections
+
+        settings.SOCKET_SERVER_NOTIFY_PORT = args.port + 1
+        settings.SOCKET_SERVER_FEED_PORT = args.port + 2
+        connections.close_all()
+        # Not daemonic, as the process server starts a process for
+        # every connection
+        server = Process(target=serve, args=(args,))
+        server.start()
+        time.sleep(1)
+        try:
+            asyncio.run(load(args, server.pid))
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
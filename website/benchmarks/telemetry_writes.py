@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Measures how the telemetry write throughput scales with the number of
+connected RPis, on the database backend selected by the DATABASE_*
+environment variables (see settings.DATABASES).
+
+Every simulated RPi writes a reply to GET_INFO as fast as it can, in
+one of these modes:
+
+- save: every RPi is a process that saves its Installation for every
+  reply, as the socket server did before the TelemetryIngestor;
+- ingestor: every RPi is a process with its own TelemetryIngestor,
+  flushed after every reply, as in the process mode of the socket
+  server;
+- bulk: a single TelemetryIngestor receives the replies of every RPi
+  and flushes them together, as in the asyncio mode.
+
+The benchmark never touches the database of the site. With SQLite it
+uses a temporary file; with the other backends DATABASE_NAME must be
+an empty scratch database. The tables are created from the models and
+dropped at the end.
+
+Usage, from the website directory:
+
+    python benchmarks/telemetry_writes.py --units 1,10,50 --updates 100
+    DATABASE_ENGINE=postgresql DATABASE_NAME=bench python benchmarks/telemetry_writes.py
+"""
+import argparse
+import time
+from multiprocessing import Process, Queue, Event
+from common import scratch_database
+
+MODES = ("save", "ingestor", "bulk")
+
+
+def telemetry(i: int) -> dict:
+    """
+    :param i: The number of the reply
+    :return: a reply to GET_INFO in which every history field changed
+    """
+    return {"inlet_pressure": i % 50, "outlet_pressure": i % 200, "inlet_temperature": i % 40,
+            "speed": 1000 + i % 500, "running": i % 2 == 0}
+
+
+def write_replies(imei: str, updates: int, mode: str, start, results: Queue) -> None:
+    """
+    Entry point of the process of a simulated RPi.
+
+    :param imei: The IMEI of the RPi
+    :param updates: The number of replies to write
+    :param mode: "save" or "ingestor"
+    :param start: The Event that starts every RPi at once
+    :param results: The Queue on which the number of failed writes is
+        put
+    :return: None
+    """
+    from django.db import connections, OperationalError
+    from app.models import Installation
+    from server.telemetry import TelemetryIngestor
+
+    connections.close_all()
+    ingestor = TelemetryIngestor()
+    errors = 0
+    start.wait()
+    for i in range(updates):
+        try:
+            if mode == "save":
+                installation = Installation.objects.get(imei=imei)
+                for field, value in telemetry(i).items():
+                    setattr(installation, field, value)
+                installation.save()
+            else:
+                ingestor.submit(imei, telemetry(i))
+                ingestor.flush()
+        except OperationalError:
+            errors += 1
+    results.put(errors)
+
+
+def run(units: int, updates: int, mode: str):
+    """
+    Writes updates replies for each of units RPis.
+
+    :return: the number of replies written per second and the number
+        of failed writes
+    """
+    from django.db import connections, OperationalError
+    from app.models import Installation, Reading
+    from server.telemetry import TelemetryIngestor
+
+    Installation.objects.all().delete()
+    Reading.objects.all().delete()
+    imeis = ["%015d" % i for i in range(units)]
+    Installation.objects.bulk_create([Installation(imei=imei, online=True) for imei in imeis])
+
+    if mode == "bulk":
+        ingestor = TelemetryIngestor(flush_size=units)
+        errors = 0
+        begin = time.monotonic()
+        for i in range(updates):
+            for imei in imeis:
+                ingestor.submit(imei, telemetry(i))
+            try:
+                ingestor.flush()
+            except OperationalError:
+                errors += 1
+        return units * updates / (time.monotonic() - begin), errors
+
+    connections.close_all()
+    start = Event()
+    results = Queue()
+    processes = [Process(target=write_replies, args=(imei, updates, mode, start, results)) for imei in imeis]
+    for p in processes:
+        p.start()
+    begin = time.monotonic()
+    start.set()
+    errors = sum(results.get() for _ in processes)
+    elapsed = time.monotonic() - begin
+    for p in processes:
+        p.join()
+    return units * updates / elapsed, errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Telemetry write throughput benchmark")
+    parser.add_argument("--units", default="1,10,50", help="Comma separated numbers of connected RPis")
+    parser.add_argument("--updates", type=int, default=100, help="Replies written by every RPi")
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma separated modes (save, ingestor, bulk)")
+    args = parser.parse_args()
+
+    with scratch_database():
+        from django.db import connection
+
+        print(f"Backend: {connection.vendor}")
+        print(f"{'units':>6} {'mode':>9} {'replies/s':>10} {'errors':>7}")
+        for units in [int(n) for n in args.units.split(",")]:
+            for mode in args.modes.split(","):
+                throughput, errors = run(units, args.updates, mode)
+                print(f"{units:>6} {mode:>9} {throughput:>10.0f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
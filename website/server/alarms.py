@@ -0,0 +1,246 @@
+import json
+import logging
+import socket as sk
+import time
+import urllib.request
+from queue import Queue, Full
+from threading import Thread
+
+RAISED = "raised"
+CLEARED = "cleared"
+
+# Events delivered at once for a single node, and events per second
+# afterwards, so that a flapping node can not flood the subscribers
+NODE_BURST = 5
+NODE_RATE = 1 / 60
+
+# Maximum number of events in a single datagram
+EVENTS_PER_DATAGRAM = 100
+
+# Maximum number of events waiting for a slow subscriber
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+def publish_alarm_events(events) -> None:
+    """
+    Publishes alarm events to the AlarmBus of the UpdateFeed of the
+    socket server. Every event is a dictionary with the IMEI of the
+    Installation, the CANbus ID of the node, the event (RAISED or
+    CLEARED) and its time, e.g.
+    {"imei": "...", "node": 12, "event": "raised", "time": "..."}.
+    Events are sent as UDP datagrams, so publishing never blocks.
+
+    :param events: A list of dictionaries
+    :return: None
+    """
+    from django.conf import settings
+    from server.feed import FEED_PORT
+
+    port = getattr(settings, "SOCKET_SERVER_FEED_PORT", FEED_PORT)
+    try:
+        with sk.socket(sk.AF_INET, sk.SOCK_DGRAM) as s:
+            for i in range(0, len(events), EVENTS_PER_DATAGRAM):
+                data = json.dumps({"alarms": events[i:i + EVENTS_PER_DATAGRAM]}, separators=(",", ":"))
+                s.sendto(data.encode(), ("127.0.0.1", port))
+    except OSError:
+        logging.getLogger(__name__).warning(f"Could not publish {len(events)} alarm events to the feed")
+
+
+class AlarmBus:
+    """
+    Delivers the alarm events published by the socket server (see
+    publish_alarm_events) to a list of subscribers, each one a
+    callable taking an event. It runs in the thread of the
+    UpdateFeed, so the subscribers must not block: the slow ones
+    (see WebhookSubscriber and EmailSpoolSubscriber) deliver from
+    their own thread.
+
+    The events of every node are deduplicated and rate limited:
+
+    - an event that does not change the state last delivered for the
+      node (e.g. a second "raised") is dropped;
+    - a token bucket allows NODE_BURST events at once and NODE_RATE
+      per second afterwards. While a node is over its rate, only its
+      latest event is kept, and it is delivered by tick as soon as
+      the bucket allows it, unless the node went back to the state
+      last delivered in the meantime.
+
+    Every delivered event carries the number of events of the node
+    suppressed since the previous one, as "suppressed".
+    """
+
+    def __init__(self, subscribers, burst=NODE_BURST, rate=NODE_RATE):
+        """
+        :param subscribers: A list of callables taking an event
+        :param burst: The events delivered at once for a node
+        :param rate: The events per second delivered for a node after
+            the burst
+        """
+        self.subscribers = list(subscribers)
+        self.burst = burst
+        self.rate = rate
+        # The delivery state of every node, by (IMEI, node)
+        self.nodes = {}
+        self.logger = logging.getLogger(__name__)
+
+    def publish(self, events) -> None:
+        """
+        :param events: The events of a datagram (see
+            publish_alarm_events)
+        :return: None
+        """
+        now = time.monotonic()
+        for event in events:
+            key = (event["imei"], event["node"])
+            node = self.nodes.get(key)
+            if node is None:
+                node = self.nodes[key] = {"delivered": None, "pending": None, "suppressed": 0,
+                                          "tokens": self.burst, "updated": now}
+            self.refill(node, now)
+            if event["event"] == node["delivered"] or node["tokens"] < 1:
+                # Superseded, or over the rate: only the latest event
+                # is kept, for tick
+                node["pending"] = event if event["event"] != node["delivered"] else None
+                node["suppressed"] += 1
+                continue
+            self.deliver(node, event)
+
+    def tick(self) -> None:
+        """
+        Delivers the latest event of the nodes that were over their
+        rate, if the bucket allows it now. To be called periodically.
+
+        :return: None
+        """
+        now = time.monotonic()
+        for node in self.nodes.values():
+            if node["pending"] is None:
+                continue
+            self.refill(node, now)
+            if node["tokens"] >= 1:
+                self.deliver(node, node["pending"])
+
+    def refill(self, node: dict, now: float) -> None:
+        node["tokens"] = min(self.burst, node["tokens"] + (now - node["updated"]) * self.rate)
+        node["updated"] = now
+
+    def deliver(self, node: dict, event: dict) -> None:
+        node["tokens"] -= 1
+        node["delivered"] = event["event"]
+        node["pending"] = None
+        event = dict(event, suppressed=node["suppressed"])
+        node["suppressed"] = 0
+        for subscriber in self.subscribers:
+            try:
+                subscriber(event)
+            except Exception:
+                self.logger.exception(f"Could not deliver an alarm event of {event['imei']}")
+
+
+class QueuedSubscriber(Thread):
+    """
+    A subscriber of the AlarmBus that delivers the events from its own
+    daemon thread, so that a slow delivery never delays the
+    UpdateFeed. If more than SUBSCRIBER_QUEUE_SIZE events are waiting,
+    the new ones are dropped. Subclasses implement deliver.
+    """
+
+    def __init__(self):
+        super(QueuedSubscriber, self).__init__()
+        self.daemon = True
+        self.queue = Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.logger = logging.getLogger(__name__)
+
+    def __call__(self, event: dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.logger.warning(f"Dropping an alarm event of {event['imei']}: {self.name} is too slow")
+
+    def run(self) -> None:
+        while True:
+            event = self.queue.get()
+            try:
+                self.deliver(event)
+            except Exception:
+                self.logger.exception(f"{self.name} could not deliver an alarm event of {event['imei']}")
+
+    def deliver(self, event: dict) -> None:
+        raise NotImplementedError()
+
+
+class WebhookSubscriber(QueuedSubscriber):
+    """
+    POSTs every event, as JSON, to a URL.
+    """
+
+    def __init__(self, url: str, timeout=5):
+        """
+        :param url: The URL of the webhook
+        :param timeout: Seconds to wait for the endpoint
+        """
+        super(WebhookSubscriber, self).__init__()
+        self.name = "WebhookSubscriber"
+        self.url = url
+        self.timeout = timeout
+
+    def deliver(self, event: dict) -> None:
+        request = urllib.request.Request(self.url, data=json.dumps(event).encode(), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class EmailSpoolSubscriber(QueuedSubscriber):
+    """
+    Sends an email for every event through the given django email
+    backend. With the default file based backend, every email is
+    written to a new file in the spool directory, to be sent by the
+    mail system.
+    """
+
+    def __init__(self, recipients, spool: str, backend="django.core.mail.backends.filebased.EmailBackend"):
+        """
+        :param recipients: The email addresses of the recipients
+        :param spool: The spool directory of the file based backend
+        :param backend: The import path of the email backend
+        """
+        super(EmailSpoolSubscriber, self).__init__()
+        self.name = "EmailSpoolSubscriber"
+        self.recipients = list(recipients)
+        self.spool = spool
+        self.backend = backend
+
+    def deliver(self, event: dict) -> None:
+        from django.core.mail import EmailMessage, get_connection
+
+        state = "scattato" if event["event"] == RAISED else "rientrato"
+        subject = f"Allarme nodo #{event['node']} {state} sull'impianto {event['imei']}"
+        body = f"{subject} il {event['time']}."
+        if event.get("suppressed"):
+            body += f"\n{event['suppressed']} eventi precedenti dello stesso nodo non sono stati notificati."
+        with get_connection(self.backend, file_path=self.spool) as connection:
+            EmailMessage(subject, body, to=self.recipients, connection=connection).send()
+
+
+def configured_subscribers() -> list:
+    """
+    :return: the subscribers of the AlarmBus enabled in the settings:
+        a WebhookSubscriber if ALARM_WEBHOOK_URL is set, and an
+        EmailSpoolSubscriber if ALARM_EMAIL_RECIPIENTS is not empty.
+        They are started.
+    """
+    from django.conf import settings
+
+    subscribers = []
+    url = getattr(settings, "ALARM_WEBHOOK_URL", None)
+    if url:
+        subscribers.append(WebhookSubscriber(url))
+    recipients = getattr(settings, "ALARM_EMAIL_RECIPIENTS", [])
+    if recipients:
+        subscribers.append(EmailSpoolSubscriber(recipients, settings.ALARM_EMAIL_SPOOL,
+                                                getattr(settings, "ALARM_EMAIL_BACKEND",
+                                                        "django.core.mail.backends.filebased.EmailBackend")))
+    for subscriber in subscribers:
+        subscriber.start()
+    return subscribers
@@ -0,0 +1,677 @@
+import asyncio
+import logging
+import os
+import socket as sk
+import time
+from multiprocessing import Process, Pipe
+from threading import Thread, Event
+
+import django
+from server.framing import MessageBuffer, PIPELINE_FEATURE, PUSH_FEATURE, HEARTBEAT_MESSAGE, command_message, \
+    parse_ack
+from server.telemetry import get_ingestor
+from server.sessions import get_recorder, shutdown, exit_on_terminate
+from server.encoding import TelemetryDecoder, DELTA_FEATURE
+from server.cadence import PollScheduler
+from server.heartbeat import HeartbeatMonitor, configure_keepalive
+from server.database import database_sync_to_async
+from server import metrics
+from server.logs import configure_logging, client_logger
+from server.feed import UpdateFeed, FEED_PORT, publish_update
+from server.notify import CommandNotifier, PipeBroadcaster, NOTIFY_PORT, DISPATCH_RATE, parse_watch
+
+
+class AsyncConnectedClient:
+    """
+    The asyncio counterpart of ConnectedClient. An AsyncConnectedClient
+    speaks exactly the same protocol (ID_SUPPLICANT, GET_INFO and
+    commands) but, instead of owning a whole process, it is a
+    coroutine running on the event loop of AsyncAppSocketServer.
+    Thousands of them can share a single process, and the memory
+    used by each connection is bounded by the StreamReader limit.
+
+    The django ORM is synchronous, so every database access is
+    wrapped with database_sync_to_async and runs in the database
+    thread of the event loop.
+    """
+
+    # Maximum number of bytes read from the stream at once
+    READ_SIZE = 4096
+    # See ConnectedClient.COMMAND_RECHECK_INTERVAL
+    COMMAND_RECHECK_INTERVAL = 10
+    # See ConnectedClient.COMMAND_WINDOW
+    COMMAND_WINDOW = 8
+    # See ConnectedClient.HEARTBEAT_INTERVAL
+    HEARTBEAT_INTERVAL = 30
+    # See ConnectedClient.COMMAND_ACK_TIMEOUT
+    COMMAND_ACK_TIMEOUT = 5
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address, clients=None,
+                 monitor=None):
+        """
+        The constructor only initializes the variables. The
+        connection is handled by calling AsyncConnectedClient.run().
+
+        :param reader: The StreamReader of the connection with the RPi
+        :param writer: The StreamWriter of the connection with the RPi
+        :param address: The address of the RPi client, as returned by
+            StreamWriter.get_extra_info("peername")
+        :param clients: A dictionary in which the client registers
+            itself, with its IMEI as key, once identified. It is used
+            by the server to notify new Commands.
+        :param monitor: The HeartbeatMonitor of the server, which
+            enforces the timeouts of receive. If None, every read has
+            its own timeout.
+        """
+        from app.models import Installation, Command
+
+        self.reader = reader
+        self.writer = writer
+        self.address = address
+        self.id = None
+        # Replaced by the logger of the IMEI once identified
+        self.logger = client_logger()
+        self.Installation = Installation
+        self.Command = Command
+        self.buffer = MessageBuffer()
+        self.features = set()
+        self.decoder = TelemetryDecoder()
+        self.ingestor = get_ingestor()
+        self.sessions = get_recorder()
+        # See ConnectedClient.session
+        self.session = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.scheduler = PollScheduler()
+        self.clients = clients if clients is not None else {}
+        self.monitor = monitor
+        # Set to interrupt the wait between two GET_INFO
+        self.wakeup = asyncio.Event()
+        self.command_notified = False
+        self.command_due = True
+        self.last_command_check = 0
+        self.push = False
+        # See ConnectedClient.push_worker
+        self.sent_commands = {}
+        self.acknowledged = set()
+        self.commands_acknowledged = asyncio.Event()
+
+    async def run(self) -> None:
+        """
+        Identifies the client, initializes the installation and
+        starts the worker coroutine. When the worker returns or fails,
+        the Installation is set as offline and the connection is closed.
+
+        :return: None
+        """
+        try:
+            if not await self.identify():
+                return
+            self.clients[self.id] = self
+            self.initialize_installation()
+            if self.push:
+                await self.push_worker()
+            else:
+                await self.raspberry_pi_worker()
+        finally:
+            # Written in bulk with the other disconnections, along
+            # with the pending telemetry of the RPi, even if the
+            # worker failed
+            if self.session is not None:
+                self.sessions.disconnect(self.session, self.id, self.bytes_received, self.bytes_sent)
+            if self.id is not None and self.clients.get(self.id) is self:
+                del self.clients[self.id]
+            self.writer.close()
+
+    async def send(self, message):
+        """
+        Encodes the message and sends it. If a problem happens,
+        the connection is closed.
+
+        :param message: The message to encode and send
+        :return: None
+        """
+        try:
+            self.logger.debug("Sending %s to %s", message, self.address)
+            data = self.buffer.encode(message)
+            self.writer.write(data)
+            self.bytes_sent += len(data)
+            metrics.increment(metrics.SENT_BYTES, len(data), self.id)
+            await self.writer.drain()
+        except ConnectionError:
+            self.logger.error(f"Could not send data to {self.address}")
+            self.writer.close()
+            raise ConnectionError()
+
+    async def receive(self, timeout=0):
+        """
+        Returns the next message sent by the client, reading from the
+        connection until self.buffer contains a complete one. Unlike
+        ConnectedClient.receive, the timeout is enforced by the
+        HeartbeatMonitor, which aborts the connection when it expires,
+        or, without a monitor, by awaiting the reads with
+        asyncio.wait_for.
+
+        :param timeout: Time in seconds to wait before closing the
+                        connection if no data is sent. Timeout = 0
+                        is default and means no timeout.
+        :return: The decoded message
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        message = self.buffer.next_message()
+        if message is None and timeout > 0 and self.monitor is not None:
+            self.monitor.expect(self, timeout)
+        try:
+            while message is None:
+                # See ConnectedClient.receive
+                settling = self.buffer.settling
+                try:
+                    wait = max(deadline - loop.time(), 0) if timeout > 0 and self.monitor is None else None
+                    if settling:
+                        wait = min(wait if wait is not None else MessageBuffer.SETTLE_TIMEOUT,
+                                   MessageBuffer.SETTLE_TIMEOUT)
+                    if wait is not None:
+                        data = await asyncio.wait_for(self.reader.read(self.READ_SIZE), wait)
+                    else:
+                        data = await self.reader.read(self.READ_SIZE)
+                except asyncio.TimeoutError:
+                    if settling:
+                        self.buffer.settle()
+                        message = self.buffer.next_message()
+                        continue
+                    self.writer.close()
+                    raise ConnectionAbortedError()
+
+                if not data:
+                    self.logger.warning(f"{self.address} closed the connection or did not send anything before timeout")
+                    raise ConnectionAbortedError()
+                self.bytes_received += len(data)
+                metrics.increment(metrics.RECEIVED_BYTES, len(data), self.id)
+                self.buffer.feed(data)
+                message = self.buffer.next_message()
+        finally:
+            if self.monitor is not None:
+                self.monitor.received(self)
+        self.logger.debug("%s sent %s", self.address, message)
+        return message
+
+    async def identify(self):
+        """
+        Same as ConnectedClient.identify: "ID_SUPPLICANT" is sent and
+        the reply is used as the IMEI of the client.
+
+        :return: True if client was successfully identified, False
+                otherwise.
+        """
+        if self.id is not None:
+            return True
+        start = time.monotonic()
+        try:
+            await self.send("ID_SUPPLICANT")
+            reply = await self.receive(2)
+            # See ConnectedClient.identify for the features
+            client_id, _, features = reply.partition(";")
+            if client_id.isdigit() and len(client_id) >= 15:
+                self.id = client_id
+                self.features = set(features.split(",")) - {""}
+                self.logger = client_logger(self.id)
+                self.logger.info(f"{self.address} is a Raspberry Pi with IMEI {self.id}.")
+                if DELTA_FEATURE in self.features and self.buffer.framed:
+                    await self.send("DELTA_OK")
+                if PUSH_FEATURE in self.features and self.buffer.framed:
+                    self.push = True
+                    await self.send(f"PUSH_OK {self.HEARTBEAT_INTERVAL}")
+                metrics.observe(metrics.HANDSHAKE_SECONDS, time.monotonic() - start)
+                return True
+        except ConnectionError:
+            self.logger.warning(f"Could not identify {self.address}.")
+            return False
+        self.logger.error(f"{self.address} tried to identify with an invalid IMEI. Closing connection")
+        return False
+
+    async def raspberry_pi_worker(self) -> None:
+        """
+        Same loop as ConnectedClient.raspberry_pi_worker, with every
+        blocking call replaced by its awaitable counterpart.
+
+        :return: None
+        """
+        while True:
+            # Phase a: Update information about installation
+            try:
+                poll_rate = self.scheduler.poll()
+                if poll_rate is not None:
+                    publish_update(self.id, poll_rate=poll_rate)
+                start = time.monotonic()
+                await self.send("GET_INFO")
+                info = await self.receive(5)
+                metrics.observe(metrics.GET_INFO_SECONDS, time.monotonic() - start)
+                updated = info != "NO_UPDATE" and info != "NU"
+                if updated:
+                    # Submitting does not touch the database, so it
+                    # does not need to leave the event loop
+                    try:
+                        self.ingestor.submit(self.id, self.decode(info))
+                    except ValueError:
+                        self.logger.warning(f"RPi {self.id} sent an invalid reply to GET_INFO: {info}")
+                        updated = False
+                interval = self.scheduler.schedule(self.decoder.state, updated)
+            except ConnectionError:
+                self.logger.warning(f"RPi {self.id} did not reply to GET_INFO.")
+                break
+            # Phase b: check if the database contains a command for
+            # this RPi and execute it
+            try:
+                if not self.command_due:
+                    self.command_due = await self.wait_for_command(interval)
+                if self.command_due:
+                    self.command_due = await self.execute_pending_commands()
+            except ConnectionError:
+                self.logger.warning(f"RPi {self.address} did not receive the last command sent or did not reply to it.")
+                break
+
+    async def push_worker(self) -> None:
+        """
+        Same as ConnectedClient.push_worker. The data is received by
+        this coroutine, while the commands are sent by
+        push_pending_commands, which runs alongside it.
+
+        :return: None
+        """
+        sender = asyncio.ensure_future(self.push_pending_commands())
+        try:
+            while True:
+                message = await self.receive(2 * self.HEARTBEAT_INTERVAL)
+                await self.handle_pushed_message(message)
+        except ConnectionError:
+            self.logger.warning(f"Lost connection with RPi {self.id}.")
+        finally:
+            sender.cancel()
+        await self.delete_acknowledged_commands()
+
+    async def push_pending_commands(self) -> None:
+        """
+        Sends the Commands queued for a pushing RPi as soon as they
+        are notified, and closes the connection if they are not
+        acknowledged within COMMAND_ACK_TIMEOUT seconds.
+
+        :return: None
+        """
+        try:
+            while True:
+                if not self.command_due:
+                    self.command_due = await self.wait_for_command(self.COMMAND_RECHECK_INTERVAL)
+                    continue
+                self.command_due = False
+                self.last_command_check = asyncio.get_running_loop().time()
+                commands = await database_sync_to_async(self.get_commands)(self.COMMAND_WINDOW)
+                if not commands:
+                    continue
+                self.commands_acknowledged.clear()
+                self.sent_commands = {command.id: command.created for command in commands}
+                for command in commands:
+                    self.logger.info(command.command_string)
+                    await self.send(command_message(command.id, command.command_string))
+                await asyncio.wait_for(self.commands_acknowledged.wait(), self.COMMAND_ACK_TIMEOUT)
+                # More commands may be queued
+                self.command_due = True
+        except asyncio.TimeoutError:
+            self.logger.warning(f"RPi {self.id} did not acknowledge the last commands sent.")
+            self.writer.close()
+        except ConnectionError:
+            pass
+
+    async def handle_pushed_message(self, message: str) -> None:
+        """
+        Same as ConnectedClient.handle_pushed_message.
+
+        :param message: The message received
+        :return: None
+        """
+        if message == HEARTBEAT_MESSAGE:
+            return
+        command_id = parse_ack(message)
+        if command_id is not None:
+            if command_id in self.sent_commands:
+                self.acknowledged.add(command_id)
+            if self.sent_commands and self.acknowledged == self.sent_commands.keys():
+                await self.delete_acknowledged_commands()
+                self.commands_acknowledged.set()
+            return
+        try:
+            self.ingestor.submit(self.id, self.decode(message))
+        except ValueError:
+            self.logger.warning(f"RPi {self.id} pushed an invalid message: {message}")
+
+    async def delete_acknowledged_commands(self) -> None:
+        """
+        Same as ConnectedClient.delete_acknowledged_commands.
+
+        :return: None
+        """
+        if self.acknowledged:
+            self.logger.info(f"{self.id} completed execution of {len(self.acknowledged)} of "
+                             f"{len(self.sent_commands)} commands")
+            for command_id in self.acknowledged:
+                metrics.observe_command_latency(self.sent_commands[command_id])
+            await database_sync_to_async(self.delete_commands)(self.acknowledged)
+        self.sent_commands = {}
+        self.acknowledged = set()
+
+    async def wait_for_command(self, timeout) -> bool:
+        """
+        Waits up to timeout seconds for the server to notify a new
+        Command for this RPi (see notify_command), or the opening of
+        a dashboard (see watch).
+
+        :param timeout: Time in seconds to wait
+        :return: True if the command queue should be checked, False
+            otherwise.
+        """
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+        if self.command_notified:
+            self.command_notified = False
+            return True
+        loop = asyncio.get_running_loop()
+        return loop.time() - self.last_command_check >= self.COMMAND_RECHECK_INTERVAL
+
+    def notify_command(self) -> None:
+        """
+        Called by the server when a new Command is saved for this RPi.
+
+        :return: None
+        """
+        self.command_notified = True
+        self.wakeup.set()
+
+    def watch(self) -> None:
+        """
+        Called by the server while the installation is shown on a
+        dashboard. If it was not watched already, the current wait is
+        interrupted so that it is polled right away.
+
+        :return: None
+        """
+        if self.scheduler.watch():
+            self.wakeup.set()
+
+    async def execute_pending_commands(self) -> bool:
+        """
+        Same as ConnectedClient.execute_pending_commands.
+
+        :return: True if a command was found, False otherwise
+        """
+        self.last_command_check = asyncio.get_running_loop().time()
+        pipeline = PIPELINE_FEATURE in self.features and self.buffer.framed
+        commands = await database_sync_to_async(self.get_commands)(self.COMMAND_WINDOW if pipeline else 1)
+        if not commands:
+            return False
+        if not pipeline:
+            command = commands[0]
+            self.logger.info(command.command_string)
+            await self.send(command.command_string)
+            message = await self.receive(5)
+            if message == "OK":
+                self.logger.info(f"{self.id} completed execution of {command.command_string}")
+                metrics.observe_command_latency(command.created)
+                await database_sync_to_async(command.delete)()
+            return True
+
+        for command in commands:
+            self.logger.info(command.command_string)
+            await self.send(command_message(command.id, command.command_string))
+        acknowledged = set()
+        for _ in commands:
+            command_id = parse_ack(await self.receive(5))
+            if command_id is not None:
+                acknowledged.add(command_id)
+        self.logger.info(f"{self.id} completed execution of {len(acknowledged)} of {len(commands)} commands")
+        for command in commands:
+            if command.id in acknowledged:
+                metrics.observe_command_latency(command.created)
+        await database_sync_to_async(self.delete_commands)(acknowledged)
+        return True
+
+    def decode(self, message: str) -> dict:
+        """
+        Decodes a reply to GET_INFO, recording the time spent.
+
+        :param message: The reply
+        :return: the decoded reply (see TelemetryDecoder.decode)
+        """
+        start = time.monotonic()
+        try:
+            return self.decoder.decode(message)
+        finally:
+            metrics.observe(metrics.DECODE_SECONDS, time.monotonic() - start)
+
+    def initialize_installation(self) -> None:
+        """
+        Set the Installation with the given IMEI as online, creating
+        it if necessary (see ConnectedClient.initialize_installation).
+        Nothing is written from the event loop.
+
+        :return: None
+        """
+        self.session = self.sessions.connect(self.id, self.address)
+
+    def get_commands(self, limit: int) -> list:
+        """
+        :param limit: The maximum number of commands to return
+        :return: The first Commands queued for this RPi
+        """
+        return list(self.Command.objects.filter(imei=self.id)[:limit])
+
+    def delete_commands(self, ids) -> None:
+        """
+        Removes the executed Commands from the queue.
+
+        :param ids: The IDs of the executed Commands
+        :return: None
+        """
+        self.Command.objects.delete_executed(self.id, ids)
+
+
+class AsyncAppSocketServer(Thread):
+    """
+    An alternative to AppSocketServer that serves every RPi from a
+    single asyncio event loop instead of forking a Process for each
+    accepted connection. The protocol is the same (see
+    AppSocketServer), and it is implemented by AsyncConnectedClient.
+
+    Django is initialized only once, before serving. If workers is
+    greater than 1, the listening socket is created by this thread and
+    shared with <workers> processes, each one running its own event
+    loop: the kernel distributes the incoming connections among them.
+    """
+
+    def __init__(self, host="", port=37863, workers=1, reader_limit=2 ** 16, notify_port=NOTIFY_PORT,
+                 feed_port=FEED_PORT, dispatch_rate=DISPATCH_RATE):
+        """
+        :param host: The address to bind to
+        :param port: The port to bind to
+        :param workers: The number of processes serving connections.
+            With 1 the event loop runs in this thread.
+        :param reader_limit: The buffer limit, in bytes, of the
+            StreamReader of every connection.
+        :param notify_port: The local UDP port on which new Commands
+            are notified by the views (see server.notify)
+        :param feed_port: The local port of the UpdateFeed (see
+            server.feed)
+        :param dispatch_rate: The maximum number of RPis woken up per
+            second by the notifications (see server.notify)
+        """
+        super(AsyncAppSocketServer, self).__init__()
+        configure_logging()
+        self.logger = logging.getLogger(__name__)
+        self.logger.info('Asyncio socket server started')
+        print("Asyncio socket server started")
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reader_limit = reader_limit
+        self.notify_port = notify_port
+        self.feed_port = feed_port
+        self.dispatch_rate = dispatch_rate
+        # The clients served by the event loop of this process,
+        # by IMEI
+        self.clients = {}
+        # The HeartbeatMonitor of the event loop of this process
+        self.monitor = None
+        # Set as soon as the server accepts connections
+        self.ready = Event()
+
+    def create_socket(self) -> sk.socket:
+        """
+        Creates the listening socket, so that it can be shared by all
+        the workers.
+
+        :return: the listening socket
+        """
+        s = sk.socket(sk.AF_INET, sk.SOCK_STREAM)
+        s.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        s.listen(sk.SOMAXCONN)
+        s.setblocking(False)
+        return s
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Called by asyncio for every accepted connection.
+
+        :return: None
+        """
+        address = writer.get_extra_info("peername")
+        self.logger.info(f"New connection from {address}.")
+        configure_keepalive(writer.get_extra_info("socket"))
+        metrics.increment(metrics.CONNECTIONS_ACCEPTED)
+        metrics.increment(metrics.CONNECTIONS)
+        try:
+            await AsyncConnectedClient(reader, writer, address, self.clients, self.monitor).run()
+        except Exception:
+            self.logger.exception(f"Unexpected error while serving {address}.")
+        finally:
+            metrics.increment(metrics.CONNECTIONS, -1)
+        self.logger.debug(f"Connection with {address} terminated.")
+
+    def dispatch(self, imei: str) -> None:
+        """
+        Wakes up the client with the given IMEI, if it is served by
+        this process, so that it checks its command queue. For a
+        watch_message the client is marked as watched instead.
+
+        :param imei: The IMEI of the RPi with a new Command
+        :return: None
+        """
+        watched = parse_watch(imei)
+        client = self.clients.get(watched or imei)
+        if client is None:
+            return
+        if watched is not None:
+            client.watch()
+        else:
+            client.notify_command()
+
+    def read_notifications(self, notifications) -> None:
+        """
+        Called by the event loop when the Pipe of a worker process is
+        readable.
+
+        :param notifications: the receiving end of the Pipe
+        :return: None
+        """
+        while notifications.poll(0):
+            self.dispatch(notifications.recv())
+
+    async def serve(self, s: sk.socket, notifications=None) -> None:
+        """
+        Serves the connections accepted on the given socket forever,
+        along with the HeartbeatMonitor of the connections.
+
+        :param s: the listening socket
+        :param notifications: the receiving end of a Pipe on which new
+            Commands are notified. If None, a CommandNotifier is
+            started in this process.
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        self.monitor = HeartbeatMonitor()
+        monitor = asyncio.ensure_future(self.monitor.run())
+        if notifications is None:
+            CommandNotifier(lambda imei: loop.call_soon_threadsafe(self.dispatch, imei), self.notify_port,
+                            self.dispatch_rate).start()
+        else:
+            loop.add_reader(notifications.fileno(), self.read_notifications, notifications)
+        server = await asyncio.start_server(self.handle_connection, sock=s, limit=self.reader_limit,
+                                            backlog=sk.SOMAXCONN)
+        async with server:
+            await server.serve_forever()
+        monitor.cancel()
+
+    def worker_process(self, s: sk.socket, notifications) -> None:
+        """
+        Entry point of a worker process. The database connections
+        inherited from the parent must not be shared, so they are
+        closed before serving. Everything buffered by the process is
+        written when it is terminated (see exit_on_terminate).
+
+        :param s: the listening socket
+        :param notifications: the receiving end of the Pipe on which
+            new Commands are notified
+        :return: None
+        """
+        from django.db import connections
+
+        connections.close_all()
+        exit_on_terminate()
+        try:
+            asyncio.run(self.serve(s, notifications))
+        finally:
+            shutdown()
+
+    def run(self) -> None:
+        """
+        Sets all the Installations as offline and starts serving.
+
+        :return: None
+        """
+        from appsocketserver import AppSocketServer
+
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "website.settings")
+        django.setup()
+        AppSocketServer.set_all_offline()
+        s = self.create_socket()
+        # The connections are queued by the kernel from now on
+        self.ready.set()
+        self.logger.info(f"Asyncio socket server listening on port {self.port} with {self.workers} worker(s)")
+        feed = UpdateFeed(self.feed_port)
+        if self.workers <= 1:
+            feed.start()
+            asyncio.run(self.serve(s))
+            return
+        from django.db import connections
+
+        # No worker inherits the database connection of this thread
+        connections.close_all()
+        broadcaster = PipeBroadcaster()
+        processes = []
+        for _ in range(self.workers):
+            notifications, sender = Pipe(duplex=False)
+            p = Process(target=self.worker_process, args=(s, notifications))
+            p.daemon = True
+            p.start()
+            notifications.close()
+            broadcaster.add(sender)
+            processes.append(p)
+        # Only once every worker is forked, as a worker forked while
+        # the feed holds a lock of SQLite (e.g. while it loads the live
+        # state) would wait for it forever
+        feed.start()
+        CommandNotifier(broadcaster, self.notify_port, self.dispatch_rate).start()
+        for p in processes:
+            p.join()
@@ -0,0 +1,105 @@
+import time
+
+
+def in_alarm(alarms) -> bool:
+    """
+    :param alarms: The alarms of an installation, as a list of CANbus
+        IDs (see server.encoding.alarm_nodes), or None if unknown
+    :return: True if at least one node is in an alarm state
+    """
+    return bool(alarms)
+
+
+class PollScheduler:
+    """
+    Decides how long a connection waits between two GET_INFO. The
+    interval is:
+
+    - ACTIVE_INTERVAL while the installation is running, has alarms
+      or is being watched on a dashboard (see watch);
+    - IDLE_INTERVAL after a reply with new data;
+    - multiplied by BACKOFF after every NO_UPDATE, up to
+      MAX_INTERVAL, while the installation is idle.
+
+    The wait is interrupted by the notifications of new Commands, so
+    a long interval does not delay commands.
+
+    The scheduler also measures the effective poll rate, i.e. the
+    number of GET_INFO sent per minute, which includes the round trip
+    of every reply (see poll).
+    """
+
+    ACTIVE_INTERVAL = 0.5
+    IDLE_INTERVAL = 1
+    MAX_INTERVAL = 30
+    BACKOFF = 2
+    # Seconds for which an installation is considered watched after
+    # the last notification of a dashboard
+    WATCH_TTL = 30
+    # Weight of the last interval in the average of the poll rate
+    RATE_SMOOTHING = 0.2
+    # Relative change of the poll rate that is worth reporting
+    RATE_CHANGE = 0.1
+
+    def __init__(self):
+        self.interval = self.IDLE_INTERVAL
+        self.watched_until = 0
+        self.last_poll = None
+        self.average_interval = None
+        self.reported_rate = None
+
+    def watch(self) -> bool:
+        """
+        Marks the installation as watched for the next WATCH_TTL
+        seconds.
+
+        :return: True if the installation was not watched already,
+            in which case the current wait should be interrupted.
+        """
+        watched = self.is_watched()
+        self.watched_until = time.monotonic() + self.WATCH_TTL
+        return not watched
+
+    def is_watched(self) -> bool:
+        return time.monotonic() < self.watched_until
+
+    def schedule(self, state: dict, updated: bool) -> float:
+        """
+        Computes the interval before the next GET_INFO.
+
+        :param state: The last known telemetry of the installation
+            (see TelemetryDecoder.state)
+        :param updated: False if the last reply was NO_UPDATE
+        :return: the interval, in seconds
+        """
+        if state.get("running") or in_alarm(state.get("alarms")) or self.is_watched():
+            self.interval = self.ACTIVE_INTERVAL
+        elif updated:
+            self.interval = self.IDLE_INTERVAL
+        else:
+            self.interval = min(max(self.interval, self.IDLE_INTERVAL) * self.BACKOFF, self.MAX_INTERVAL)
+        return self.interval
+
+    def poll(self):
+        """
+        To be called whenever GET_INFO is sent.
+
+        :return: the effective poll rate, in GET_INFO per minute, if
+            it changed by more than RATE_CHANGE since it was last
+            returned, None otherwise.
+        """
+        now = time.monotonic()
+        if self.last_poll is not None:
+            interval = now - self.last_poll
+            if self.average_interval is None:
+                self.average_interval = interval
+            else:
+                self.average_interval += self.RATE_SMOOTHING * (interval - self.average_interval)
+        self.last_poll = now
+        if not self.average_interval:
+            return None
+        rate = 60 / self.average_interval
+        if self.reported_rate is not None and abs(rate - self.reported_rate) <= self.RATE_CHANGE * self.reported_rate:
+            return None
+        self.reported_rate = rate
+        return round(rate, 1)
@@ -1,10 +1,16 @@
-import os
-from threading import Thread
 import time
-import json
-import logging
-import django
+import selectors
 import socket as sk
+from server.framing import MessageBuffer, PIPELINE_FEATURE, PUSH_FEATURE, HEARTBEAT_MESSAGE, command_message, \
+    parse_ack
+from server.telemetry import get_ingestor
+from server.sessions import get_recorder
+from server.encoding import TelemetryDecoder, DELTA_FEATURE
+from server.cadence import PollScheduler
+from server.feed import publish_update
+from server.notify import watch_message
+from server import metrics
+from server.logs import client_logger
 
 
 class ConnectedClient:
@@ -21,10 +27,22 @@ class ConnectedClient:
     Installations and Commands.
     """
 
-    def __init__(self, connection: sk.socket, address):
+    # Seconds after which the command queue is checked even if no
+    # notification has been received (see server.notify)
+    COMMAND_RECHECK_INTERVAL = 10
+    # Maximum number of commands sent at once to a pipelining RPi
+    COMMAND_WINDOW = 8
+    # Seconds of silence after which a pushing RPi sends a heartbeat
+    # (see push_worker)
+    HEARTBEAT_INTERVAL = 30
+    # Seconds within which a pushing RPi must acknowledge the commands
+    COMMAND_ACK_TIMEOUT = 5
+
+    def __init__(self, connection: sk.socket, address, notifications=None):
         """
-        The constructor initializes all the variables and prepares the
-        django ORM, and the logger. Then, it asks the client to
+        The constructor initializes all the variables and the logger.
+        Django must be already set up by the socket server, before
+        forking the process of the client. Then, it asks the client to
         identify itself. If it doesn't identify successfully then
         a ConnectionError is raised, otherwise the installation is
         initialized (and a record created if none was present with the
@@ -38,32 +56,58 @@ class ConnectedClient:
               with the RPi client.
         :param address: The address of the RPi client as returned by
             socket.accept()
+        :param notifications: The child end of a duplex
+            multiprocessing.Pipe on which the IMEI of this RPi is sent
+            whenever it has new Commands (see server.notify). If None,
+            the command queue is checked every second.
         """
-        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "website.settings")
-        django.setup()
         from app.models import Installation, Command
 
         # Initialize parameters
         self.connection = connection
         self.address = address
         self.id = None
-        self.logger = logging.getLogger(f'{__name__}.{self.address}')
+        # Replaced by the logger of the IMEI once identified
+        self.logger = client_logger()
         self.is_command_server = False
         self.Installation = Installation
         self.Command = Command
+        self.buffer = MessageBuffer()
+        self.features = set()
+        self.decoder = TelemetryDecoder()
+        self.ingestor = get_ingestor()
+        self.sessions = get_recorder()
+        # The ConnectionSession of the RPi, and the bytes exchanged
+        self.session = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.scheduler = PollScheduler()
+        self.notifications = notifications
+        self.command_due = True
+        self.last_command_check = 0
+        self.push = False
+        # Commands sent to a pushing RPi and not acknowledged yet
+        self.sent_commands = {}
+        self.acknowledged = set()
+        self.commands_sent_at = 0
 
         # Ask for identity
         if not self.identify():
             raise ConnectionError()
 
         self.initialize_installation()
-        self.raspberry_pi_worker()
-        # If this point is reached, it means the RPi closed the
-        # connection. So the corresponding value must be set
-        # to "offline"
-        i = self.Installation.objects.get(imei=self.id)
-        i.online = False
-        i.save()
+        try:
+            if self.push:
+                self.push_worker()
+            else:
+                self.raspberry_pi_worker()
+        finally:
+            # If this point is reached, it means the RPi closed the
+            # connection, or the worker failed. So the corresponding
+            # value must be set to "offline", before the process
+            # terminates
+            self.sessions.disconnect(self.session, self.id, self.bytes_received, self.bytes_sent)
+            self.sessions.flush()
 
     def send(self, message):
         """
@@ -75,9 +119,11 @@ class ConnectedClient:
         """
         # Encode and send the message
         try:
-            self.logger.debug(f"Sending {message} to {self.address}")
-            data = message.encode()
-            self.connection.send(data)
+            self.logger.debug("Sending %s to %s", message, self.address)
+            data = self.buffer.encode(message)
+            self.connection.sendall(data)
+            self.bytes_sent += len(data)
+            metrics.increment(metrics.SENT_BYTES, len(data), self.id)
         except ConnectionError:
             self.logger.error(f"Could not send data to {self.address}")
             self.connection.close()
@@ -87,75 +133,58 @@ class ConnectedClient:
             self.connection.close()
             raise ConnectionError()
 
-    def receive_thread(self, buffer_size, data):
-        """
-        This function is meant to be used as a separate thread, to
-        implement a reliable timeout for socket.recv. It just calls
-        socket.recv with the specified buffer_size and puts it
-        in to the first position of the given list. If an unknown
-        error happens, the connection is shut down.
-
-        :param buffer_size: The buffer size for the recv call. Usually
-            it's 1024 bytes.
-        :param data: A list. This needs to be a mutable object so
-            that it's synchronized with the parent thread, and it
-            can receive information.
-        :return: None
-        """
-        try:
-            data[0] = self.connection.recv(buffer_size)
-        except ConnectionError or ConnectionAbortedError:
-            pass
-        except:
-            self.logger.error(f"Critical error while receiving data from {self.address}")
-            self.connection.close()
-            raise ConnectionError()
-
-    def receive(self, timeout=0, buffer_size=1024):
+    def receive(self, timeout=0):
         """
-        Listens for data on the connection and decodes it. Optional
-        parameters are timeout and buffer_size, which may be
-        customized to make the function behave as necessary. In
-        order to implement a reliable timeout for socket.recv, the
-        call is wrapped in a thread. If it doesn't return before the
-        timeout mark, then the thread is terminated by closing the
-        connection and the function returns.
-
-        :param timeout: Time in seconds to wait before closing the
-                        connection if no data is sent. Timeout = 0
-                        is default and means no timeout.
-        :param buffer_size: The buffer size in bytes. Default is 1024
-                            and should not be changed unless
-                            necessary.
-        :return:
+        Returns the next message sent by the client. Messages are
+        received in self.buffer, which takes care of the framing:
+        if a previous read already contained the next message, it is
+        returned immediately, otherwise the function reads from the
+        connection until a complete message is received. The timeout
+        is implemented with the native socket timeout, so the function
+        returns as soon as the data arrives. If no complete message is
+        received before the timeout, the connection is closed.
+
+        :param timeout: Time in seconds (fractions are allowed) to
+                        wait before closing the connection if no data
+                        is sent. Timeout = 0 is default and means no
+                        timeout.
+        :return: The decoded message
         """
-        data = [None]
-        rec_thread = Thread(target=self.receive_thread, args=(buffer_size, data))
-        rec_thread.daemon = True
-        rec_thread.start()
-
-        timer = 0
-        if timeout > 0:
-            while timer <= timeout:
-                if not (data[0] is None):
-                    break
-                time.sleep(1)
-                timer += 1
-            if timer > timeout:
+        deadline = time.monotonic() + timeout
+        message = self.buffer.next_message()
+        while message is None:
+            # Until the framing is known, a pause in the data ends the
+            # first message (see MessageBuffer.settle)
+            settling = self.buffer.settling
+            try:
+                wait = max(deadline - time.monotonic(), 0.001) if timeout > 0 else None
+                if settling:
+                    wait = min(wait or MessageBuffer.SETTLE_TIMEOUT, MessageBuffer.SETTLE_TIMEOUT)
+                self.connection.settimeout(wait)
+                size = self.connection.recv_into(self.buffer.writable())
+            except sk.timeout:
+                if settling:
+                    self.buffer.settle()
+                    message = self.buffer.next_message()
+                    continue
                 self.connection.close()
                 raise ConnectionAbortedError()
-        else:
-            rec_thread.join()
-
-        data = data[0]
-        if not data or data is None:
-            self.logger.warning(f"{self.address} closed the connection or did not send anything before timeout")
-            raise ConnectionAbortedError()
-        else:
-            # Data should be an array of bytes!
-            message = data.decode("UTF-8")
-            self.logger.debug(f"{self.address} sent {bytes(message, 'utf-8')}")
-            return message
+            except ConnectionError:
+                size = 0
+            except OSError:
+                self.logger.error(f"Critical error while receiving data from {self.address}")
+                self.connection.close()
+                raise ConnectionError()
+
+            if size == 0:
+                self.logger.warning(f"{self.address} closed the connection or did not send anything before timeout")
+                raise ConnectionAbortedError()
+            self.bytes_received += size
+            metrics.increment(metrics.RECEIVED_BYTES, size, self.id)
+            self.buffer.commit(size)
+            message = self.buffer.next_message()
+        self.logger.debug("%s sent %s", self.address, message)
+        return message
 
     def identify(self):
         """
@@ -164,7 +193,20 @@ class ConnectedClient:
         will return true immediately.
 
         At first "ID_SUPPLICANT" is sent. Then the reply is decoded
-        and assigned to self.id.
+        and assigned to self.id. The IMEI may be followed by ";" and
+        a comma separated list of the optional features supported by
+        the client, which are stored in self.features:
+
+        - DELTA: the client encodes its replies to GET_INFO as deltas
+          (see server.encoding.TelemetryDecoder). The server confirms
+          with "DELTA_OK", only if the reply was terminated by a
+          newline, as a legacy RPi could read it along with the
+          following GET_INFO.
+        - PIPELINE: the client accepts several commands at once (see
+          execute_pending_commands).
+        - PUSH: the client pushes its telemetry instead of being
+          polled (see push_worker). The server confirms with
+          "PUSH_OK <HEARTBEAT_INTERVAL>".
 
         IMPORTANT Note that the IMEI is not perfectly checked.
                 Any string with 15 or more digits will work!
@@ -174,14 +216,25 @@ class ConnectedClient:
         """
         if self.id is not None:
             return True
+        start = time.monotonic()
         # Send a "ID_SUPPLICANT" and use the reply to identify the client
         try:
             self.send("ID_SUPPLICANT")
             # The client has up to one second to respond
-            client_id = self.receive(2)
+            reply = self.receive(2)
+            # The IMEI may be followed by the optional features
+            # supported by the client, e.g. "<IMEI>;DELTA"
+            client_id, _, features = reply.partition(";")
             if client_id.isdigit() and len(client_id) >= 15:
                 self.id = client_id
+                self.features = set(features.split(",")) - {""}
+                self.logger = client_logger(self.id)
                 self.logger.info(f"{self.address} is a Raspberry Pi with IMEI {self.id}.")
+                if DELTA_FEATURE in self.features and self.buffer.framed:
+                    self.send("DELTA_OK")
+                if PUSH_FEATURE in self.features and self.buffer.framed:
+                    self.push = True
+                    self.send(f"PUSH_OK {self.HEARTBEAT_INTERVAL}")
             else:
                 self.logger.error(f"{self.address} tried to identify with an invalid IMEI."
                                   " Closing connection")
@@ -190,6 +243,11 @@ class ConnectedClient:
         except ConnectionError:
             self.logger.warning(f"Could not identify {self.address}.")
             return False
+        if self.notifications is not None:
+            # Only the notifications for this RPi are sent from now on
+            # (see server.notify.PipeRouter)
+            self.notifications.send(self.id)
+        metrics.observe(metrics.HANDSHAKE_SECONDS, time.monotonic() - start)
         return True
 
     def raspberry_pi_worker(self) -> None:
@@ -198,79 +256,299 @@ class ConnectedClient:
         The process is a simple loop:
         a) the server sends "GET_INFO" and waits for the RPi to send
            updated data about its installation. As soon as the
-           server receives that data, it will be used to update the
-           Installation instance. If no data has to be updated, then
-           the server wil wait for a second before going to b).
-
-        b) the server checks the Command instance with the
+           server receives that data, it is handed to the
+           TelemetryIngestor, which updates the Installation in
+           bulk with the other pending updates. The reply is used by
+           the PollScheduler to decide how long to wait before the
+           next GET_INFO: less than a second while the installation
+           is running, in alarm or watched on a dashboard, longer and
+           longer while it is idle and replies NO_UPDATE.
+
+        b) the server checks the Command instances with the
            corresponding IMEI. If there are any commands, they are
-           sent to the client. The command will be considered
+           sent to the client (see execute_pending_commands). The command will be considered
            "executed" only if the client answers with "OK".
            If no commands are found, then the server will
-           wait a second before returning to point a).
+           wait for the interval chosen by the PollScheduler before
+           returning to point a). The wait is
+           interrupted as soon as the socket server is notified of a
+           new command for this RPi, and the database is only
+           checked after such a notification or once every
+           COMMAND_RECHECK_INTERVAL seconds.
+
+        The effective poll rate is published to the UpdateFeed as
+        "poll_rate", in GET_INFO per minute, whenever it changes.
 
         :return:
         """
         while True:
             # Phase a: Update information about installation
             try:
+                poll_rate = self.scheduler.poll()
+                if poll_rate is not None:
+                    publish_update(self.id, poll_rate=poll_rate)
+                start = time.monotonic()
                 self.send("GET_INFO")
                 info = self.receive(5)
+                metrics.observe(metrics.GET_INFO_SECONDS, time.monotonic() - start)
                 # To reduce data usage, we will reply NO_UPDATE or NU (to save data) if
                 # the data sent on the last GET_INFO is still valid
-                if info != "NO_UPDATE" and info != "NU":
-                    info = json.loads(info)
-                    i = self.Installation.objects.get(imei=self.id)
-                    # Only update elements that changed, and were
-                    # included the reply
-                    for key, value in info.items():
-                        setattr(i, key, value)
-                    i.save()
+                updated = info != "NO_UPDATE" and info != "NU"
+                if updated:
+                    # Only elements that changed, and were included in
+                    # the reply, are written by the ingestor
+                    try:
+                        self.ingestor.submit(self.id, self.decode(info))
+                    except ValueError:
+                        self.logger.warning(f"RPi {self.id} sent an invalid reply to GET_INFO: {info}")
+                        updated = False
+                interval = self.scheduler.schedule(self.decoder.state, updated)
             except ConnectionError:
                 self.logger.warning(f"RPi {self.id} did not reply to GET_INFO.")
                 break
             # Phase b) check if the database contains a command for
             # this RPi and execute it
             try:
-                self.logger.debug("Checking command queue for imei {}.".format(self.id))
-                matching_commands = self.Command.objects.filter(imei=self.id)
-                matching_commands_count = matching_commands.count()
-
-                # Command found
-                if matching_commands_count > 0:
-                    matching_command = self.Command.objects.get(imei=self.id)
-                    self.logger.info(matching_command.command_string)
-                    self.send(matching_command.command_string)
-                    message = self.receive(5)
-                    if message == "OK":
-                        self.logger.info(f"{self.id} completed execution of {matching_command.command_string}")
-                        matching_command.delete()
-                else:
-                    # If no commands are found, wait before checking
-                    # again.
-                    time.sleep(1)
+                if not self.command_due:
+                    # Wait before the next GET_INFO, unless a command
+                    # is notified in the meantime
+                    self.command_due = self.wait_for_command(interval)
+                if self.command_due:
+                    self.command_due = self.execute_pending_commands()
             except ConnectionError:
                 self.logger.warning(f"RPi {self.address} did not receive the last command sent or did not reply to it.")
                 print(f"RPi {self.address} did not receive the last command sent or did not reply to it.")
                 break
 
+    def push_worker(self) -> None:
+        """
+        Handles an alive connection with a Raspberry Pi in push mode.
+        GET_INFO is never sent: the RPi sends its data, encoded as a
+        reply to GET_INFO, as soon as it changes, and
+        HEARTBEAT_MESSAGE after HEARTBEAT_INTERVAL seconds without
+        changes. The first message must contain every field. The
+        data is handed to the TelemetryIngestor as in
+        raspberry_pi_worker.
+
+        Commands are sent as soon as they are notified, in the
+        pipelined format (see execute_pending_commands), and their
+        acknowledgements are received along with the data.
+
+        The RPi is considered disconnected if it sends nothing for
+        two heartbeat intervals, or if it does not acknowledge the
+        commands within COMMAND_ACK_TIMEOUT seconds.
+
+        :return: None
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.connection, selectors.EVENT_READ)
+        if self.notifications is not None:
+            selector.register(self.notifications, selectors.EVENT_READ)
+        last_heard = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                if self.sent_commands and now - self.commands_sent_at > self.COMMAND_ACK_TIMEOUT:
+                    self.logger.warning(f"RPi {self.id} did not acknowledge the last commands sent.")
+                    break
+                if not self.sent_commands and (self.command_due or
+                                               now - self.last_command_check >= self.COMMAND_RECHECK_INTERVAL):
+                    self.command_due = False
+                    self.push_pending_commands()
+                message = self.buffer.next_message()
+                if message is None:
+                    if now - last_heard > 2 * self.HEARTBEAT_INTERVAL:
+                        self.logger.warning(f"RPi {self.id} did not send a heartbeat.")
+                        break
+                    for key, _ in selector.select(1):
+                        if key.fileobj is self.connection:
+                            message = self.receive(self.COMMAND_ACK_TIMEOUT)
+                        else:
+                            self.read_notifications(selector)
+                    if message is None:
+                        continue
+                last_heard = time.monotonic()
+                self.handle_pushed_message(message)
+        except ConnectionError:
+            self.logger.warning(f"Lost connection with RPi {self.id}.")
+        finally:
+            selector.close()
+            self.delete_acknowledged_commands()
+
+    def read_notifications(self, selector) -> None:
+        """
+        Reads the pending notifications of new Commands, in push
+        mode.
+
+        :param selector: The selector of push_worker
+        :return: None
+        """
+        try:
+            while self.notifications.poll(0):
+                if self.notifications.recv() == self.id:
+                    self.command_due = True
+        except EOFError:
+            # The socket server is not notifying anymore
+            selector.unregister(self.notifications)
+            self.notifications = None
+
+    def push_pending_commands(self) -> None:
+        """
+        Sends the Commands queued for this RPi, if any, without
+        waiting for their acknowledgements (see
+        handle_pushed_message).
+
+        :return: None
+        """
+        self.last_command_check = time.monotonic()
+        commands = list(self.Command.objects.filter(imei=self.id)[:self.COMMAND_WINDOW])
+        for command in commands:
+            self.logger.info(command.command_string)
+            self.send(command_message(command.id, command.command_string))
+        self.sent_commands = {command.id: command.created for command in commands}
+        self.commands_sent_at = time.monotonic()
+
+    def handle_pushed_message(self, message: str) -> None:
+        """
+        Handles a message received in push mode: a heartbeat, the
+        acknowledgement of a command, or new data.
+
+        :param message: The message received
+        :return: None
+        """
+        if message == HEARTBEAT_MESSAGE:
+            return
+        command_id = parse_ack(message)
+        if command_id is not None:
+            if command_id in self.sent_commands:
+                self.acknowledged.add(command_id)
+            if self.sent_commands and self.acknowledged == self.sent_commands.keys():
+                self.delete_acknowledged_commands()
+                # More commands may be queued
+                self.command_due = True
+            return
+        try:
+            self.ingestor.submit(self.id, self.decode(message))
+        except ValueError:
+            self.logger.warning(f"RPi {self.id} pushed an invalid message: {message}")
+
+    def delete_acknowledged_commands(self) -> None:
+        """
+        Removes the commands acknowledged by a pushing RPi from the
+        queue.
+
+        :return: None
+        """
+        if self.acknowledged:
+            self.logger.info(f"{self.id} completed execution of {len(self.acknowledged)} of "
+                             f"{len(self.sent_commands)} commands")
+            for command_id in self.acknowledged:
+                metrics.observe_command_latency(self.sent_commands[command_id])
+            self.Command.objects.delete_executed(self.id, self.acknowledged)
+        self.sent_commands = {}
+        self.acknowledged = set()
+
+    def wait_for_command(self, timeout) -> bool:
+        """
+        Waits up to timeout seconds for a notification of a new
+        Command for this RPi. Notifications for other RPis are
+        discarded. A notification that the installation is shown on a
+        dashboard ends the wait, if it was not watched already, so
+        that idle installations are polled right away.
+
+        :param timeout: Time in seconds to wait
+        :return: True if the command queue should be checked, False
+            otherwise.
+        """
+        if self.notifications is None:
+            time.sleep(timeout)
+            return True
+        deadline = time.monotonic() + timeout
+        try:
+            while self.notifications.poll(max(deadline - time.monotonic(), 0)):
+                message = self.notifications.recv()
+                if message == self.id:
+                    return True
+                if message == watch_message(self.id) and self.scheduler.watch():
+                    deadline = time.monotonic()
+        except EOFError:
+            # The socket server is not notifying anymore
+            self.notifications = None
+        if time.monotonic() < deadline:
+            time.sleep(deadline - time.monotonic())
+        return time.monotonic() - self.last_command_check >= self.COMMAND_RECHECK_INTERVAL
+
+    def execute_pending_commands(self) -> bool:
+        """
+        Sends the Commands queued for this RPi, if any, in order.
+        A command will be considered "executed" only if the client
+        answers with "OK", in which case it is removed from the
+        database.
+
+        RPis that advertised the PIPELINE feature receive up to
+        COMMAND_WINDOW commands at once, each one as
+        "CMD <id> <command>", and acknowledge each one with
+        "OK <id>", so a burst of commands costs a single round trip.
+        Other RPis receive one command at a time.
+
+        :return: True if a command was found, False otherwise
+        """
+        self.logger.debug("Checking command queue for imei {}.".format(self.id))
+        self.last_command_check = time.monotonic()
+        if PIPELINE_FEATURE not in self.features or not self.buffer.framed:
+            matching_command = self.Command.objects.filter(imei=self.id).first()
+            if matching_command is None:
+                return False
+            self.logger.info(matching_command.command_string)
+            self.send(matching_command.command_string)
+            message = self.receive(5)
+            if message == "OK":
+                self.logger.info(f"{self.id} completed execution of {matching_command.command_string}")
+                metrics.observe_command_latency(matching_command.created)
+                self.Command.objects.delete_executed(self.id, [matching_command.id])
+            return True
+
+        commands = list(self.Command.objects.filter(imei=self.id)[:self.COMMAND_WINDOW])
+        if not commands:
+            return False
+        for command in commands:
+            self.logger.info(command.command_string)
+            self.send(command_message(command.id, command.command_string))
+        acknowledged = set()
+        for _ in commands:
+            command_id = parse_ack(self.receive(5))
+            if command_id is not None:
+                acknowledged.add(command_id)
+        self.logger.info(f"{self.id} completed execution of {len(acknowledged)} of {len(commands)} commands")
+        for command in commands:
+            if command.id in acknowledged:
+                metrics.observe_command_latency(command.created)
+        self.Command.objects.delete_executed(self.id, acknowledged)
+        return True
+
+    def decode(self, message: str) -> dict:
+        """
+        Decodes a reply to GET_INFO, recording the time spent.
+
+        :param message: The reply
+        :return: the decoded reply (see TelemetryDecoder.decode)
+        """
+        start = time.monotonic()
+        try:
+            return self.decoder.decode(message)
+        finally:
+            metrics.observe(metrics.DECODE_SECONDS, time.monotonic() - start)
+
     def initialize_installation(self) -> None:
         """
         Set the Installation with the given IMEI as online. If no
         Installation with such IMEI exists, create a new one first.
+        Both are written in bulk with the other connections (see
+        server.sessions.SessionRecorder).
 
         :return: None
         """
-        # If the given ID (IMEI) exists in the database,
-        # just set the Installation to appear as "online",
-        # else create a new record.
-        matching_installations = self.Installation.objects.filter(imei=self.id)
-        if matching_installations.count() == 0:
-            i = self.Installation(imei=self.id, online=True)
-        else:
-            i = self.Installation.objects.get(imei=self.id)
-            i.online = True
-        i.save()
+        self.session = self.sessions.connect(self.id, self.address)
 
 
 
@@ -0,0 +1,49 @@
+def database_sync_to_async(func):
+    """
+    Wraps a function that uses the django ORM so that it can be
+    awaited from an event loop. The function always runs in the same
+    thread, whatever the version of asgiref, so that every event loop
+    of the socket server uses a single persistent database connection
+    (see settings.DATABASES), whatever the number of RPis it serves.
+
+    :param func: The synchronous function
+    :return: the awaitable function
+    """
+    from asgiref.sync import sync_to_async
+
+    return sync_to_async(func, thread_sensitive=True)
+
+
+def close_stale_connections() -> None:
+    """
+    Closes the database connections of the current thread that are
+    broken or older than CONN_MAX_AGE, so that they are reopened on
+    the next query. Django only does it between two requests, so the
+    long-lived threads of the socket server must call this from time
+    to time.
+
+    :return: None
+    """
+    from django.db import close_old_connections
+
+    close_old_connections()
+
+
+def enable_wal() -> None:
+    """
+    Switches a SQLite database to WAL mode, in which readers never
+    block the writer, if settings.DATABASE_WAL is set. The mode is
+    stored in the database file, so this is done once by the socket
+    server (see manage.py runsocketserver) instead of on every
+    connection.
+
+    :return: None
+    """
+    from django.conf import settings
+    from django.db import connection
+
+    if connection.vendor == "sqlite" and getattr(settings, "DATABASE_WAL", False):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        # Not inherited by the processes forked by the server
+        connection.close()
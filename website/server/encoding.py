@@ -0,0 +1,152 @@
+import json
+
+# The telemetry fields of the compact encoding. The ID of a field is
+# its index, so new fields must only be appended.
+TELEMETRY_FIELDS = (
+    ("inlet_pressure", int),
+    ("inlet_temperature", int),
+    ("outlet_pressure", int),
+    ("outlet_pressure_target", int),
+    ("working_hours_counter", int),
+    ("working_minutes_counter", int),
+    ("anti_drip", bool),
+    ("start_code", str),
+    ("alarms", list),
+    ("speed", int),
+    ("bk_service", bool),
+    ("tl_service", bool),
+    ("rb_service", bool),
+    ("run", bool),
+    ("running", bool),
+)
+
+# Feature advertised by the RPis that support the delta encoding
+DELTA_FEATURE = "DELTA"
+
+# Prefix of the replies encoded as deltas
+DELTA_PREFIX = "D"
+
+
+def decode_value(kind, value: str):
+    """
+    Decodes the value of a field of a delta.
+
+    :param kind: The type of the field (see TELEMETRY_FIELDS)
+    :param value: The encoded value
+    :return: The value, as stored in the Installation
+    :raise ValueError: if the value is malformed
+    """
+    if kind is bool:
+        if value not in ("0", "1"):
+            raise ValueError(f"Malformed boolean {value!r}")
+        return value == "1"
+    if kind is int:
+        return int(value)
+    if kind is list:
+        # A comma separated list of CANbus IDs
+        return alarm_nodes([i for i in value.split(",") if i])
+    return value
+
+
+def alarm_nodes(value) -> list:
+    """
+    Normalizes the alarms sent by a RPi, so that they can be compared
+    and stored as Alarms.
+
+    :param value: A list of CANbus IDs, or the same list as a JSON
+        string
+    :return: the sorted list of the distinct CANbus IDs
+    :raise ValueError: if the value is malformed
+    """
+    if isinstance(value, str):
+        value = json.loads(value)
+    if not isinstance(value, list):
+        raise ValueError("Alarms are not a list")
+    try:
+        return sorted({int(node) for node in value})
+    except TypeError:
+        raise ValueError("Alarms are not a list of CANbus IDs")
+
+
+def encode_delta(fields: dict) -> str:
+    """
+    Encodes the given telemetry fields as a delta. This is the
+    encoding used by the RPis, and it is provided here as a reference
+    and for testing.
+
+    :param fields: The fields to encode
+    :return: the encoded delta
+    """
+    items = []
+    for field_id, (name, kind) in enumerate(TELEMETRY_FIELDS):
+        if name not in fields:
+            continue
+        value = fields[name]
+        if kind is bool:
+            value = "1" if value else "0"
+        elif kind is list:
+            value = ",".join(str(i) for i in value)
+        items.append(f"{field_id}={value}")
+    return DELTA_PREFIX + ";".join(items)
+
+
+class TelemetryDecoder:
+    """
+    Decodes the replies to GET_INFO of a connection. Two encodings are
+    supported:
+
+    - JSON: an object with the fields that changed, e.g.
+      {"speed": 1500, "running": true}. This is the default.
+
+    - Delta: for the RPis that advertised the DELTA feature during
+      the identification (see ConnectedClient.identify). A reply is
+      "D" followed by the fields that changed since the previous
+      reply, separated by ";", each one as <field ID>=<value>, e.g.
+      "D9=1500;14=1". Booleans are 0 or 1 and alarms are a comma
+      separated list of CANbus IDs.
+
+    In both encodings the alarms are decoded as the sorted list of
+    the CANbus IDs of the nodes in an alarm state (see alarm_nodes).
+
+    The decoder keeps the last state received on the connection, so
+    that only the fields whose value actually changed are returned.
+    The state starts empty on every connection, so the first reply
+    must contain every field.
+    """
+
+    def __init__(self):
+        self.state = {}
+
+    def decode(self, message: str) -> dict:
+        """
+        Decodes a reply to GET_INFO, other than NO_UPDATE.
+
+        :param message: The reply
+        :return: a dictionary with the fields that changed
+        :raise ValueError: if the reply is malformed
+        """
+        if message.startswith(DELTA_PREFIX):
+            fields = {}
+            for item in message[len(DELTA_PREFIX):].split(";"):
+                if not item:
+                    continue
+                field_id, separator, value = item.partition("=")
+                # int would also accept a sign, and a negative index
+                # would select a field from the end
+                if not separator or not field_id.isdecimal():
+                    raise ValueError(f"Malformed delta item {item!r}")
+                try:
+                    name, kind = TELEMETRY_FIELDS[int(field_id)]
+                except IndexError:
+                    raise ValueError(f"Unknown field ID {field_id}")
+                fields[name] = decode_value(kind, value)
+        else:
+            fields = json.loads(message)
+            if not isinstance(fields, dict):
+                raise ValueError("GET_INFO reply is not a JSON object")
+            if "alarms" in fields:
+                fields["alarms"] = alarm_nodes(fields["alarms"])
+        changed = {key: value for key, value in fields.items()
+                   if key not in self.state or self.state[key] != value}
+        self.state.update(changed)
+        return changed
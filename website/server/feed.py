@@ -0,0 +1,270 @@
+import json
+import logging
+import selectors
+import socket as sk
+import time
+from threading import Thread
+from server.livestate import LiveState
+from server.metrics import MetricsStore
+from server.alarms import AlarmBus, configured_subscribers
+
+# Default port of the feed. The same number is used for the UDP
+# socket receiving the updates and for the TCP socket serving them.
+FEED_PORT = 37865
+
+# Maximum number of updates sent in a single datagram
+UPDATES_PER_DATAGRAM = 50
+
+# Default seconds between two reloads of the LiveState
+RELOAD_INTERVAL = 60
+
+
+def publish_updates(updates, seen=False) -> None:
+    """
+    Publishes the changes of some Installations to the UpdateFeed of
+    the socket server, which forwards them to every subscriber (e.g.
+    the dashboards). Every update is a dictionary with the IMEI of the
+    Installation and the fields that changed, e.g.
+    {"imei": "...", "online": True}. Updates are sent as UDP
+    datagrams, so publishing never blocks.
+
+    :param updates: A list of dictionaries
+    :param seen: True if the updates were received from the RPis
+        (see LiveState.update)
+    :return: None
+    """
+    from django.conf import settings
+
+    port = getattr(settings, "SOCKET_SERVER_FEED_PORT", FEED_PORT)
+    try:
+        with sk.socket(sk.AF_INET, sk.SOCK_DGRAM) as s:
+            for i in range(0, len(updates), UPDATES_PER_DATAGRAM):
+                data = json.dumps({"seen": seen, "updates": updates[i:i + UPDATES_PER_DATAGRAM]},
+                                  separators=(",", ":"), default=str)
+                s.sendto(data.encode(), ("127.0.0.1", port))
+    except OSError:
+        logging.getLogger(__name__).debug("Could not publish updates to the feed")
+
+
+def publish_update(imei: str, **fields) -> None:
+    """
+    Shortcut for publish_updates with a single Installation.
+
+    :param imei: The IMEI of the Installation that changed
+    :param fields: The fields that changed, with their new value
+    :return: None
+    """
+    publish_updates([dict(fields, imei=imei)])
+
+
+def subscribe(port=FEED_PORT, timeout=None):
+    """
+    Connects to the UpdateFeed and yields the lists of updates
+    published, and the alarm events as {"alarm": <event>}, as JSON
+    strings. When timeout is given, None is
+    yielded every timeout seconds without updates, so that the
+    caller can check that its own client is still alive.
+
+    :param port: The port of the feed
+    :param timeout: Seconds after which None is yielded
+    :return: a generator of JSON strings
+    """
+    with sk.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(b"SUBSCRIBE\n")
+        s.settimeout(timeout)
+        f = s.makefile("rb")
+        while True:
+            try:
+                line = f.readline()
+            except sk.timeout:
+                yield None
+                continue
+            if not line:
+                return
+            yield line.decode("UTF-8").rstrip("\n")
+
+
+class UpdateFeed(Thread):
+    """
+    The hub between the processes that change Installations and the
+    ones that display them. Updates are received as UDP datagrams
+    (see publish_updates) from any process, and forwarded, one JSON
+    line per datagram, to every client connected to the TCP socket
+    on the same port (see subscribe).
+
+    Subscribers that can not keep up are disconnected, so a slow
+    dashboard never delays the others.
+
+    The feed also keeps the LiveState of the installations, loaded
+    from the database at startup and kept up to date with the updates
+    it receives. As datagrams can be lost, the LiveState is also
+    reloaded from the database every reload_interval seconds. Every
+    client of the TCP socket sends a request line:
+    "SUBSCRIBE" to receive the updates, "GET" followed by the
+    JSON arguments of LiveState.snapshot to receive a snapshot (see
+    server.livestate.get_live_state), or "METRICS" to receive the
+    metrics of the socket server (see server.metrics.get_metrics).
+
+    The metrics are published by the processes of the socket server
+    on the same UDP socket as the updates, and added up in a
+    MetricsStore. So are the alarm events (see
+    server.alarms.publish_alarm_events), which are delivered by an
+    AlarmBus: to the subscribers of the feed, as a JSON object
+    {"alarm": <event>} instead of a list of updates, and to the
+    webhook and the email spool enabled in the settings.
+    """
+
+    def __init__(self, port=FEED_PORT, reload_interval=None):
+        """
+        :param port: The local port of the feed
+        :param reload_interval: Seconds between two reloads of the
+            LiveState. Defaults to
+            settings.SOCKET_SERVER_FEED_RELOAD_INTERVAL.
+        """
+        from django.conf import settings
+
+        super(UpdateFeed, self).__init__()
+        self.daemon = True
+        self.port = port
+        if reload_interval is None:
+            reload_interval = getattr(settings, "SOCKET_SERVER_FEED_RELOAD_INTERVAL", RELOAD_INTERVAL)
+        self.reload_interval = reload_interval
+        self.subscribers = []
+        self.state = LiveState()
+        self.metrics = MetricsStore()
+        self.alarms = None
+        self.logger = logging.getLogger(__name__)
+
+    def load_state(self) -> None:
+        """
+        Loads the LiveState from the database.
+
+        :return: None
+        """
+        from app.models import Installation, Command, Alarm
+        from server.database import close_stale_connections
+
+        close_stale_connections()
+        updated = self.state.load(Installation.objects.values(*Installation.SNAPSHOT_FIELDS),
+                                  set(Command.objects.values_list("imei", flat=True)),
+                                  Alarm.objects.active().nodes_by_imei())
+        self.logger.debug(f"Reloaded {updated} installations of the live state")
+
+    def run(self) -> None:
+        selector = selectors.DefaultSelector()
+        updates = sk.socket(sk.AF_INET, sk.SOCK_DGRAM)
+        listener = sk.socket(sk.AF_INET, sk.SOCK_STREAM)
+        try:
+            updates.bind(("127.0.0.1", self.port))
+            listener.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEADDR, 1)
+            listener.bind(("127.0.0.1", self.port))
+            listener.listen()
+        except OSError:
+            self.logger.error(f"Could not start the update feed on port {self.port}.")
+            updates.close()
+            listener.close()
+            return
+        self.alarms = AlarmBus([self.broadcast_alarm] + configured_subscribers())
+        selector.register(updates, selectors.EVENT_READ)
+        selector.register(listener, selectors.EVENT_READ)
+        self.logger.info(f"Update feed listening on port {self.port}")
+        next_reload = 0
+        while True:
+            try:
+                if time.monotonic() >= next_reload:
+                    next_reload = time.monotonic() + self.reload_interval
+                    self.load_state()
+                # The alarm events delayed by the rate limit are
+                # delivered at least once per second
+                self.alarms.tick()
+            except Exception:
+                self.logger.exception("Could not reload the live state or deliver the alarms")
+            for key, _ in selector.select(1):
+                if key.fileobj is listener:
+                    client, _ = listener.accept()
+                    client.settimeout(0.1)
+                    self.handle_request(client)
+                else:
+                    data, _ = updates.recvfrom(2 ** 16)
+                    self.handle_datagram(data)
+
+    def handle_datagram(self, data: bytes) -> None:
+        """
+        Handles a datagram received on the UDP socket. An invalid
+        datagram is logged and discarded.
+
+        :param data: The datagram
+        :return: None
+        """
+        try:
+            message = json.loads(data)
+            if "metrics" in message:
+                self.metrics.add(message["metrics"])
+            elif "alarms" in message:
+                self.alarms.publish(message["alarms"])
+            else:
+                self.apply(message)
+        except Exception:
+            self.logger.exception(f"Could not handle the datagram {data[:100]!r}")
+
+    def handle_request(self, client: sk.socket) -> None:
+        """
+        Reads the request line of a new client and serves it.
+
+        :param client: The socket of the client
+        :return: None
+        """
+        try:
+            with client.makefile("rb") as f:
+                request = f.readline().decode("UTF-8").strip()
+            if request == "SUBSCRIBE":
+                self.subscribers.append(client)
+                return
+            if request.startswith("GET "):
+                snapshot = self.state.snapshot(**json.loads(request[4:]))
+                client.sendall(json.dumps(snapshot, separators=(",", ":")).encode() + b"\n")
+            if request == "METRICS":
+                client.sendall(self.metrics.render().encode())
+        except (OSError, ValueError, TypeError):
+            pass
+        client.close()
+
+    def apply(self, message: dict) -> None:
+        """
+        Applies the updates of a datagram to the LiveState and
+        forwards them to the subscribers.
+
+        :param message: The decoded datagram (see publish_updates)
+        :return: None
+        """
+        for update in message["updates"]:
+            fields = {key: value for key, value in update.items() if key != "imei"}
+            self.state.update(update["imei"], fields, message["seen"])
+        self.broadcast(json.dumps(message["updates"], separators=(",", ":")).encode() + b"\n")
+
+    def broadcast_alarm(self, event: dict) -> None:
+        """
+        Subscriber of the AlarmBus that forwards the alarm events to
+        the subscribers of the feed.
+
+        :param event: The alarm event
+        :return: None
+        """
+        self.broadcast(json.dumps({"alarm": event}, separators=(",", ":")).encode() + b"\n")
+
+    def broadcast(self, data: bytes) -> None:
+        """
+        Sends data to every subscriber, dropping the ones that closed
+        the connection or are too slow.
+
+        :param data: The line to send
+        :return: None
+        """
+        alive = []
+        for subscriber in self.subscribers:
+            try:
+                subscriber.sendall(data)
+                alive.append(subscriber)
+            except OSError:
+                subscriber.close()
+        self.subscribers = alive
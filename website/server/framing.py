@@ -0,0 +1,204 @@
+class MessageBuffer:
+    """
+    A persistent receive buffer that splits the byte stream of a
+    connection into messages. Every message is terminated by
+    DELIMITER ("\\n"), so a big GET_INFO reply may span several reads
+    and several messages may be returned by a single read.
+
+    The buffer is a bytearray: data is received directly into it (see
+    MessageBuffer.writable) and messages are decoded from a memoryview
+    of it, so no intermediate bytes objects are created. It starts
+    small, as most messages are, and grows up to max_size, the
+    maximum size of a message, which bounds the memory used by every
+    connection. Once a big message is consumed it shrinks back.
+
+    Older RPis do not terminate their messages. The framing is
+    therefore detected on the first message received (the reply to
+    ID_SUPPLICANT): the connection is framed as soon as the delimiter
+    is received. As the reply may span several reads, the buffer only
+    falls back to the legacy behaviour, where every read is a whole
+    message, when the receiver calls settle because no more data
+    arrived within SETTLE_TIMEOUT seconds.
+    """
+
+    DELIMITER = b"\n"
+
+    # Seconds without data after which an unterminated reply to
+    # ID_SUPPLICANT is considered complete (see settle)
+    SETTLE_TIMEOUT = 0.2
+
+    def __init__(self, size=2 ** 12, max_size=2 ** 16):
+        """
+        :param size: The initial size of the buffer in bytes.
+        :param max_size: The maximum size of the buffer in bytes,
+            i.e. the maximum length of a message.
+        """
+        self.size = size
+        self.max_size = max_size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # None until the first message is received
+        self.framed = None
+
+    @property
+    def settling(self) -> bool:
+        """
+        :return: True if part of the first message was received, but
+            the framing is not known yet (see settle)
+        """
+        return self.framed is None and self.end > self.start
+
+    def settle(self) -> None:
+        """
+        To be called when no data was received for SETTLE_TIMEOUT
+        seconds while settling: the first message was not terminated,
+        so the connection is not framed.
+
+        :return: None
+        """
+        if self.settling:
+            self.framed = False
+
+    def resize(self, size: int) -> None:
+        """
+        Moves the pending data to a new buffer of the given size.
+
+        :param size: The new size in bytes
+        :return: None
+        """
+        pending = self.end - self.start
+        buffer = bytearray(size)
+        buffer[:pending] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+    def writable(self) -> memoryview:
+        """
+        Returns the free part of the buffer, to be passed to
+        socket.recv_into. Any data already consumed is discarded to
+        make room for the new one. Call MessageBuffer.commit with the
+        number of bytes written.
+
+        :return: a memoryview of the free part of the buffer
+        """
+        if self.start > 0:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if self.end == len(self.buffer):
+            if len(self.buffer) >= self.max_size:
+                raise ConnectionError("Message exceeds the size of the receive buffer")
+            self.resize(min(len(self.buffer) * 2, self.max_size))
+        return self.view[self.end:]
+
+    def commit(self, size: int) -> None:
+        """
+        Marks size bytes of the view returned by writable() as
+        received.
+
+        :param size: The number of bytes received
+        :return: None
+        """
+        self.end += size
+
+    def feed(self, data: bytes) -> None:
+        """
+        Copies the given data in the buffer. This is meant for
+        transports that do not support recv_into, e.g. asyncio
+        streams.
+
+        :param data: The bytes received
+        :return: None
+        """
+        data = memoryview(data)
+        while data:
+            free = self.writable()
+            size = min(len(free), len(data))
+            free[:size] = data[:size]
+            self.commit(size)
+            data = data[size:]
+
+    def next_message(self):
+        """
+        Extracts the next complete message from the buffer.
+
+        :return: The decoded message, or None if no complete message
+            has been received yet.
+        """
+        if self.start == self.end:
+            return None
+        if self.framed is None:
+            if self.buffer.find(self.DELIMITER, self.start, self.end) == -1:
+                return None
+            self.framed = True
+        if self.framed:
+            index = self.buffer.find(self.DELIMITER, self.start, self.end)
+            if index == -1:
+                return None
+            message = str(self.view[self.start:index], "UTF-8")
+            self.start = index + len(self.DELIMITER)
+        else:
+            message = str(self.view[self.start:self.end], "UTF-8")
+            self.start = self.end
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size:
+                self.resize(self.size)
+        return message
+
+    def encode(self, message: str) -> bytes:
+        """
+        Encodes a message to be sent on the connection, terminating it
+        if the connection is framed.
+
+        :param message: The message to encode
+        :return: the encoded message
+        """
+        data = message.encode()
+        if self.framed:
+            data += self.DELIMITER
+        return data
+
+
+# Feature advertised by the RPis that accept several commands at once
+# (see ConnectedClient.execute_pending_commands). It requires framing.
+PIPELINE_FEATURE = "PIPELINE"
+
+
+def command_message(command_id: int, command_string: str) -> str:
+    """
+    :param command_id: The ID of the Command
+    :param command_string: The command
+    :return: the message sending the command to a pipelining RPi
+    """
+    return f"CMD {command_id} {command_string}"
+
+
+def parse_ack(message: str):
+    """
+    Parses the acknowledgement of a command sent with
+    command_message, i.e. "OK <command ID>".
+
+    :param message: The message received
+    :return: the ID of the acknowledged Command, or None if the
+        message is not an acknowledgement
+    """
+    status, _, command_id = message.partition(" ")
+    if status != "OK" or not command_id.isdigit():
+        return None
+    return int(command_id)
+
+
+# Feature advertised by the RPis that push their telemetry instead of
+# being polled with GET_INFO (see ConnectedClient.push_worker). It
+# requires framing.
+PUSH_FEATURE = "PUSH"
+
+# Message sent by a pushing RPi when it had nothing to push for the
+# heartbeat interval given by the server with "PUSH_OK <seconds>"
+HEARTBEAT_MESSAGE = "HB"
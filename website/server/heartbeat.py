@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import socket as sk
+import time
+from server.database import database_sync_to_async, close_stale_connections
+from server import metrics
+
+# TCP keepalive settings of the connections with the RPis: the first
+# probe is sent after KEEPALIVE_IDLE seconds of silence, then every
+# KEEPALIVE_INTERVAL seconds, and the connection is dropped by the
+# kernel after KEEPALIVE_COUNT unanswered probes
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+def configure_keepalive(connection) -> None:
+    """
+    Enables TCP keepalive on the connection with a RPi, so that a
+    half-open connection (e.g. a RPi that lost the GSM signal) makes
+    the pending reads fail within about two minutes, even while the
+    server is not waiting for a reply. The options that the platform
+    does not support are skipped.
+
+    :param connection: The socket of the connection
+    :return: None
+    """
+    connection.setsockopt(sk.SOL_SOCKET, sk.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                          ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(sk, option):
+            connection.setsockopt(sk.IPPROTO_TCP, getattr(sk, option), value)
+
+
+class TimerWheel:
+    """
+    A hashed timing wheel: the deadlines are kept in a circular list
+    of slots, one for every tick, so that scheduling, rescheduling
+    and cancelling a deadline take constant time whatever the number
+    of connections, and expiring them only looks at the slots of the
+    ticks elapsed. A deadline further than a whole turn of the wheel
+    stays in its slot until the right turn.
+    """
+
+    def __init__(self, now: float, tick=1.0, slots=64):
+        """
+        :param now: The current time
+        :param tick: The resolution of the wheel, in seconds
+        :param slots: The number of slots
+        """
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}
+        self.current = int(now // tick)
+
+    def slot(self, deadline: float) -> set:
+        return self.slots[int(deadline // self.tick) % len(self.slots)]
+
+    def schedule(self, key, deadline: float) -> None:
+        """
+        Schedules, or reschedules, the deadline of key.
+
+        :param key: Any hashable object
+        :param deadline: The time at which key expires
+        :return: None
+        """
+        self.cancel(key)
+        self.deadlines[key] = deadline
+        self.slot(deadline).add(key)
+
+    def cancel(self, key) -> None:
+        """
+        :param key: A key scheduled with schedule, or any other object
+        :return: None
+        """
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self.slot(deadline).discard(key)
+
+    def expire(self, now: float) -> list:
+        """
+        Removes the keys whose deadline is past.
+
+        :param now: The current time
+        :return: the expired keys
+        """
+        tick = int(now // self.tick)
+        expired = []
+        for t in range(self.current, min(tick, self.current + len(self.slots) - 1) + 1):
+            slot = self.slots[t % len(self.slots)]
+            for key in [key for key in slot if self.deadlines[key] <= now]:
+                slot.discard(key)
+                del self.deadlines[key]
+                expired.append(key)
+        self.current = tick
+        return expired
+
+
+class HeartbeatMonitor:
+    """
+    Detects the dead connections of an AsyncAppSocketServer worker.
+
+    Instead of wrapping every read in its own timeout, a client
+    registers the deadline of the message it is waiting for with
+    expect, and clears it with received: both are a constant time
+    operation on a TimerWheel. Once per tick the monitor aborts the
+    connections whose deadline is past, which ends their pending
+    read. The peer is then considered dead: for polled RPis the reply
+    to GET_INFO acts as a ping frame, for pushing RPis the heartbeat
+    does.
+
+    The Installations of the closed connections are set offline in
+    batches by the SessionRecorder (see server.sessions). Every tick
+    closes the database connection of the event loop if it is stale,
+    and publishes the metrics recorded by the event loop (see
+    server.metrics).
+    """
+
+    def __init__(self, tick=1.0):
+        """
+        :param tick: The resolution of the deadlines, in seconds
+        """
+        self.tick = tick
+        self.wheel = TimerWheel(time.monotonic(), tick)
+        self.logger = logging.getLogger(__name__)
+
+    def expect(self, client, timeout: float) -> None:
+        """
+        :param client: An AsyncConnectedClient waiting for a message
+        :param timeout: Seconds after which the connection is aborted
+            if the message is not received
+        :return: None
+        """
+        self.wheel.schedule(client, time.monotonic() + timeout)
+
+    def received(self, client) -> None:
+        """
+        :param client: An AsyncConnectedClient that received the
+            message it was waiting for
+        :return: None
+        """
+        self.wheel.cancel(client)
+
+    async def run(self) -> None:
+        """
+        Aborts the expired connections once per tick, forever.
+
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(self.tick)
+            for client in self.wheel.expire(time.monotonic()):
+                self.logger.warning(f"RPi {client.id} at {client.address} did not reply in time.")
+                client.writer.transport.abort()
+            await database_sync_to_async(close_stale_connections)()
+            metrics.publish()
@@ -0,0 +1,132 @@
+import json
+import socket as sk
+import time
+
+_missing = object()
+
+
+class LiveState:
+    """
+    The live state of the installations, by IMEI: the fields shown on
+    the dashboard, including whether they are online, their latest
+    telemetry, whether a command is pending and when they were last
+    seen by the socket server. It is kept by the UpdateFeed, which
+    applies every update it receives, and read by the views through
+    get_live_state.
+
+    Every update increments a version number, which is also stored in
+    the entries it changed. Readers pass the version they last saw
+    and only receive the entries changed since then: if nothing
+    changed they receive no entry at all. The version is prefixed with
+    an epoch, the startup time, so that versions seen before a restart
+    are never mistaken for recent ones.
+    """
+
+    def __init__(self):
+        self.epoch = str(int(time.time()))
+        self.version = 0
+        self.entries = {}
+
+    def load(self, installations, pending, alarms) -> int:
+        """
+        Initializes the state from the database, or brings it back in
+        line with the database. Only the entries that differ from it
+        are updated, so that a reload does not send every installation
+        to the readers again. The entries of the Installations deleted
+        from the database are removed.
+
+        :param installations: An iterable of dictionaries with the
+            fields of every Installation
+        :param pending: The set of IMEIs with a pending Command
+        :param alarms: The CANbus IDs of the nodes in an alarm state,
+            by IMEI (see AlarmQuerySet.nodes_by_imei)
+        :return: the number of entries updated or removed
+        """
+        updated = 0
+        loaded = set()
+        for installation in installations:
+            imei = installation["imei"]
+            loaded.add(imei)
+            fields = dict(installation, command_pending=imei in pending, alarms=alarms.get(imei, []))
+            entry = self.entries.get(imei, {})
+            changed = {key: value for key, value in fields.items() if entry.get(key, _missing) != value}
+            if changed:
+                self.update(imei, changed)
+                updated += 1
+        # Only the entries loaded from the database have an id: the
+        # ones of RPis whose Installation is not created yet are kept
+        for imei in [imei for imei, entry in self.entries.items() if "id" in entry and imei not in loaded]:
+            del self.entries[imei]
+            updated += 1
+        return updated
+
+    def update(self, imei: str, fields: dict, seen=False) -> None:
+        """
+        Applies an update to the entry of the given IMEI.
+
+        :param imei: The IMEI of the installation
+        :param fields: The fields that changed, with their new value
+        :param seen: True if the update comes from the RPi, in which
+            case the last seen time is updated too.
+        :return: None
+        """
+        self.version += 1
+        entry = self.entries.setdefault(imei, {"imei": imei, "command_pending": False, "alarms": [],
+                                               "last_seen": None})
+        entry.update(fields)
+        entry["version"] = self.version
+        if seen:
+            entry["last_seen"] = time.time()
+
+    def snapshot(self, since="", imei=None) -> dict:
+        """
+        :param since: The version returned by a previous snapshot, or
+            an empty string
+        :param imei: If given, only the entry of this IMEI is
+            considered.
+        :return: a dictionary with the current version and the list
+            of the entries changed since the given version
+        """
+        epoch, _, version = since.partition("-")
+        if epoch != self.epoch or not version.isdigit():
+            version = 0
+        version = int(version)
+        if imei is not None:
+            entries = [self.entries[imei]] if imei in self.entries else []
+        else:
+            entries = self.entries.values()
+        return {
+            "version": f"{self.epoch}-{self.version}",
+            "installations": [entry for entry in entries if entry["version"] > version],
+        }
+
+
+def get_live_state(since="", imei=None, port=None):
+    """
+    Reads the live state from the UpdateFeed of the socket server.
+
+    :param since: The version returned by a previous call, to only
+        receive the installations changed since then.
+    :param imei: If given, only the installation with this IMEI is
+        returned.
+    :param port: The port of the feed. Defaults to
+        settings.SOCKET_SERVER_FEED_PORT.
+    :return: the snapshot (see LiveState.snapshot), or None if the
+        socket server is not available.
+    """
+    from django.conf import settings
+    from server.feed import FEED_PORT
+
+    if port is None:
+        port = getattr(settings, "SOCKET_SERVER_FEED_PORT", FEED_PORT)
+    try:
+        with sk.create_connection(("127.0.0.1", port), timeout=1) as s:
+            request = json.dumps({"since": since, "imei": imei})
+            s.sendall(f"GET {request}\n".encode())
+            with s.makefile("rb") as f:
+                line = f.readline()
+    except OSError:
+        return None
+    if not line:
+        return None
+    return json.loads(line)
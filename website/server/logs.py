@@ -0,0 +1,123 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import zlib
+from datetime import datetime
+from multiprocessing import Queue
+from pathlib import Path
+
+# Name of the logger of every connected RPi, followed by its IMEI
+# (see client_logger)
+CLIENT_LOGGER = "server.client"
+
+_listener = None
+
+
+def client_logger(imei=None) -> logging.Logger:
+    """
+    :param imei: The IMEI of the RPi, None until it is identified
+    :return: the logger of the connection with a RPi. There is one
+        logger for every IMEI, so that the records can be sampled by
+        IMEI (see ImeiSampler), and the number of loggers is bounded
+        by the size of the fleet instead of growing with every
+        connection.
+    """
+    if imei is None:
+        return logging.getLogger(CLIENT_LOGGER)
+    return logging.getLogger(f"{CLIENT_LOGGER}.{imei}")
+
+
+class ImeiSampler(logging.Filter):
+    """
+    Lets through the records of one RPi out of every <rate>, chosen
+    by IMEI, so that the sampled RPis keep a complete log while the
+    volume shrinks with the size of the fleet. Warnings and errors,
+    and the records of the other loggers, are never discarded.
+    """
+
+    def __init__(self, rate=1):
+        """
+        :param rate: 1 to keep every RPi, 10 to keep one out of ten
+        """
+        super(ImeiSampler, self).__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        prefix, _, imei = record.name.rpartition(".")
+        if prefix != CLIENT_LOGGER:
+            return True
+        return zlib.crc32(imei.encode()) % self.rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats every record as a JSON object on a single line, with the
+    IMEI of the RPi for the records of the connections.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        prefix, _, imei = record.name.rpartition(".")
+        if prefix == CLIENT_LOGGER:
+            entry["imei"] = imei
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+def configure_logging() -> None:
+    """
+    Configures the logging of the socket server. Every message is
+    written to a file in the logs directory, named after the startup
+    time and rotated every SOCKET_SERVER_LOG_MAX_BYTES bytes, as text
+    or as JSON lines (SOCKET_SERVER_LOG_FORMAT).
+
+    The file is only written by a QueueListener thread of this
+    process. Every logger, in this process and in the ones it forks,
+    puts its records on a multiprocessing Queue instead, so logging
+    never waits for the disk and the lines of different processes
+    are never interleaved. Records below SOCKET_SERVER_LOG_LEVEL are
+    discarded before being formatted, and the records of the RPis
+    are sampled by IMEI (SOCKET_SERVER_LOG_SAMPLING, see
+    ImeiSampler) before being queued.
+
+    Calling it again has no effect.
+
+    :return: None
+    """
+    global _listener
+    from django.conf import settings
+
+    if _listener is not None:
+        return
+    directory = Path("logs/")
+    directory.mkdir(exist_ok=True)
+    filename = directory / datetime.now().strftime("%Y-%m-%d_%H-%M-%S_server.log")
+    handler = logging.handlers.RotatingFileHandler(filename,
+                                                   maxBytes=getattr(settings, "SOCKET_SERVER_LOG_MAX_BYTES", 0),
+                                                   backupCount=getattr(settings, "SOCKET_SERVER_LOG_BACKUPS", 0))
+    if getattr(settings, "SOCKET_SERVER_LOG_FORMAT", "text") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("[%(asctime)s][%(levelname)s] %(message)s"))
+
+    queue = Queue()
+    queue_handler = logging.handlers.QueueHandler(queue)
+    queue_handler.addFilter(ImeiSampler(getattr(settings, "SOCKET_SERVER_LOG_SAMPLING", 1)))
+    root = logging.getLogger()
+    root.setLevel(getattr(settings, "SOCKET_SERVER_LOG_LEVEL", "DEBUG"))
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(queue, handler)
+    _listener.start()
+    # Writes the records still queued when the program terminates
+    atexit.register(_listener.stop)
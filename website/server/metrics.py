@@ -0,0 +1,264 @@
+import bisect
+import json
+import logging
+import os
+import socket as sk
+import time
+from threading import local
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Seconds after which the samples recorded by a thread are published
+PUBLISH_INTERVAL = 5
+
+# Maximum number of samples in a single datagram
+SAMPLES_PER_DATAGRAM = 100
+
+CONNECTIONS_ACCEPTED = "picontroller_connections_accepted_total"
+CONNECTIONS = "picontroller_connections"
+HANDSHAKE_SECONDS = "picontroller_handshake_seconds"
+GET_INFO_SECONDS = "picontroller_get_info_seconds"
+DECODE_SECONDS = "picontroller_telemetry_decode_seconds"
+WRITE_SECONDS = "picontroller_telemetry_write_seconds"
+COMMAND_LATENCY_SECONDS = "picontroller_command_latency_seconds"
+RECEIVED_BYTES = "picontroller_received_bytes_total"
+SENT_BYTES = "picontroller_sent_bytes_total"
+
+# Type and description of every metric, in the order they are exposed
+METRICS = {
+    CONNECTIONS_ACCEPTED: ("counter", "Connections accepted from the RPis."),
+    CONNECTIONS: ("gauge", "Open connections with the RPis."),
+    HANDSHAKE_SECONDS: ("histogram", "Duration of the identification of the RPis."),
+    GET_INFO_SECONDS: ("histogram", "Round trip time of GET_INFO."),
+    DECODE_SECONDS: ("histogram", "Time spent decoding the JSON telemetry of the RPis."),
+    WRITE_SECONDS: ("histogram", "Duration of the database writes of the telemetry."),
+    COMMAND_LATENCY_SECONDS: ("histogram", "Time from the creation of a Command to its acknowledgement."),
+    RECEIVED_BYTES: ("counter", "Bytes received from each RPi."),
+    SENT_BYTES: ("counter", "Bytes sent to each RPi."),
+}
+
+_local = local()
+
+
+class MetricsRecorder:
+    """
+    Records the metrics of a single thread of the socket server.
+    Every thread has its own recorder (see recorder), so recording a
+    sample is a dictionary update, without locks, cheap enough for
+    the hot paths.
+
+    The samples are kept as deltas: at most every PUBLISH_INTERVAL
+    seconds, while the thread records samples, or whenever publish is
+    called, they are sent to the UpdateFeed as UDP datagrams (see
+    server.feed) and reset. The feed adds them up in a MetricsStore,
+    so the processes of the socket server, including the short-lived
+    ones of the process mode, are exposed as a whole.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.counters = {}
+        self.histograms = {}
+        self.published = time.monotonic()
+
+    def increment(self, name: str, value, labels: tuple) -> None:
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+        if time.monotonic() - self.published >= PUBLISH_INTERVAL:
+            self.publish()
+
+    def observe(self, name: str, value: float, labels: tuple) -> None:
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # The count of every bucket, then the sum of the values
+            histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-1] += value
+        if time.monotonic() - self.published >= PUBLISH_INTERVAL:
+            self.publish()
+
+    def publish(self) -> None:
+        """
+        Sends the samples recorded since the last publication to the
+        UpdateFeed. If the feed is not available they are discarded.
+
+        :return: None
+        """
+        from django.conf import settings
+        from server.feed import FEED_PORT
+
+        self.published = time.monotonic()
+        samples = [[name, labels, value] for (name, labels), value in self.counters.items()]
+        samples += [[name, labels, histogram] for (name, labels), histogram in self.histograms.items()]
+        self.counters = {}
+        self.histograms = {}
+        if not samples:
+            return
+        port = getattr(settings, "SOCKET_SERVER_FEED_PORT", FEED_PORT)
+        try:
+            with sk.socket(sk.AF_INET, sk.SOCK_DGRAM) as s:
+                for i in range(0, len(samples), SAMPLES_PER_DATAGRAM):
+                    data = json.dumps({"metrics": samples[i:i + SAMPLES_PER_DATAGRAM]}, separators=(",", ":"))
+                    s.sendto(data.encode(), ("127.0.0.1", port))
+        except OSError:
+            logging.getLogger(__name__).debug("Could not publish metrics to the feed")
+
+
+def recorder() -> MetricsRecorder:
+    """
+    :return: the MetricsRecorder of the current thread. A forked
+        process does not inherit the samples of its parent, which
+        publishes them itself.
+    """
+    current = getattr(_local, "recorder", None)
+    if current is None or current.pid != os.getpid():
+        current = _local.recorder = MetricsRecorder()
+    return current
+
+
+def increment(name: str, value=1, imei=None) -> None:
+    """
+    Increments a counter, or a gauge if value is negative.
+
+    :param name: The name of the metric (see METRICS)
+    :param value: The increment
+    :param imei: The IMEI of the RPi, for the metrics by RPi
+    :return: None
+    """
+    recorder().increment(name, value, ("imei", imei) if imei is not None else ())
+
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Records a duration in a histogram.
+
+    :param name: The name of the metric (see METRICS)
+    :param seconds: The duration
+    :return: None
+    """
+    recorder().observe(name, seconds, ())
+
+
+def observe_command_latency(created) -> None:
+    """
+    Records the latency of an acknowledged Command.
+
+    :param created: The creation time of the Command, None for the
+        Commands created before it was recorded
+    :return: None
+    """
+    from django.utils import timezone
+
+    if created is not None:
+        observe(COMMAND_LATENCY_SECONDS, (timezone.now() - created).total_seconds())
+
+
+def publish() -> None:
+    """
+    Publishes the samples recorded by the current thread. To be
+    called before a process terminates, and periodically by the
+    threads that may stay idle.
+
+    :return: None
+    """
+    recorder().publish()
+
+
+class MetricsStore:
+    """
+    Adds up the samples published by the MetricsRecorders, and
+    renders them in the Prometheus text format. It is kept by the
+    UpdateFeed and read by the views through get_metrics.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, samples) -> None:
+        """
+        :param samples: The samples of a datagram (see
+            MetricsRecorder.publish)
+        :return: None
+        """
+        for name, labels, value in samples:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(labels))
+            if METRICS[name][0] == "histogram":
+                histogram = self.histograms.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    histogram[i] += v
+            else:
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self) -> str:
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for (n, labels), value in self.counters.items():
+                    if n == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            for (n, labels), histogram in self.histograms.items():
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + ('le', str(bound)))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: tuple) -> str:
+    """
+    :param labels: A flat tuple of names and values, e.g.
+        ("imei", "123...")
+    :return: the labels in the Prometheus text format. The values
+        are escaped, as the IMEIs are sent by the RPis.
+    """
+    if not labels:
+        return ""
+    pairs = [f'{labels[i]}="{escape_label(labels[i + 1])}"' for i in range(0, len(labels), 2)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def escape_label(value) -> str:
+    """
+    :param value: The value of a label
+    :return: the value with its backslashes, double quotes and line
+        feeds escaped, as required by the Prometheus text format
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def get_metrics(port=None):
+    """
+    Reads the metrics from the UpdateFeed of the socket server.
+
+    :param port: The port of the feed. Defaults to
+        settings.SOCKET_SERVER_FEED_PORT.
+    :return: the metrics in the Prometheus text format, or None if the
+        socket server is not available.
+    """
+    from django.conf import settings
+    from server.feed import FEED_PORT
+
+    if port is None:
+        port = getattr(settings, "SOCKET_SERVER_FEED_PORT", FEED_PORT)
+    try:
+        with sk.create_connection(("127.0.0.1", port), timeout=1) as s:
+            s.sendall(b"METRICS\n")
+            with s.makefile("rb") as f:
+                return f.read().decode("UTF-8")
+    except OSError:
+        return None
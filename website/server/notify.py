@@ -0,0 +1,314 @@
+import logging
+import selectors
+import socket as sk
+import time
+from queue import Queue
+from threading import Thread, Lock
+
+# Default port on which the socket server listens for notifications
+NOTIFY_PORT = 37864
+
+# Default maximum number of RPis woken up per second
+DISPATCH_RATE = 200
+
+# Maximum number of IMEIs in a single notification
+IMEIS_PER_DATAGRAM = 256
+
+# Prefix of the notification sent, followed by an IMEI, while the
+# installation is shown on a dashboard, so that its RPi is polled at
+# its fastest rate (see server.cadence.PollScheduler)
+WATCH_MESSAGE = "WATCH"
+
+# Minimum number of seconds between two notifications of an open
+# dashboard for the same installation sent by the same process
+WATCH_INTERVAL = 10
+
+# Maximum number of installations watched by a single request
+MAX_WATCHED = 100
+
+# When the last notification was sent, by IMEI, shared by the threads
+# of the web server
+last_watch = {}
+last_watch_lock = Lock()
+
+
+def notify_command(imei: str) -> None:
+    """
+    Notifies the socket server that a new Command has been saved for
+    the RPi with the given IMEI, so that it can be sent immediately.
+    The notification is a single UDP datagram sent to the local
+    socket server: if it gets lost, the command is still delivered,
+    as the database is checked periodically anyway.
+
+    :param imei: The IMEI of the recipient of the command
+    :return: None
+    """
+    notify_commands([imei])
+
+
+def notify_commands(imeis) -> None:
+    """
+    Same as notify_command, for many RPis at once. The IMEIs are sent
+    newline separated, in as few datagrams as possible.
+
+    :param imeis: A list with the IMEIs of the recipients
+    :return: None
+    """
+    from django.conf import settings
+
+    port = getattr(settings, "SOCKET_SERVER_NOTIFY_PORT", NOTIFY_PORT)
+    try:
+        with sk.socket(sk.AF_INET, sk.SOCK_DGRAM) as s:
+            for i in range(0, len(imeis), IMEIS_PER_DATAGRAM):
+                s.sendto("\n".join(imeis[i:i + IMEIS_PER_DATAGRAM]).encode(), ("127.0.0.1", port))
+    except OSError:
+        logging.getLogger(__name__).warning(f"Could not notify the socket server of commands for {len(imeis)} RPis")
+
+
+def watch_message(imei: str) -> str:
+    """
+    :param imei: The IMEI of a watched installation
+    :return: the notification that the installation is watched
+    """
+    return f"{WATCH_MESSAGE} {imei}"
+
+
+def parse_watch(message: str):
+    """
+    :param message: A notification
+    :return: the IMEI of the watched installation, or None if the
+        notification is not a watch_message
+    """
+    prefix, _, imei = message.partition(" ")
+    if prefix == WATCH_MESSAGE and imei:
+        return imei
+    return None
+
+
+def notify_watching(imeis) -> None:
+    """
+    Notifies the socket server that the installations with the given
+    IMEIs are shown on a dashboard. The notification lasts
+    PollScheduler.WATCH_TTL seconds, so it must be repeated while the
+    dashboard is open: it can be called on every request of the
+    dashboard, as it is only sent once every WATCH_INTERVAL seconds
+    for the same installation. Only the installations shown are
+    watched, so a dashboard showing the whole fleet, or more than
+    MAX_WATCHED installations, does not watch any.
+
+    :param imeis: The IMEIs of the installations shown, or None
+    :return: None
+    """
+    if not imeis or len(imeis) > MAX_WATCHED:
+        return
+    now = time.monotonic()
+    with last_watch_lock:
+        due = [imei for imei in imeis if imei not in last_watch or now - last_watch[imei] >= WATCH_INTERVAL]
+        if not due:
+            return
+        for imei in [imei for imei, sent in last_watch.items() if now - sent >= WATCH_INTERVAL]:
+            del last_watch[imei]
+        for imei in due:
+            last_watch[imei] = now
+    notify_commands([watch_message(imei) for imei in due])
+
+
+class CommandNotifier(Thread):
+    """
+    Listens for the notifications sent by notify_command and passes
+    the IMEI of every notification (or a watch_message, see
+    notify_watching) to the dispatch callable. This is
+    meant to run as a daemon thread of the socket server: dispatch
+    is called from this thread and from the one of the backlog (see
+    below), so it must be thread safe.
+
+    Dispatching of the notifications for many RPis at once (see
+    notify_commands) is rate limited, so that a command sent to the
+    whole fleet does not make every connection query the database at
+    the same time: at most rate of their IMEIs are dispatched per
+    second, by a second daemon thread. A notification for a single
+    RPi, and every watch_message, bypasses that backlog and is
+    dispatched immediately.
+    """
+
+    def __init__(self, dispatch, port=NOTIFY_PORT, rate=DISPATCH_RATE):
+        """
+        :param dispatch: A callable taking the IMEI of the RPi that
+            has a new Command.
+        :param port: The local UDP port to listen on
+        :param rate: The maximum number of IMEIs dispatched per second
+        """
+        super(CommandNotifier, self).__init__()
+        self.daemon = True
+        self.dispatch = dispatch
+        self.port = port
+        self.interval = 1 / rate
+        # The IMEIs of the notifications for many RPis
+        self.backlog = Queue()
+        self.logger = logging.getLogger(__name__)
+
+    def run(self) -> None:
+        with sk.socket(sk.AF_INET, sk.SOCK_DGRAM) as s:
+            try:
+                s.bind(("127.0.0.1", self.port))
+            except OSError:
+                self.logger.error(f"Could not listen for command notifications on port {self.port}. "
+                                  "Commands will be delivered by polling the database.")
+                return
+            self.logger.info(f"Listening for command notifications on port {self.port}")
+            Thread(target=self.dispatch_backlog, name="CommandNotifierBacklog", daemon=True).start()
+            while True:
+                data, _ = s.recvfrom(2 ** 16)
+                imeis = data.decode("UTF-8").split("\n")
+                for imei in imeis:
+                    if len(imeis) == 1 or parse_watch(imei) is not None:
+                        self.dispatch(imei)
+                    else:
+                        self.backlog.put(imei)
+
+    def dispatch_backlog(self) -> None:
+        """
+        Dispatches the IMEIs of the notifications for many RPis, at
+        most rate per second, forever.
+
+        :return: None
+        """
+        next_dispatch = 0
+        while True:
+            imei = self.backlog.get()
+            now = time.monotonic()
+            if now < next_dispatch:
+                time.sleep(next_dispatch - now)
+            next_dispatch = max(now, next_dispatch) + self.interval
+            self.dispatch(imei)
+
+
+class PipeBroadcaster:
+    """
+    A dispatch callable for CommandNotifier that forwards every IMEI
+    to a set of processes, through the sending end of a
+    multiprocessing.Pipe for each of them. Every process is
+    responsible for ignoring the IMEIs it does not serve. Pipes of
+    terminated processes are discarded. This is meant for the few
+    worker processes of AsyncAppSocketServer: processes serving a
+    single RPi each are served by a PipeRouter instead.
+    """
+
+    def __init__(self):
+        self.pipes = []
+        self.lock = Lock()
+
+    def add(self, pipe) -> None:
+        """
+        :param pipe: The sending end of a multiprocessing.Pipe
+        :return: None
+        """
+        with self.lock:
+            self.pipes.append(pipe)
+
+    def __call__(self, imei: str) -> None:
+        with self.lock:
+            alive = []
+            for pipe in self.pipes:
+                try:
+                    pipe.send(imei)
+                    alive.append(pipe)
+                except OSError:
+                    pipe.close()
+            self.pipes = alive
+
+
+class PipeRouter(Thread):
+    """
+    A dispatch callable for CommandNotifier that forwards every IMEI
+    only to the process serving the RPi with that IMEI, through a
+    duplex multiprocessing.Pipe for each process. Every process sends
+    the IMEI of its RPi on its Pipe once identified (see
+    ConnectedClient.identify), and this thread reads them. A
+    notification is therefore a single pipe write, whatever the
+    number of processes, and a busy process only delays its own
+    notifications. Notifications for RPis that are not connected are
+    dropped: once the IMEI of a process is registered, it is sent back
+    to it as a notification, so that its RPi checks its command queue
+    again and finds the Commands saved before the registration.
+
+    Pipes of terminated processes are discarded when their end of
+    file is read.
+    """
+
+    def __init__(self):
+        super(PipeRouter, self).__init__()
+        self.daemon = True
+        self.lock = Lock()
+        # The Pipes added since the last select
+        self.added = []
+        # The Pipe of the process serving every IMEI, and the reverse
+        self.owners = {}
+        self.imeis = {}
+        # Wakes up the selector of run when a Pipe is added
+        self.waker, self.wakeup = sk.socketpair()
+        self.wakeup.setblocking(False)
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, pipe) -> None:
+        """
+        :param pipe: The parent end of a duplex multiprocessing.Pipe
+        :return: None
+        """
+        with self.lock:
+            self.added.append(pipe)
+        try:
+            self.wakeup.send(b"\0")
+        except BlockingIOError:
+            # The selector has not read the previous wake ups yet
+            pass
+
+    def __call__(self, imei: str) -> None:
+        with self.lock:
+            pipe = self.owners.get(parse_watch(imei) or imei)
+        if pipe is None:
+            return
+        try:
+            pipe.send(imei)
+        except OSError:
+            # Discarded once its end of file is read
+            pass
+
+    def discard(self, pipe) -> None:
+        """
+        Forgets the Pipe of a terminated process.
+
+        :param pipe: The Pipe
+        :return: None
+        """
+        with self.lock:
+            imei = self.imeis.pop(pipe, None)
+            # The RPi may have reconnected in the meantime
+            if self.owners.get(imei) is pipe:
+                del self.owners[imei]
+        pipe.close()
+
+    def run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.waker, selectors.EVENT_READ)
+        while True:
+            with self.lock:
+                added, self.added = self.added, []
+            for pipe in added:
+                selector.register(pipe, selectors.EVENT_READ)
+            for key, _ in selector.select():
+                pipe = key.fileobj
+                if pipe is self.waker:
+                    self.waker.recv(4096)
+                    continue
+                try:
+                    imei = pipe.recv()
+                except (EOFError, OSError):
+                    selector.unregister(pipe)
+                    self.discard(pipe)
+                    continue
+                with self.lock:
+                    self.imeis[pipe] = imei
+                    self.owners[imei] = pipe
+                # Acknowledged as a notification (see above)
+                self(imei)
@@ -0,0 +1,260 @@
+import logging
+import os
+import signal
+import sys
+import time
+from collections import Counter
+from threading import Thread, Lock
+from django.db import transaction
+from django.utils import timezone
+from server.feed import publish_updates
+from server.database import close_stale_connections
+from server import telemetry
+from server.telemetry import get_ingestor
+
+_recorder = None
+_recorder_lock = Lock()
+
+
+def get_recorder():
+    """
+    Returns the SessionRecorder of the current process, creating and
+    starting it if necessary (see get_ingestor).
+
+    :return: the SessionRecorder of this process
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None or _recorder.pid != os.getpid():
+            from django.conf import settings
+
+            _recorder = SessionRecorder(getattr(settings, "SESSION_FLUSH_INTERVAL", 1.0))
+            _recorder.start()
+        return _recorder
+
+
+def shutdown() -> None:
+    """
+    Writes everything buffered by the SessionRecorder and the
+    TelemetryIngestor of the current process, including the rollups of
+    the minute in progress, so that no history is lost when the socket
+    server stops. To be called by every process of the socket server
+    before it exits.
+
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    with _recorder_lock:
+        recorder = _recorder if _recorder is not None and _recorder.pid == os.getpid() else None
+    with telemetry._ingestor_lock:
+        ingestor = telemetry._ingestor if telemetry._ingestor is not None and telemetry._ingestor.pid == os.getpid() \
+            else None
+    try:
+        if recorder is not None:
+            recorder.flush()
+        if ingestor is not None:
+            ingestor.flush()
+            ingestor.write_rollups()
+    except Exception:
+        logger.exception("Could not write the buffered connections and telemetry")
+
+
+def exit_on_terminate() -> None:
+    """
+    Makes SIGTERM exit the current process the way SIGINT does, so
+    that the finally clauses run, e.g. when multiprocessing terminates
+    the daemonic processes of the socket server. Must be called from
+    the main thread.
+
+    :return: None
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+
+def format_address(address) -> str:
+    """
+    :param address: The address of a RPi, as returned by
+        socket.accept()
+    :return: the address as "host:port"
+    """
+    if isinstance(address, tuple):
+        return f"{address[0]}:{address[1]}"
+    return str(address)
+
+
+class SessionRecorder(Thread):
+    """
+    Records every connection of the RPis as a ConnectionSession, and
+    keeps the online state of their Installations. Connections and
+    disconnections are buffered and written in bulk every
+    flush_interval seconds, so that after a restart the whole fleet
+    reconnects with a handful of statements instead of a few for
+    every RPi:
+
+    - a SELECT of the IMEIs never seen by this process, followed, only
+      for the IMEIs with no Installation, by an INSERT and a SELECT to
+      publish the new Installations;
+    - an INSERT of the new sessions and an UPDATE of the closed ones;
+    - an UPDATE of the Installations that went online, and one of the
+      Installations that went offline.
+
+    An Installation is online while it has an open session in this
+    process, so a RPi that reconnects before its previous connection
+    is closed stays online. The pending telemetry of the
+    Installations that went offline is written first (see
+    TelemetryIngestor.forget).
+    """
+
+    # The fields written when a session is closed
+    CLOSE_FIELDS = ("disconnected", "bytes_received", "bytes_sent")
+
+    def __init__(self, flush_interval=1.0):
+        """
+        :param flush_interval: Maximum time in seconds a connection or
+            disconnection is kept in memory.
+        """
+        super(SessionRecorder, self).__init__()
+        from app.models import Installation, ConnectionSession
+
+        self.daemon = True
+        self.pid = os.getpid()
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger(__name__)
+        self.Installation = Installation
+        self.ConnectionSession = ConnectionSession
+        self.lock = Lock()
+        # Flushes are serialized, so that a session is never closed
+        # before it is inserted
+        self.flush_lock = Lock()
+        # The sessions to insert, and the ones to close, by key
+        self.opened = {}
+        self.closed = {}
+        # The IMEIs whose online state may have changed
+        self.changed = set()
+        # The open sessions of this process, by IMEI
+        self.connections = Counter()
+        # The IMEIs that have an Installation
+        self.known = set()
+
+    def connect(self, imei: str, address):
+        """
+        Opens the session of a RPi that was just identified.
+
+        :param imei: The IMEI of the RPi
+        :param address: The address of the RPi, as returned by
+            socket.accept()
+        :return: the key of the session, for disconnect
+        """
+        session = self.ConnectionSession(imei=imei, address=format_address(address), connected=timezone.now())
+        with self.lock:
+            self.opened[session.id] = session
+            self.connections[imei] += 1
+            self.changed.add(imei)
+        return session.id
+
+    def disconnect(self, key, imei: str, bytes_received=0, bytes_sent=0) -> None:
+        """
+        Closes the session of a RPi.
+
+        :param key: The key returned by connect
+        :param imei: The IMEI of the RPi
+        :param bytes_received: The bytes received from the RPi
+        :param bytes_sent: The bytes sent to the RPi
+        :return: None
+        """
+        now = timezone.now()
+        with self.lock:
+            # A session not written yet is inserted already closed
+            session = self.opened.get(key)
+            if session is None:
+                session = self.closed[key] = self.ConnectionSession(id=key)
+            session.disconnected = now
+            session.bytes_received = bytes_received
+            session.bytes_sent = bytes_sent
+            self.connections[imei] -= 1
+            if self.connections[imei] <= 0:
+                del self.connections[imei]
+            self.changed.add(imei)
+
+    def flush(self) -> int:
+        """
+        Writes every buffered connection and disconnection to the
+        database.
+
+        :return: The number of Installations whose online state was
+            written
+        """
+        with self.flush_lock:
+            with self.lock:
+                opened, closed, changed = self.opened, self.closed, self.changed
+                self.opened, self.closed, self.changed = {}, {}, set()
+                online = {imei for imei in changed if self.connections[imei] > 0}
+            if not changed:
+                return 0
+            offline = changed - online
+
+            unknown = {session.imei for session in opened.values()} - self.known
+            try:
+                # Outside of the transaction, as SQLite does not wait
+                # for the other writers when a transaction that read
+                # starts writing. First, so that the telemetry of the
+                # new Installations, kept until they exist (see
+                # TelemetryIngestor.flush), is written below.
+                created = self.create_installations(unknown)
+                # The sessions are written even if the telemetry is not
+                ingestor = get_ingestor()
+                for imei in offline:
+                    try:
+                        ingestor.forget(imei)
+                    except Exception:
+                        self.logger.exception(f"Could not write the telemetry of {imei}")
+                with transaction.atomic():
+                    if opened:
+                        self.ConnectionSession.objects.bulk_create(opened.values())
+                    if closed:
+                        self.ConnectionSession.objects.bulk_update(closed.values(), self.CLOSE_FIELDS)
+                    if online:
+                        self.Installation.objects.filter(imei__in=online).update(online=True)
+                    if offline:
+                        self.Installation.objects.filter(imei__in=offline).update(online=False)
+            except Exception:
+                # Keep everything for the next flush: the online state
+                # is computed again from the open sessions
+                with self.lock:
+                    self.opened = {**opened, **self.opened}
+                    self.closed = {**closed, **self.closed}
+                    self.changed |= changed
+                raise
+            self.known |= unknown
+            self.logger.debug(f"{len(online)} installations online and {len(offline)} offline")
+            # update does not send the post_save signals
+            publish_updates(created + [{"imei": imei, "online": imei in online} for imei in changed])
+            return len(changed)
+
+    def create_installations(self, imeis) -> list:
+        """
+        Creates the Installations of the given IMEIs that do not have
+        one yet.
+
+        :param imeis: A set of IMEIs
+        :return: the fields of the new Installations, to publish them
+            to the live state
+        """
+        if not imeis:
+            return []
+        missing = imeis - set(self.Installation.objects.filter(imei__in=imeis).values_list("imei", flat=True))
+        if not missing:
+            return []
+        # Another process may create the same Installation
+        self.Installation.objects.bulk_create([self.Installation(imei=imei, online=True) for imei in missing],
+                                              ignore_conflicts=True)
+        return list(self.Installation.objects.filter(imei__in=missing).values(*self.Installation.SNAPSHOT_FIELDS))
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                close_stale_connections()
+                self.flush()
+            except Exception:
+                self.logger.exception("Could not record the connections")
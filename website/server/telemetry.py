@@ -0,0 +1,357 @@
+import logging
+import os
+import time
+from threading import Thread, Lock, Event
+from django.core.exceptions import ValidationError
+from django.db import OperationalError
+from django.db.models import Q
+from django.utils import timezone
+from server.feed import publish_updates
+from server.database import close_stale_connections
+from server import metrics
+from server.alarms import publish_alarm_events, RAISED, CLEARED
+
+_ingestor = None
+_ingestor_lock = Lock()
+_missing = object()
+
+# Maximum number of cleared Alarms matched by a single UPDATE
+ALARMS_PER_QUERY = 200
+
+
+def get_ingestor():
+    """
+    Returns the TelemetryIngestor of the current process, creating and
+    starting it if necessary. Processes forked by the socket server
+    do not inherit the flushing thread of their parent, so every
+    process gets its own ingestor.
+
+    :return: the TelemetryIngestor of this process
+    """
+    global _ingestor
+    with _ingestor_lock:
+        if _ingestor is None or _ingestor.pid != os.getpid():
+            from django.conf import settings
+
+            _ingestor = TelemetryIngestor(getattr(settings, "TELEMETRY_FLUSH_INTERVAL", 1.0),
+                                          getattr(settings, "TELEMETRY_FLUSH_SIZE", 500))
+            _ingestor.start()
+        return _ingestor
+
+
+class TelemetryIngestor(Thread):
+    """
+    Buffers the GET_INFO replies of the RPis and writes them to the
+    database in bulk. Updates for the same IMEI received before a
+    flush are merged, and fields whose value did not change since the
+    last flush are discarded, so that only the fields that actually
+    changed are written.
+
+    The buffer is flushed every flush_interval seconds, or as soon as
+    it holds flush_size IMEIs. Every flush issues one UPDATE for each
+    distinct set of changed fields (see QuerySet.bulk_update) and no
+    SELECT, as the primary keys of the Installations are cached.
+
+    The changes are then published to the UpdateFeed (see
+    server.feed). Every flush also appends a Reading for each Installation whose
+    history fields (see Reading.FIELDS) changed, with a single INSERT.
+    The Readings are also added up by minute in memory, and written as
+    ReadingRollups with a single INSERT once the minute is over (see
+    write_rollups).
+
+    The alarms are not a field of Installation: when the list of
+    nodes in an alarm state of a RPi changes, an Alarm is raised for
+    every new node and the Alarms of the nodes that left the list are
+    cleared (see write_alarms), and an event is published for each
+    one (see server.alarms). A change of the alarms is flushed right
+    away instead of waiting for flush_interval.
+    """
+
+    def __init__(self, flush_interval=1.0, flush_size=500):
+        """
+        :param flush_interval: Maximum time in seconds an update is
+            kept in memory.
+        :param flush_size: Number of buffered IMEIs that triggers a
+            flush.
+        """
+        super(TelemetryIngestor, self).__init__()
+        from app.models import Installation, Reading, ReadingRollup, Alarm
+
+        self.daemon = True
+        self.pid = os.getpid()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.logger = logging.getLogger(__name__)
+        self.Installation = Installation
+        self.Reading = Reading
+        self.ReadingRollup = ReadingRollup
+        self.Alarm = Alarm
+        self.fields = {f.attname: f for f in Installation._meta.concrete_fields if f.attname not in ("id", "imei")}
+        self.lock = Lock()
+        self.flush_requested = Event()
+        self.pending = {}
+        self.last_values = {}
+        self.primary_keys = {}
+        # The minimum, maximum, total and number of values of every
+        # field, by IMEI and minute
+        self.rollups = {}
+
+    def submit(self, imei: str, info: dict) -> None:
+        """
+        Buffers a GET_INFO reply. Keys that are not fields of
+        Installation, other than the alarms, are ignored, and so are
+        the values that can not be converted to their field (see
+        clean).
+
+        :param imei: The IMEI of the RPi that sent the reply
+        :param info: The decoded GET_INFO reply
+        :return: None
+        """
+        info = self.clean(imei, info)
+        with self.lock:
+            last = self.last_values.get(imei, {})
+            pending = self.pending.setdefault(imei, {})
+            for key, value in info.items():
+                if last.get(key, _missing) == value:
+                    pending.pop(key, None)
+                else:
+                    pending[key] = value
+                    # Every reconnecting RPi sends its alarms, usually
+                    # none: they only need a flush if there are some
+                    if key == "alarms" and (value or last.get(key)):
+                        self.flush_requested.set()
+            if len(self.pending) >= self.flush_size:
+                self.flush_requested.set()
+
+    def clean(self, imei: str, info: dict) -> dict:
+        """
+        Converts the values of a GET_INFO reply to the type of their
+        field. A value that can not be converted is logged and
+        discarded here, as it would make every flush fail.
+
+        :param imei: The IMEI of the RPi that sent the reply
+        :param info: The decoded GET_INFO reply
+        :return: the converted values of the known fields
+        """
+        cleaned = {}
+        for key, value in info.items():
+            try:
+                if key == "alarms":
+                    if not isinstance(value, list):
+                        raise TypeError()
+                    cleaned[key] = [int(node) for node in value]
+                elif key in self.fields:
+                    field = self.fields[key]
+                    value = field.to_python(value)
+                    if value is None and not field.null:
+                        raise ValidationError(field.error_messages["null"])
+                    field.run_validators(value)
+                    cleaned[key] = value
+            except (ValidationError, TypeError, ValueError):
+                self.logger.warning(f"Discarding invalid {key} {value!r} of {imei}")
+        return cleaned
+
+    def forget(self, imei: str) -> None:
+        """
+        Flushes the updates and the rollups of the given IMEI and
+        discards its cached values. To be called when the RPi
+        disconnects.
+
+        :param imei: The IMEI of the disconnected RPi
+        :return: None
+        """
+        self.flush()
+        with self.lock:
+            self.last_values.pop(imei, None)
+            # Still no Installation (see flush): nothing to keep it for
+            self.pending.pop(imei, None)
+        self.write_rollups(imei=imei)
+
+    def flush(self) -> int:
+        """
+        Writes every buffered update to the database.
+
+        :return: The number of Installations updated
+        """
+        with self.lock:
+            pending = {imei: fields for imei, fields in self.pending.items() if fields}
+            self.pending = {}
+        if not pending:
+            return 0
+
+        missing = [imei for imei in pending if imei not in self.primary_keys]
+        if missing:
+            self.primary_keys.update(self.Installation.objects.filter(imei__in=missing).values_list("imei", "id"))
+
+        # The Installation of a new RPi is created by the
+        # SessionRecorder of its connection (see server.sessions), maybe
+        # after its first reply: the reply is kept until then, as the
+        # TelemetryDecoder only sends the fields again once they change
+        unknown = [imei for imei in pending if imei not in self.primary_keys]
+        if unknown:
+            with self.lock:
+                for imei in unknown:
+                    self.pending[imei] = {**pending.pop(imei), **self.pending.get(imei, {})}
+            self.logger.debug(f"Keeping the telemetry of {len(unknown)} IMEIs with no installation yet")
+            if not pending:
+                return 0
+
+        # Group the Installations by set of changed fields, so that
+        # every UPDATE only writes what changed
+        groups = {}
+        for imei, fields in pending.items():
+            fields = {key: value for key, value in fields.items() if key != "alarms"}
+            if fields:
+                groups.setdefault(tuple(sorted(fields)), []).append(self.Installation(id=self.primary_keys[imei],
+                                                                                      **fields))
+        alarms = {imei: fields["alarms"] for imei, fields in pending.items() if "alarms" in fields}
+        start = time.monotonic()
+        try:
+            for fields, installations in groups.items():
+                self.Installation.objects.bulk_update(installations, fields)
+            if alarms:
+                self.write_alarms(alarms)
+        except OperationalError:
+            # The database is locked or unreachable: keep the updates
+            # for the next flush, unless newer ones were received in
+            # the meantime. Any other error would happen again, so the
+            # updates are discarded.
+            with self.lock:
+                for imei, fields in pending.items():
+                    self.pending[imei] = {**fields, **self.pending.get(imei, {})}
+            raise
+        elapsed = time.monotonic() - start
+        metrics.observe(metrics.WRITE_SECONDS, elapsed)
+        self.logger.debug(f"Flushed telemetry of {len(pending)} installations in {elapsed * 1000:.1f} ms")
+        publish_updates([dict(fields, imei=imei) for imei, fields in pending.items()], seen=True)
+
+        with self.lock:
+            for imei, fields in pending.items():
+                self.last_values.setdefault(imei, {}).update(fields)
+            readings = [self.reading(imei) for imei, fields in pending.items()
+                        if not fields.keys().isdisjoint(self.Reading.FIELDS)]
+            self.roll_up(readings)
+        if readings:
+            self.Reading.objects.bulk_create(readings)
+        return len(pending)
+
+    def write_alarms(self, alarms: dict) -> None:
+        """
+        Raises and clears the Alarms of the given IMEIs, with a query
+        for the active Alarms of the IMEIs whose alarms are not cached,
+        an INSERT for the raised ones and an UPDATE for the cleared
+        ones.
+
+        :param alarms: The new lists of nodes in an alarm state, by
+            IMEI
+        :return: None
+        """
+        with self.lock:
+            active = {imei: self.last_values.get(imei, {}).get("alarms") for imei in alarms}
+        unknown = [imei for imei, nodes in active.items() if nodes is None]
+        if unknown:
+            loaded = self.Alarm.objects.active().filter(imei__in=unknown).nodes_by_imei()
+            active.update({imei: loaded.get(imei, []) for imei in unknown})
+
+        now = timezone.now()
+        raised = []
+        cleared = []
+        for imei, nodes in alarms.items():
+            raised += [self.Alarm(imei=imei, node=node, raised=now) for node in set(nodes) - set(active[imei])]
+            cleared += [Q(imei=imei, node=node) for node in set(active[imei]) - set(nodes)]
+        for i in range(0, len(cleared), ALARMS_PER_QUERY):
+            condition = Q()
+            for match in cleared[i:i + ALARMS_PER_QUERY]:
+                condition |= match
+            self.Alarm.objects.active().filter(condition).update(cleared=now)
+        if raised:
+            self.Alarm.objects.bulk_create(raised)
+
+        timestamp = now.isoformat()
+        events = [{"imei": alarm.imei, "node": alarm.node, "event": RAISED, "time": timestamp} for alarm in raised]
+        for imei, nodes in alarms.items():
+            events += [{"imei": imei, "node": node, "event": CLEARED, "time": timestamp}
+                       for node in sorted(set(active[imei]) - set(nodes))]
+        if events:
+            publish_alarm_events(events)
+
+    def reading(self, imei: str):
+        """
+        Creates a Reading with the last known values of the given
+        IMEI. Fields never received since the RPi connected are left
+        empty.
+
+        :param imei: The IMEI of the RPi
+        :return: an unsaved Reading
+        """
+        last = self.last_values[imei]
+        values = {field: last.get(field) for field in self.Reading.FIELDS}
+        return self.Reading(imei=imei, ts=int(time.time()), **values)
+
+    def roll_up(self, readings) -> None:
+        """
+        Adds the given Readings to the rollups of their minute. Must
+        be called with the lock held.
+
+        :param readings: A list of Readings
+        :return: None
+        """
+        for reading in readings:
+            rollup = self.rollups.setdefault((reading.imei, reading.ts // 60 * 60), {})
+            for field in self.Reading.FIELDS:
+                value = getattr(reading, field)
+                if value is None:
+                    continue
+                value = int(value)
+                values = rollup.get(field)
+                if values is None:
+                    rollup[field] = [value, value, value, 1]
+                else:
+                    values[0] = min(values[0], value)
+                    values[1] = max(values[1], value)
+                    values[2] += value
+                    values[3] += 1
+
+    def write_rollups(self, before=None, imei=None) -> int:
+        """
+        Writes the rollups of the minutes before the given one, or of
+        every minute of the given IMEI, with a single INSERT.
+
+        :param before: The UNIX timestamp of a minute
+        :param imei: The IMEI of a RPi
+        :return: The number of ReadingRollups written
+        """
+        with self.lock:
+            keys = [key for key in self.rollups
+                    if (imei is None or key[0] == imei) and (before is None or key[1] < before)]
+            rollups = {key: self.rollups.pop(key) for key in keys}
+        rows = [self.ReadingRollup(imei=key[0], minute=key[1], field=field, min=values[0], max=values[1],
+                                   total=values[2], count=values[3])
+                for key, fields in rollups.items() for field, values in fields.items()]
+        try:
+            self.ReadingRollup.objects.bulk_create(rows)
+        except OperationalError:
+            # Retried on the next flush, as the updates are (see flush)
+            with self.lock:
+                for key, fields in rollups.items():
+                    rollup = self.rollups.setdefault(key, {})
+                    for field, values in fields.items():
+                        newer = rollup.get(field)
+                        if newer is not None:
+                            values = [min(values[0], newer[0]), max(values[1], newer[1]),
+                                      values[2] + newer[2], values[3] + newer[3]]
+                        rollup[field] = values
+            raise
+        return len(rows)
+
+    def run(self) -> None:
+        while True:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                close_stale_connections()
+                self.flush()
+                self.write_rollups(before=int(time.time()) // 60 * 60)
+            except Exception:
+                self.logger.exception("Could not flush telemetry")
+            metrics.publish()
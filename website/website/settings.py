@@ -36,7 +36,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'app',
+    'app.apps.AppConfig',
 ]
 
 MIDDLEWARE = [
@@ -73,12 +73,51 @@ WSGI_APPLICATION = 'website.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# SQLite is the default, for a single node: the socket server switches
+# it to WAL mode (DATABASE_WAL), so that the dashboard can read while
+# the socket server writes, and writers wait up to DATABASE_TIMEOUT
+# seconds for the lock instead of failing with "database is locked".
+# The journal mode is stored in the database file, so other commands,
+# e.g. "manage.py check", never change it. The SQLITE_PRAGMAS are set
+# on every connection (see app.apps.AppConfig): synchronous=NORMAL only
+# syncs the WAL at checkpoints.
+# Set DATABASE_ENGINE=postgresql, and the other DATABASE_* variables,
+# to use PostgreSQL, which supports concurrent writes from every
+# socket server process. When HOST and PORT point to a transaction
+# pooler such as PgBouncer, set DATABASE_POOLER=1 so that the
+# connections are shared by all the processes.
+#
+# Connections are persistent (CONN_MAX_AGE): every process, or
+# every event loop in asyncio mode, keeps its own connection open.
+
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite3')
+DATABASE_TIMEOUT = 20
+DATABASE_WAL = True
+SQLITE_PRAGMAS = {'synchronous': 'NORMAL'}
+
+if DATABASE_ENGINE == 'sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DATABASE_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+            'OPTIONS': {'timeout': DATABASE_TIMEOUT},
+            'CONN_MAX_AGE': 600,
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.' + DATABASE_ENGINE,
+            'NAME': os.environ.get('DATABASE_NAME', 'picancontroller'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
+            'PORT': os.environ.get('DATABASE_PORT', ''),
+            'CONN_MAX_AGE': 600,
+            # Server-side cursors do not work through a transaction pooler
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DATABASE_POOLER', '') == '1',
+        }
     }
-}
 
 
 # Password validation
@@ -125,4 +164,83 @@ STATICFILES_DIRS = [
 
 LOGIN_URL = '/app/login'
 LOGIN_REDIRECT_URL = 'dashboard'
-LOGOUT_REDIRECT_URL = 'login'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = 'login'
+
+# Socket server, started with "manage.py runsocketserver"
+# "asyncio" serves every RPi from an event loop (see
+# server.asyncserver), "process" forks a process for every RPi.
+
+SOCKET_SERVER_MODE = "asyncio"
+
+# Port the RPis connect to
+
+SOCKET_SERVER_PORT = 37863
+
+# Seconds within which "manage.py runsocketserver" is expected to
+# listen for the RPis after a restart, from the start of its process
+
+SOCKET_SERVER_STARTUP_BUDGET = 2.0
+
+# Number of processes sharing the listening socket in asyncio mode
+
+SOCKET_SERVER_WORKERS = 1
+
+# Local UDP port on which the views notify new commands to the socket
+# server (see server.notify)
+
+SOCKET_SERVER_NOTIFY_PORT = 37864
+
+# Maximum number of RPis woken up per second by the notifications, so
+# that a command sent to the whole fleet is delivered gradually
+
+SOCKET_SERVER_DISPATCH_RATE = 200
+
+# Local port of the feed through which the socket server pushes the
+# changes of the installations to the dashboards (see server.feed)
+
+SOCKET_SERVER_FEED_PORT = 37865
+
+# Seconds between two reloads of the live state of the feed from the
+# database, which correct the updates lost by the UDP datagrams
+
+SOCKET_SERVER_FEED_RELOAD_INTERVAL = 60
+
+# Logging of the socket server (see server.logs): minimum level, "text"
+# or "json" lines, size in bytes after which the file is rotated and
+# rotated files kept. With a sampling of N only one RPi out of N logs
+# its messages below WARNING.
+
+SOCKET_SERVER_LOG_LEVEL = "INFO"
+SOCKET_SERVER_LOG_FORMAT = "text"
+SOCKET_SERVER_LOG_MAX_BYTES = 10 * 2 ** 20
+SOCKET_SERVER_LOG_BACKUPS = 5
+SOCKET_SERVER_LOG_SAMPLING = 1
+
+# Alarm events (see server.alarms) are pushed to the dashboards and, if
+# enabled, POSTed to ALARM_WEBHOOK_URL (e.g. the local stand-in
+# "http://127.0.0.1:8000/app/alarms/webhook") and emailed to
+# ALARM_EMAIL_RECIPIENTS, through a spool directory by default
+
+ALARM_WEBHOOK_URL = None
+ALARM_EMAIL_RECIPIENTS = []
+ALARM_EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
+ALARM_EMAIL_SPOOL = os.path.join(BASE_DIR, 'spool', 'alarms')
+
+# Addresses allowed to read /metrics without logging in, e.g. the
+# Prometheus server (see server.metrics)
+
+METRICS_ALLOWED_ADDRESSES = ['127.0.0.1', '::1']
+
+# Telemetry received from the RPis is written to the database at most
+# every TELEMETRY_FLUSH_INTERVAL seconds, or as soon as
+# TELEMETRY_FLUSH_SIZE installations have pending updates (see
+# server.telemetry)
+
+TELEMETRY_FLUSH_INTERVAL = 1.0
+TELEMETRY_FLUSH_SIZE = 500
+
+# The connections and disconnections of the RPis, and the online state
+# of the installations, are written to the database at most every
+# SESSION_FLUSH_INTERVAL seconds (see server.sessions)
+
+SESSION_FLUSH_INTERVAL = 1.0
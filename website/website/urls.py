@@ -18,18 +18,16 @@ from django.urls import path, include
 from django.views.generic import RedirectView
 from django.conf import settings
 from django.conf.urls.static import static
-from appsocketserver import AppSocketServer
+from app import views as app_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', RedirectView.as_view(url='app/dashboard/', permanent=True)),
     path('app/', include('app.urls')),
+    path('metrics', app_views.metrics, name='metrics'),
 ]
 
 # To serve also static files like CSS, Js...
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
-# Start
-socketServer = AppSocketServer()
-socketServer.daemon = True
-socketServer.start()
+# The socket server runs on its own, with "manage.py runsocketserver"